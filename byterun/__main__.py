@@ -2,8 +2,12 @@
 
 import argparse
 import logging
+import sys
 
 from . import execfile
+from .codecache import CodeCache
+from .profiling import FunctionProfiler, OpcodeProfiler, SamplingProfiler
+from .pyvm2 import VirtualMachine
 
 parser = argparse.ArgumentParser(
     prog="byterun",
@@ -17,6 +21,53 @@ parser.add_argument(
     '-v', '--verbose', dest='verbose', action='store_true',
     help="trace the execution of the bytecode.",
 )
+parser.add_argument(
+    '-O', '--optimize', dest='optimize', action='store_true',
+    help="run the bytecode through the peephole optimizer first.",
+)
+parser.add_argument(
+    '--transpile-after', dest='transpile_after', metavar='N', type=int,
+    help=(
+        "transpile functions to Python source after they run N times, "
+        "and run them natively from then on."
+    ),
+)
+parser.add_argument(
+    '--code-cache', dest='code_cache', metavar='DIR',
+    help="keep the compiled and decoded program in DIR for the next run.",
+)
+parser.add_argument(
+    '--interpret-imports', dest='interpret_imports', metavar='PATTERN',
+    action='append', default=[],
+    help=(
+        "run imported modules matching PATTERN in the interpreter too, "
+        "rather than natively. Can be given more than once."
+    ),
+)
+parser.add_argument(
+    '--profile-opcodes', dest='profile_opcodes', metavar='FILE',
+    help=(
+        "profile the opcodes run, and write the results to FILE: "
+        "JSON if it ends with .json, otherwise in pstats format."
+    ),
+)
+parser.add_argument(
+    '--profile-functions', dest='profile_functions', metavar='FILE',
+    help="profile the functions run, and write the results to FILE.",
+)
+parser.add_argument(
+    '--profile-samples', dest='profile_samples', metavar='FILE',
+    help=(
+        "sample the running stack, write the collapsed stacks to FILE, "
+        "and summarize the hottest lines. Can't be used with "
+        "--transpile-after."
+    ),
+)
+parser.add_argument(
+    '--sample-interval', dest='sample_interval', metavar='SECONDS',
+    type=float, default=0.005,
+    help="how often to sample with --profile-samples.",
+)
 parser.add_argument(
     'prog',
     help="The program to run.",
@@ -26,6 +77,9 @@ parser.add_argument(
     help="Arguments to pass to the program.",
 )
 args = parser.parse_args()
+if args.profile_samples and args.transpile_after is not None:
+    # Transpiled code doesn't keep its frame's line up to date.
+    parser.error("--profile-samples can't be used with --transpile-after")
 
 if args.module:
     run_fn = execfile.run_python_module
@@ -35,5 +89,42 @@ else:
 level = logging.DEBUG if args.verbose else logging.WARNING
 logging.basicConfig(level=level)
 
+# Sampling needs the 'dispatch' engine, see SamplingProfiler.
+vm = VirtualMachine(
+    engine='dispatch', optimize=args.optimize,
+    transpile_after=args.transpile_after,
+)
+if args.profile_opcodes:
+    vm.opcode_profiler = OpcodeProfiler()
+if args.profile_functions:
+    vm.function_profiler = FunctionProfiler()
+if args.profile_samples:
+    sampler = SamplingProfiler(vm, args.sample_interval)
+    sampler.start()
+
+code_cache = None
+if args.code_cache:
+    code_cache = CodeCache(args.code_cache)
+
+importer = execfile.InterpretedImporter(
+    vm, args.interpret_imports, code_cache=code_cache,
+)
+if args.interpret_imports:
+    importer.install()
+
 argv = [args.prog] + args.args
-run_fn(args.prog, argv)
+try:
+    run_fn(args.prog, argv, vm=vm, code_cache=code_cache)
+finally:
+    importer.uninstall()
+    if args.profile_opcodes:
+        if args.profile_opcodes.endswith('.json'):
+            vm.opcode_profiler.write_json(args.profile_opcodes)
+        else:
+            vm.opcode_profiler.write_pstats(args.profile_opcodes)
+    if args.profile_functions:
+        vm.function_profiler.write_pstats(args.profile_functions)
+    if args.profile_samples:
+        sampler.stop()
+        sampler.write_collapsed(args.profile_samples)
+        sys.stderr.write(sampler.summary())
@@ -0,0 +1,141 @@
+"""Benchmarks comparing Byterun with the real Python interpreter.
+
+Each benchmark is the source of a module defining `main(n)`, which does
+work in proportion to `n` and returns a result.  The result must be the same
+whether the VM or the real interpreter runs it.
+
+"""
+
+import collections
+import platform
+import sys
+from timeit import default_timer
+
+import six
+from six.moves import builtins
+
+from byterun.profiling import OpcodeProfiler
+from byterun.pyvm2 import VirtualMachine
+
+
+# One benchmark.  `kind` is 'micro' or 'macro', `n` is the size to run.
+Benchmark = collections.namedtuple("Benchmark", "name, kind, n, source")
+
+
+def all_benchmarks():
+    """Get the list of all the Benchmarks."""
+    from . import macro, micro
+    return micro.BENCHMARKS + macro.BENCHMARKS
+
+
+def load(bench, vm=None):
+    """Make the `main` function of `bench`.
+
+    With a VirtualMachine `vm`, the module is run in it, and `main` is an
+    interpreted function.  Otherwise it's run natively.
+
+    """
+    code = compile(bench.source, "<bench %s>" % bench.name, "exec")
+    globs = {'__builtins__': builtins, '__name__': '__bench__'}
+    if vm is None:
+        six.exec_(code, globs)
+    else:
+        vm.run_code(code, f_globals=globs)
+    return globs['main']
+
+
+def time_calls(main, n, repeat):
+    """Call `main(n)` `repeat` times, returning the result and the times."""
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        result = main(n)
+        times.append(default_timer() - start)
+    return result, times
+
+
+def count_instructions(bench, engine, n):
+    """Count the bytecode instructions one run of `bench` executes."""
+    vm = VirtualMachine(engine=engine)
+    main = load(bench, vm)
+    vm.opcode_profiler = profiler = OpcodeProfiler()
+    main(n)
+    return sum(count for count, _ in profiler.opcodes.values())
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmark(bench, engine='dispatch', repeat=5, n=None,
+                  optimize=False, transpile_after=None):
+    """Run one benchmark in the VM and natively, returning a dict of results.
+
+    The first run in the VM is the warmup, which decodes the code, fills the
+    caches, and transpiles hot functions if `transpile_after` is given.  The
+    runs after it are the steady state, which is what the instruction rate
+    and the slowdown are measured from.  The instructions are counted
+    unoptimized and untranspiled, so rates with and without them compare.
+
+    """
+    if n is None:
+        n = bench.n
+    repeat = max(repeat, 2)
+
+    native_result, native_times = time_calls(load(bench), n, repeat)
+    vm = VirtualMachine(
+        engine=engine, optimize=optimize, transpile_after=transpile_after,
+    )
+    vm_result, vm_times = time_calls(load(bench, vm), n, repeat)
+    if vm_result != native_result:
+        raise AssertionError(
+            "Benchmark %s got %r in the VM, but %r natively" %
+            (bench.name, vm_result, native_result)
+        )
+
+    instructions = count_instructions(bench, engine, n)
+    steady = median(vm_times[1:])
+    native = min(native_times)
+    return {
+        'kind': bench.kind,
+        'n': n,
+        'instructions': instructions,
+        'native_time': native,
+        'warmup_time': vm_times[0],
+        'steady_time': steady,
+        'times': vm_times,
+        'warmup_ratio': vm_times[0] / steady if steady else 0.0,
+        'slowdown': steady / native if native else 0.0,
+        'instructions_per_second': instructions / steady if steady else 0.0,
+    }
+
+
+def run_benchmarks(benchmarks, engine='dispatch', repeat=5, report=None,
+                   optimize=False, transpile_after=None):
+    """Run `benchmarks`, returning the results to save as JSON.
+
+    `report` is called with each benchmark's name and results as they're
+    done, if given.
+
+    """
+    results = {}
+    for bench in benchmarks:
+        results[bench.name] = run_benchmark(
+            bench, engine, repeat, optimize=optimize,
+            transpile_after=transpile_after,
+        )
+        if report is not None:
+            report(bench.name, results[bench.name])
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'engine': engine,
+        'optimize': optimize,
+        'transpile_after': transpile_after,
+        'repeat': repeat,
+        'benchmarks': results,
+    }
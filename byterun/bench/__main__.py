@@ -0,0 +1,109 @@
+"""Run the Byterun benchmarks: python -m byterun.bench"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import sys
+
+from byterun.bench import all_benchmarks, run_benchmarks
+from byterun.bench.memory import measure_memory
+from byterun.pyvm2 import VirtualMachine
+
+parser = argparse.ArgumentParser(
+    prog="byterun.bench",
+    description="Time Byterun against the real Python interpreter.",
+)
+parser.add_argument(
+    '--engine', default='dispatch', choices=VirtualMachine.ENGINES,
+    help="the VM engine to run the benchmarks with.",
+)
+parser.add_argument(
+    '--optimize', action='store_true',
+    help="run the benchmarks with the peephole optimizer.",
+)
+parser.add_argument(
+    '--transpile-after', type=int, metavar='N',
+    help="transpile functions to Python source after N runs.",
+)
+parser.add_argument(
+    '--repeat', type=int, default=5,
+    help="how many times to run each benchmark, including the warmup.",
+)
+parser.add_argument(
+    '--json', dest='json_file', metavar='FILE',
+    help="save the results to FILE as JSON.",
+)
+parser.add_argument(
+    '--compare', metavar='FILE',
+    help="compare the results with those saved in FILE.",
+)
+parser.add_argument(
+    '--memory', action='store_true',
+    help="measure the bytes per frame, closure and generator instead.",
+)
+parser.add_argument(
+    'names', nargs='*',
+    help="the benchmarks to run, all of them if none are given.",
+)
+args = parser.parse_args()
+
+# The VM logs each exception it catches, which isn't what we're timing.
+logging.getLogger('byterun').setLevel(logging.CRITICAL)
+
+if args.memory:
+    sizes = measure_memory(args.engine)
+    print("%-16s %10s %10s %9s" % ("object", "vm bytes", "native", "ratio"))
+    for kind in ['frame', 'closure', 'generator']:
+        vm_size, native_size = sizes[kind]
+        print("%-16s %10d %10d %8.1fx" % (
+            kind, vm_size, native_size, vm_size / float(native_size),
+        ))
+    sys.exit(0)
+
+benchmarks = all_benchmarks()
+if args.names:
+    unknown = set(args.names) - set(bench.name for bench in benchmarks)
+    if unknown:
+        parser.error("Unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+    benchmarks = [bench for bench in benchmarks if bench.name in args.names]
+
+old = None
+if args.compare:
+    with open(args.compare) as f:
+        old = json.load(f)['benchmarks']
+
+print(
+    "%-16s %10s %10s %10s %9s %12s %7s" % (
+        "benchmark", "native", "warmup", "steady", "slowdown", "instr/s",
+        "warmup",
+    ),
+    end="",
+)
+print("  %8s" % "vs old" if old else "")
+
+
+def report(name, result):
+    print(
+        "%-16s %9.4fs %9.4fs %9.4fs %8.1fx %12.0f %6.2fx" % (
+            name, result['native_time'], result['warmup_time'],
+            result['steady_time'], result['slowdown'],
+            result['instructions_per_second'], result['warmup_ratio'],
+        ),
+        end="",
+    )
+    if old and name in old:
+        print("  %7.2fx" % (result['steady_time'] / old[name]['steady_time']))
+    else:
+        print("")
+    sys.stdout.flush()
+
+
+results = run_benchmarks(
+    benchmarks, args.engine, args.repeat, report, optimize=args.optimize,
+    transpile_after=args.transpile_after,
+)
+if args.json_file:
+    with open(args.json_file, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
@@ -0,0 +1,450 @@
+"""Macrobenchmarks: small whole programs, after the pyperformance ones."""
+
+import textwrap
+
+from . import Benchmark
+
+
+def macro(name, n, source):
+    return Benchmark(name, 'macro', n, textwrap.dedent(source))
+
+
+BENCHMARKS = [
+    # The n-body simulation of the Jovian planets.
+    macro('nbody', 50, """\
+        PI = 3.14159265358979323
+        SOLAR_MASS = 4 * PI * PI
+        DAYS_PER_YEAR = 365.24
+
+        def make_bodies():
+            return [
+                # The sun.
+                [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0], SOLAR_MASS],
+                # Jupiter.
+                [[4.84143144246472090e+00, -1.16032004402742839e+00,
+                  -1.03622044471123109e-01],
+                 [1.66007664274403694e-03 * DAYS_PER_YEAR,
+                  7.69901118419740425e-03 * DAYS_PER_YEAR,
+                  -6.90460016972063023e-05 * DAYS_PER_YEAR],
+                 9.54791938424326609e-04 * SOLAR_MASS],
+                # Saturn.
+                [[8.34336671824457987e+00, 4.12479856412430479e+00,
+                  -4.03523417114321381e-01],
+                 [-2.76742510726862411e-03 * DAYS_PER_YEAR,
+                  4.99852801234917238e-03 * DAYS_PER_YEAR,
+                  2.30417297573763929e-05 * DAYS_PER_YEAR],
+                 2.85885980666130812e-04 * SOLAR_MASS],
+                # Uranus.
+                [[1.28943695621391310e+01, -1.51111514016986312e+01,
+                  -2.23307578892655734e-01],
+                 [2.96460137564761618e-03 * DAYS_PER_YEAR,
+                  2.37847173959480950e-03 * DAYS_PER_YEAR,
+                  -2.96589568540237556e-05 * DAYS_PER_YEAR],
+                 4.36624404335156298e-05 * SOLAR_MASS],
+                # Neptune.
+                [[1.53796971148509165e+01, -2.59193146099879641e+01,
+                  1.79258772950371181e-01],
+                 [2.68067772490389322e-03 * DAYS_PER_YEAR,
+                  1.62824170038242295e-03 * DAYS_PER_YEAR,
+                  -9.51592254519715870e-05 * DAYS_PER_YEAR],
+                 5.15138902046611451e-05 * SOLAR_MASS],
+            ]
+
+        def pairs(bodies):
+            result = []
+            for i in range(len(bodies)):
+                for j in range(i + 1, len(bodies)):
+                    result.append((bodies[i], bodies[j]))
+            return result
+
+        def advance(dt, bodies, body_pairs):
+            for ((r1, v1, m1), (r2, v2, m2)) in body_pairs:
+                dx = r1[0] - r2[0]
+                dy = r1[1] - r2[1]
+                dz = r1[2] - r2[2]
+                mag = dt * ((dx * dx + dy * dy + dz * dz) ** -1.5)
+                b1m = m1 * mag
+                b2m = m2 * mag
+                v1[0] -= dx * b2m
+                v1[1] -= dy * b2m
+                v1[2] -= dz * b2m
+                v2[0] += dx * b1m
+                v2[1] += dy * b1m
+                v2[2] += dz * b1m
+            for (r, (vx, vy, vz), m) in bodies:
+                r[0] += dt * vx
+                r[1] += dt * vy
+                r[2] += dt * vz
+
+        def energy(bodies, body_pairs):
+            e = 0.0
+            for ((x1, y1, z1), v1, m1), ((x2, y2, z2), v2, m2) in body_pairs:
+                dx = x1 - x2
+                dy = y1 - y2
+                dz = z1 - z2
+                e -= (m1 * m2) / ((dx * dx + dy * dy + dz * dz) ** 0.5)
+            for (r, (vx, vy, vz), m) in bodies:
+                e += m * (vx * vx + vy * vy + vz * vz) / 2.0
+            return e
+
+        def offset_momentum(bodies):
+            px = py = pz = 0.0
+            for (r, (vx, vy, vz), m) in bodies:
+                px -= vx * m
+                py -= vy * m
+                pz -= vz * m
+            v = bodies[0][1]
+            v[0] = px / SOLAR_MASS
+            v[1] = py / SOLAR_MASS
+            v[2] = pz / SOLAR_MASS
+
+        def main(n):
+            bodies = make_bodies()
+            body_pairs = pairs(bodies)
+            offset_momentum(bodies)
+            before = energy(bodies, body_pairs)
+            for _ in range(n):
+                advance(0.01, bodies, body_pairs)
+            return round(before, 9), round(energy(bodies, body_pairs), 9)
+        """),
+
+    # The Richards operating system scheduler simulation.
+    macro('richards', 100, """\
+        I_IDLE = 0
+        I_WORK = 1
+        I_HANDLERA = 2
+        I_HANDLERB = 3
+        I_DEVA = 4
+        I_DEVB = 5
+
+        K_DEV = 1000
+        K_WORK = 1001
+
+        BUFSIZE = 4
+
+        class Packet(object):
+            def __init__(self, link, ident, kind):
+                self.link = link
+                self.ident = ident
+                self.kind = kind
+                self.datum = 0
+                self.data = [0] * BUFSIZE
+
+            def append_to(self, lst):
+                self.link = None
+                if lst is None:
+                    return self
+                p = lst
+                while p.link is not None:
+                    p = p.link
+                p.link = self
+                return lst
+
+        class TaskState(object):
+            def __init__(self):
+                self.packet_pending = True
+                self.task_waiting = False
+                self.task_holding = False
+
+            def packet_pending_state(self):
+                self.packet_pending = True
+                self.task_waiting = False
+                self.task_holding = False
+                return self
+
+            def waiting(self):
+                self.packet_pending = False
+                self.task_waiting = True
+                self.task_holding = False
+                return self
+
+            def running(self):
+                self.packet_pending = False
+                self.task_waiting = False
+                self.task_holding = False
+                return self
+
+            def waiting_with_packet(self):
+                self.packet_pending = True
+                self.task_waiting = True
+                self.task_holding = False
+                return self
+
+            def is_held_or_suspended(self):
+                return self.task_holding or (
+                    not self.packet_pending and self.task_waiting
+                )
+
+            def is_waiting_with_packet(self):
+                return (
+                    self.packet_pending and self.task_waiting and
+                    not self.task_holding
+                )
+
+        class Scheduler(object):
+            def __init__(self):
+                self.tasks = [None] * 10
+                self.task_list = None
+                self.current = None
+                self.current_id = 0
+                self.hold_count = 0
+                self.qpkt_count = 0
+
+            def find(self, ident):
+                t = self.tasks[ident]
+                if t is None:
+                    raise Exception("Bad task id %r" % ident)
+                return t
+
+            def schedule(self):
+                self.current = self.task_list
+                while self.current is not None:
+                    t = self.current
+                    if t.is_held_or_suspended():
+                        self.current = t.link
+                    else:
+                        self.current_id = t.ident
+                        self.current = t.run_task()
+
+        class Task(TaskState):
+            def __init__(self, sched, ident, priority, wkq, state):
+                TaskState.__init__(self)
+                self.sched = sched
+                self.link = sched.task_list
+                self.ident = ident
+                self.priority = priority
+                self.wkq = wkq
+                self.packet_pending = state.packet_pending
+                self.task_waiting = state.task_waiting
+                self.task_holding = state.task_holding
+                sched.task_list = self
+                sched.tasks[ident] = self
+
+            def add_packet(self, p, old):
+                if self.wkq is None:
+                    self.wkq = p
+                    self.packet_pending = True
+                    if self.priority > old.priority:
+                        return self
+                else:
+                    p.append_to(self.wkq)
+                return old
+
+            def run_task(self):
+                if self.is_waiting_with_packet():
+                    msg = self.wkq
+                    self.wkq = msg.link
+                    if self.wkq is None:
+                        self.running()
+                    else:
+                        self.packet_pending_state()
+                else:
+                    msg = None
+                return self.fn(msg)
+
+            def wait_task(self):
+                self.task_waiting = True
+                return self
+
+            def hold(self):
+                self.sched.hold_count += 1
+                self.task_holding = True
+                return self.link
+
+            def release(self, ident):
+                t = self.sched.find(ident)
+                t.task_holding = False
+                if t.priority > self.priority:
+                    return t
+                return self
+
+            def qpkt(self, pkt):
+                t = self.sched.find(pkt.ident)
+                self.sched.qpkt_count += 1
+                pkt.link = None
+                pkt.ident = self.sched.current_id
+                return t.add_packet(pkt, self)
+
+        class DeviceTask(Task):
+            def __init__(self, sched, ident, priority, wkq, state):
+                Task.__init__(self, sched, ident, priority, wkq, state)
+                self.pending = None
+
+            def fn(self, pkt):
+                if pkt is None:
+                    pkt = self.pending
+                    if pkt is None:
+                        return self.wait_task()
+                    self.pending = None
+                    return self.qpkt(pkt)
+                self.pending = pkt
+                return self.hold()
+
+        class HandlerTask(Task):
+            def __init__(self, sched, ident, priority, wkq, state):
+                Task.__init__(self, sched, ident, priority, wkq, state)
+                self.work_in = None
+                self.device_in = None
+
+            def fn(self, pkt):
+                if pkt is not None:
+                    if pkt.kind == K_WORK:
+                        self.work_in = pkt.append_to(self.work_in)
+                    else:
+                        self.device_in = pkt.append_to(self.device_in)
+                work = self.work_in
+                if work is None:
+                    return self.wait_task()
+                count = work.datum
+                if count >= BUFSIZE:
+                    self.work_in = work.link
+                    return self.qpkt(work)
+                dev = self.device_in
+                if dev is None:
+                    return self.wait_task()
+                self.device_in = dev.link
+                dev.datum = work.data[count]
+                work.datum = count + 1
+                return self.qpkt(dev)
+
+        class IdleTask(Task):
+            def __init__(self, sched, ident, priority, wkq, state, count):
+                Task.__init__(self, sched, ident, priority, wkq, state)
+                self.control = 1
+                self.count = count
+
+            def fn(self, pkt):
+                self.count -= 1
+                if self.count == 0:
+                    return self.hold()
+                if self.control & 1 == 0:
+                    self.control = self.control // 2
+                    return self.release(I_DEVA)
+                self.control = self.control // 2 ^ 0xd008
+                return self.release(I_DEVB)
+
+        class WorkTask(Task):
+            def __init__(self, sched, ident, priority, wkq, state):
+                Task.__init__(self, sched, ident, priority, wkq, state)
+                self.destination = I_HANDLERA
+                self.count = 0
+
+            def fn(self, pkt):
+                if pkt is None:
+                    return self.wait_task()
+                if self.destination == I_HANDLERA:
+                    dest = I_HANDLERB
+                else:
+                    dest = I_HANDLERA
+                self.destination = dest
+                pkt.ident = dest
+                pkt.datum = 0
+                for i in range(BUFSIZE):
+                    self.count += 1
+                    if self.count > 26:
+                        self.count = 1
+                    pkt.data[i] = ord("A") + self.count - 1
+                return self.qpkt(pkt)
+
+        def run(count):
+            sched = Scheduler()
+            IdleTask(
+                sched, I_IDLE, 1, None, TaskState().running(), count,
+            )
+
+            wkq = Packet(None, 0, K_WORK)
+            wkq = Packet(wkq, 0, K_WORK)
+            WorkTask(
+                sched, I_WORK, 1000, wkq, TaskState().waiting_with_packet(),
+            )
+
+            wkq = Packet(None, I_DEVA, K_DEV)
+            wkq = Packet(wkq, I_DEVA, K_DEV)
+            wkq = Packet(wkq, I_DEVA, K_DEV)
+            HandlerTask(
+                sched, I_HANDLERA, 2000, wkq,
+                TaskState().waiting_with_packet(),
+            )
+
+            wkq = Packet(None, I_DEVB, K_DEV)
+            wkq = Packet(wkq, I_DEVB, K_DEV)
+            wkq = Packet(wkq, I_DEVB, K_DEV)
+            HandlerTask(
+                sched, I_HANDLERB, 3000, wkq,
+                TaskState().waiting_with_packet(),
+            )
+
+            DeviceTask(sched, I_DEVA, 4000, None, TaskState().waiting())
+            DeviceTask(sched, I_DEVB, 5000, None, TaskState().waiting())
+
+            sched.schedule()
+            return sched.qpkt_count, sched.hold_count
+
+        def main(n):
+            return run(n)
+        """),
+
+    # The chaos game: points jumping towards the corners of a shape.
+    macro('chaos', 1500, """\
+        class Point(object):
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+
+            def towards(self, other, ratio):
+                return Point(
+                    self.x + (other.x - self.x) * ratio,
+                    self.y + (other.y - self.y) * ratio,
+                )
+
+        class Random(object):
+            # A linear congruential generator, so the VM runs all the work.
+            def __init__(self, seed):
+                self.state = seed
+
+            def below(self, limit):
+                self.state = (self.state * 1103515245 + 12345) & 0x7FFFFFFF
+                return self.state % limit
+
+        def main(n):
+            corners = [
+                Point(0.0, 0.0), Point(1.0, 0.0), Point(1.0, 1.0),
+                Point(0.0, 1.0), Point(0.5, 0.5),
+            ]
+            rand = Random(1234)
+            p = Point(0.25, 0.75)
+            grid = {}
+            for _ in range(n):
+                p = p.towards(corners[rand.below(len(corners))], 2.0 / 3)
+                cell = (int(p.x * 16), int(p.y * 16))
+                grid[cell] = grid.get(cell, 0) + 1
+            return len(grid), max(grid.values())
+        """),
+
+    # Making structures, and round-tripping them through JSON.
+    macro('json', 50, """\
+        import json
+
+        def make_record(i):
+            return {
+                'id': i,
+                'name': 'record %d' % i,
+                'tags': ['tag%d' % (i % 7), 'tag%d' % (i % 3)],
+                'score': i * 1.5,
+                'active': i % 2 == 0,
+                'children': [{'id': j, 'parent': i} for j in range(3)],
+            }
+
+        def main(n):
+            total = 0
+            for i in range(n):
+                records = [make_record(i * 10 + j) for j in range(10)]
+                text = json.dumps(records, sort_keys=True)
+                back = json.loads(text)
+                for record in back:
+                    total += record['id'] + len(record['children'])
+                    if record['active']:
+                        total += 1
+            return total
+        """),
+]
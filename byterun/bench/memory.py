@@ -0,0 +1,133 @@
+"""Measuring how much memory Byterun's runtime objects take.
+
+Frames, closures and generators are measured as the bytes of the object
+itself, its __dict__ if it has one, and the containers only it uses, like a
+frame's value stack.  The objects they refer to that belong to the program,
+like the values in a frame's locals, aren't counted.  The same things in the
+real interpreter are measured the same way, to compare.
+
+"""
+
+import sys
+import textwrap
+
+import six
+from six.moves import builtins
+
+from byterun.pyobj import Cell, Frame, Function, Generator
+from byterun.pyvm2 import VirtualMachine
+
+# The containers each kind of object owns, by attribute name.
+OWNED = {
+    Frame: ['stack', 'block_stack', 'fastlocals', 'cells', '_locals_dict'],
+    Function: ['func_closure', 'func_defaults'],
+    Generator: [],
+    Cell: [],
+}
+
+SOURCE = textwrap.dedent("""\
+    def recurse(n):
+        if n:
+            return recurse(n - 1)
+        return probe()
+
+    def make_closure(x, y):
+        def closure():
+            return x + y
+        return closure
+
+    def generate(n):
+        for i in range(n):
+            yield i
+
+    def main(depth):
+        frames = recurse(depth)
+        closure = make_closure(1, 2)
+        gen = generate(3)
+        next(gen)
+        return frames, closure, gen
+    """)
+
+
+def size_of(obj):
+    """The bytes `obj` takes, with its __dict__ and the containers it owns."""
+    size = sys.getsizeof(obj)
+    if not hasattr(type(obj), '__slots__'):
+        # Slotted classes with a __dict__ slot make it when it's first used,
+        # so asking for it would make it.
+        size += sys.getsizeof(obj.__dict__)
+    for name in OWNED.get(type(obj), ()):
+        try:
+            part = object.__getattribute__(obj, name)
+        except AttributeError:
+            continue
+        if part is not None:
+            size += sys.getsizeof(part)
+    if isinstance(obj, Function) and obj.func_closure:
+        size += sum(size_of(cell) for cell in obj.func_closure)
+    elif isinstance(obj, Generator):
+        size += size_of(obj.gi_frame)
+    return size
+
+
+def native_size_of(obj):
+    """The bytes a real frame, function or generator takes, as size_of."""
+    size = sys.getsizeof(obj)
+    closure = getattr(obj, '__closure__', None)
+    if closure:
+        size += sys.getsizeof(closure)
+        size += sum(sys.getsizeof(cell) for cell in closure)
+    defaults = getattr(obj, '__defaults__', None)
+    if defaults is not None:
+        size += sys.getsizeof(defaults)
+    frame = getattr(obj, 'gi_frame', None)
+    if frame is not None:
+        size += sys.getsizeof(frame)
+    return size
+
+
+def run_source(vm=None, depth=50):
+    """Run the program, returning its frames, closure and generator."""
+    frames = []
+    if vm is None:
+        def probe():
+            frame = sys._getframe(1)
+            while frame.f_code.co_name == 'recurse':
+                frames.append(frame)
+                frame = frame.f_back
+            return frames
+    else:
+        def probe():
+            frames.extend(
+                frame for frame in vm.frames
+                if frame.f_code.co_name == 'recurse'
+            )
+            return frames
+    env = {
+        '__builtins__': builtins, '__name__': '__memory__', 'probe': probe,
+    }
+    code = compile(SOURCE, "<memory>", "exec")
+    if vm is None:
+        six.exec_(code, env)
+    else:
+        vm.run_code(code, f_globals=env)
+    return env['main'](depth)
+
+
+def measure_memory(engine='dispatch', depth=50):
+    """Measure the bytes per frame, closure and generator, in the VM and not.
+
+    Returns a dict mapping 'frame', 'closure' and 'generator' to a pair of
+    the bytes in the VM and the bytes natively.
+
+    """
+    results = {}
+    for vm in [VirtualMachine(engine=engine), None]:
+        sizer = native_size_of if vm is None else size_of
+        frames, closure, gen = run_source(vm, depth)
+        results.setdefault('frame', []).append(
+            sum(sizer(frame) for frame in frames) // len(frames)
+        )
+        results.setdefault('closure', []).append(sizer(closure))
+        results.setdefault('generator', []).append(sizer(gen))
+    return dict((kind, tuple(sizes)) for kind, sizes in results.items())
@@ -0,0 +1,156 @@
+"""Microbenchmarks: one kind of operation each, in a loop."""
+
+import textwrap
+
+from . import Benchmark
+
+
+def micro(name, n, source):
+    return Benchmark(name, 'micro', n, textwrap.dedent(source))
+
+
+BENCHMARKS = [
+    micro('arithmetic', 5000, """\
+        def main(n):
+            total = 0
+            x = 1.5
+            for i in range(n):
+                total = (total + i * 3 - (i % 7)) & 0xFFFFFF
+                x = x * 0.5 + i / 3.0
+            return total, round(x, 3)
+        """),
+
+    micro('attributes', 3000, """\
+        class Point(object):
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+
+        def main(n):
+            p = Point(1, 2)
+            total = 0
+            for i in range(n):
+                p.x = p.y + i
+                p.y = p.x - 1
+                total += p.x + p.y
+            return total
+        """),
+
+    micro('calls', 2000, """\
+        def add(a, b):
+            return a + b
+
+        def with_defaults(a, b=2, c=3):
+            return a + b + c
+
+        def with_star(*args, **kwargs):
+            return len(args) + len(kwargs)
+
+        class Counter(object):
+            def __init__(self):
+                self.count = 0
+            def bump(self, by):
+                self.count += by
+
+        def main(n):
+            counter = Counter()
+            total = 0
+            for i in range(n):
+                total += add(i, 1)
+                total += with_defaults(i, c=4)
+                total += with_star(i, i, key=i)
+                counter.bump(2)
+            return total, counter.count
+        """),
+
+    micro('closures', 3000, """\
+        def make_adder(x):
+            def add(y):
+                return x + y
+            return add
+
+        def make_counter():
+            count = [0]
+            def bump():
+                count[0] += 1
+                return count[0]
+            return bump
+
+        def main(n):
+            bump = make_counter()
+            total = 0
+            for i in range(n):
+                total += make_adder(i)(1) + bump()
+            return total
+        """),
+
+    micro('generators', 5000, """\
+        def numbers(n):
+            for i in range(n):
+                yield i
+
+        def evens(source):
+            for x in source:
+                if x % 2 == 0:
+                    yield x
+
+        def main(n):
+            total = 0
+            for x in evens(numbers(n)):
+                total += x
+            total += sum(x * x for x in range(n // 10))
+            return total
+        """),
+
+    micro('exceptions', 2000, """\
+        class Oops(Exception):
+            pass
+
+        def fail(i):
+            raise Oops(i)
+
+        def main(n):
+            caught = 0
+            for i in range(n):
+                try:
+                    fail(i)
+                except Oops:
+                    caught += 1
+                try:
+                    pass
+                finally:
+                    caught += 1
+            return caught
+        """),
+
+    micro('comprehensions', 200, """\
+        def main(n):
+            total = 0
+            for i in range(n):
+                squares = [x * x for x in range(20)]
+                evens = {x for x in squares if x % 2 == 0}
+                index = {x: str(x) for x in squares}
+                total += sum(x for x in evens)
+                total += len(squares) + len(evens) + len(index)
+            return total
+        """),
+
+    micro('with', 2000, """\
+        class Manager(object):
+            def __init__(self):
+                self.entered = 0
+            def __enter__(self):
+                self.entered += 1
+                return self
+            def __exit__(self, *exc_info):
+                return False
+
+        def main(n):
+            manager = Manager()
+            total = 0
+            for i in range(n):
+                with manager as m:
+                    total += m.entered
+            return total
+        """),
+]
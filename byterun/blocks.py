@@ -0,0 +1,284 @@
+"""Finding the block stack of each instruction before running, for Byterun.
+
+Python 2 bytecode pushes a block onto the frame's block stack for each
+loop, try statement and with statement it enters, and pops it again when it
+leaves, but which blocks are on the stack at an instruction never depends on
+how the instruction was reached.  So the block stacks can be worked out once
+from the instructions, into a table indexed by offset.  Frames whose code has
+a table don't push or pop blocks at all: the VM only looks in the table when
+something has to unwind the blocks.
+
+The table is indexed by the offset execution would go on at, which is what
+f_lasti is when a handler returns a why.  The block stack there is that of
+the instruction before, except after SETUP_WITH, whose block isn't set up if
+__enter__ fails.
+
+Each block records the stack level to unwind to, so the depth of the value
+stack at each instruction is worked out too.  In a finally clause the depth
+depends on how it was entered, so code with blocks inside finally clauses
+doesn't get a table.  Neither does Python 3 code, whose exception handlers
+push blocks of their own.
+
+"""
+
+import collections
+import dis
+
+import six
+
+Block = collections.namedtuple("Block", "type, handler, level")
+
+# Why execution can't go on at the next instruction, as handlers return it.
+# Handlers return None almost always, so the engines test only the truth of
+# what they return, and these are all true.  A why pushed onto the value
+# stack for a finally clause is told from the None or exception class that
+# can be there instead by being an int.
+WHY_EXCEPTION = 1
+WHY_RERAISE = 2
+WHY_RETURN = 3
+WHY_BREAK = 4
+WHY_CONTINUE = 5
+WHY_YIELD = 6
+WHY_SILENCED = 7
+
+
+def _opcode(name):
+    return dis.opmap.get(name, -1)
+
+SETUP_LOOP = _opcode('SETUP_LOOP')
+SETUP_EXCEPT = _opcode('SETUP_EXCEPT')
+SETUP_FINALLY = _opcode('SETUP_FINALLY')
+SETUP_WITH = _opcode('SETUP_WITH')
+POP_BLOCK = _opcode('POP_BLOCK')
+END_FINALLY = _opcode('END_FINALLY')
+FOR_ITER = _opcode('FOR_ITER')
+
+# The opcodes that push or pop blocks, other than SETUP_WITH, which also
+# calls __enter__.  Frames with a block table can skip them.
+BLOCK_OPCODES = set([SETUP_LOOP, SETUP_EXCEPT, SETUP_FINALLY, POP_BLOCK])
+
+UNCONDITIONAL_JUMPS = set([_opcode('JUMP_ABSOLUTE'), _opcode('JUMP_FORWARD')])
+
+# Opcodes that never go on to the next instruction.
+NO_FALL_THROUGH = set(_opcode(name) for name in [
+    'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'BREAK_LOOP', 'CONTINUE_LOOP',
+    'RETURN_VALUE', 'RAISE_VARARGS',
+])
+
+# Jumps whose target is reached with the stack as it is after the jump,
+# and the change in depth from taking them.
+JUMP_EFFECTS = {
+    _opcode('JUMP_ABSOLUTE'): 0,
+    _opcode('JUMP_FORWARD'): 0,
+    _opcode('POP_JUMP_IF_FALSE'): -1,
+    _opcode('POP_JUMP_IF_TRUE'): -1,
+    _opcode('JUMP_IF_FALSE_OR_POP'): 0,
+    _opcode('JUMP_IF_TRUE_OR_POP'): 0,
+    FOR_ITER: -1,
+}
+
+# How much each Python 2 opcode with a fixed effect changes the depth of
+# the value stack by, when it goes on to the next instruction.
+STACK_EFFECTS = {
+    'STOP_CODE': 0, 'NOP': 0, 'POP_TOP': -1, 'ROT_TWO': 0, 'ROT_THREE': 0,
+    'ROT_FOUR': 0, 'DUP_TOP': 1, 'LIST_APPEND': -1, 'SET_ADD': -1,
+    'MAP_ADD': -2, 'SLICE+0': 0, 'SLICE+1': -1, 'SLICE+2': -1,
+    'SLICE+3': -2, 'STORE_SLICE+0': -2, 'STORE_SLICE+1': -3,
+    'STORE_SLICE+2': -3, 'STORE_SLICE+3': -4, 'DELETE_SLICE+0': -1,
+    'DELETE_SLICE+1': -2, 'DELETE_SLICE+2': -2, 'DELETE_SLICE+3': -3,
+    'STORE_SUBSCR': -3, 'DELETE_SUBSCR': -2, 'STORE_MAP': -2,
+    'PRINT_EXPR': -1, 'PRINT_ITEM': -1, 'PRINT_ITEM_TO': -2,
+    'PRINT_NEWLINE': 0, 'PRINT_NEWLINE_TO': -1, 'LOAD_LOCALS': 1,
+    'IMPORT_STAR': -1, 'EXEC_STMT': -3, 'YIELD_VALUE': 0, 'BUILD_CLASS': -2,
+    'WITH_CLEANUP': -1, 'STORE_NAME': -1, 'DELETE_NAME': 0,
+    'STORE_ATTR': -2, 'DELETE_ATTR': -1, 'STORE_GLOBAL': -1,
+    'DELETE_GLOBAL': 0, 'LOAD_CONST': 1, 'LOAD_NAME': 1, 'BUILD_MAP': 1,
+    'LOAD_ATTR': 0, 'COMPARE_OP': -1, 'IMPORT_NAME': -1, 'IMPORT_FROM': 1,
+    'LOAD_GLOBAL': 1, 'LOAD_FAST': 1, 'STORE_FAST': -1, 'DELETE_FAST': 0,
+    'LOAD_CLOSURE': 1, 'LOAD_DEREF': 1, 'STORE_DEREF': -1, 'GET_ITER': 0,
+    'POP_JUMP_IF_FALSE': -1, 'POP_JUMP_IF_TRUE': -1,
+    'JUMP_IF_FALSE_OR_POP': -1, 'JUMP_IF_TRUE_OR_POP': -1, 'FOR_ITER': 1,
+}
+STACK_EFFECTS = dict(
+    (dis.opmap[name], effect) for name, effect in STACK_EFFECTS.items()
+    if name in dis.opmap
+)
+# Unary operators replace the top of the stack, binary ones the top two.
+STACK_EFFECTS.update(
+    (op, 0 if name.startswith('UNARY_') else -1)
+    for name, op in dis.opmap.items()
+    if name.startswith(('UNARY_', 'BINARY_', 'INPLACE_'))
+)
+
+# How much opcodes whose effect depends on their argument change the depth.
+ARG_STACK_EFFECTS = {
+    'UNPACK_SEQUENCE': lambda arg: arg - 1,
+    'DUP_TOPX': lambda arg: arg,
+    'BUILD_TUPLE': lambda arg: 1 - arg,
+    'BUILD_LIST': lambda arg: 1 - arg,
+    'BUILD_SET': lambda arg: 1 - arg,
+    'MAKE_FUNCTION': lambda arg: -arg,
+    'MAKE_CLOSURE': lambda arg: -arg - 1,
+    'BUILD_SLICE': lambda arg: -2 if arg == 3 else -1,
+    'CALL_FUNCTION': lambda arg: -(arg & 0xFF) - 2 * (arg >> 8),
+    'CALL_FUNCTION_VAR': lambda arg: -(arg & 0xFF) - 2 * (arg >> 8) - 1,
+    'CALL_FUNCTION_KW': lambda arg: -(arg & 0xFF) - 2 * (arg >> 8) - 1,
+    'CALL_FUNCTION_VAR_KW': lambda arg: -(arg & 0xFF) - 2 * (arg >> 8) - 2,
+}
+ARG_STACK_EFFECTS = dict(
+    (dis.opmap[name], effect) for name, effect in ARG_STACK_EFFECTS.items()
+    if name in dis.opmap
+)
+
+
+class Unknown(Exception):
+    """The block stacks of some code can't be known before running it."""
+
+
+def block_table(instructions):
+    """Make the block table for `instructions`, from decode_instructions.
+
+    Returns a list, indexed by the offset execution goes on at, of tuples of
+    Blocks: the frame's block stack, innermost last.  Returns None if the
+    block stacks can't be known before running the code.
+
+    """
+    if six.PY3:
+        return None
+    try:
+        states = block_states(instructions)
+    except Unknown:
+        return None
+
+    table = [None] * (len(instructions) + 1)
+    blocks = ()
+    for offset, instr in enumerate(instructions):
+        state = states.get(offset)
+        if state is None:
+            # In the middle of an instruction, or never run: nothing goes on
+            # here, except after an instruction that doesn't fall through.
+            table[offset] = blocks
+            continue
+        if table[offset] is None:
+            table[offset] = state[1]
+        blocks = state[1]
+        next_offset = instr.next
+        if instr.opcode == SETUP_WITH:
+            # If __enter__ fails, there's no block to unwind.
+            table[next_offset] = blocks
+        elif instr.opcode not in BLOCK_OPCODES and (
+            instr.opcode not in UNCONDITIONAL_JUMPS
+        ):
+            # Jumps never unwind, so it doesn't matter where they'd go on.
+            after = states.get(next_offset)
+            if after is not None and after[1] != blocks:
+                # Only possible after an instruction that doesn't fall
+                # through: which block stack is right depends on which one
+                # ran.
+                return None
+    table[-1] = blocks
+    return table
+
+
+def block_states(instructions):
+    """Work out the state of the stacks before each instruction that can run.
+
+    Returns a dict mapping offsets to (depth, blocks, handlers): the depth of
+    the value stack, the tuple of Blocks on the block stack, and a tuple of
+    the handlers the instruction is in, as (type, level) pairs.  A handler
+    is 'except' while the exception it caught is on the stack, or 'finally'
+    from the start of a finally clause to its END_FINALLY.  Raises Unknown
+    if the states can't be known.
+
+    """
+    # Finally clauses can be reached by falling into them, as well as by
+    # unwinding, so they are known by their offsets.
+    finally_starts = set(
+        instr.arguments[0] for instr in instructions
+        if instr is not None and instr.opcode in (SETUP_FINALLY, SETUP_WITH)
+    )
+    states = {}
+    todo = []
+
+    def reach(offset, depth, blocks, handlers):
+        if offset in finally_starts:
+            handlers += (('finally', depth - 1),)
+        state = (depth, blocks, handlers)
+        known = states.get(offset)
+        if known is None:
+            states[offset] = state
+            todo.append(offset)
+        elif known != state:
+            raise Unknown()
+
+    reach(0, 0, (), ())
+    while todo:
+        offset = todo.pop()
+        depth, blocks, handlers = states[offset]
+        opcode, arguments, next_offset = instructions[offset]
+
+        if opcode in (SETUP_LOOP, SETUP_EXCEPT, SETUP_FINALLY, SETUP_WITH):
+            if any(kind == 'finally' for kind, _ in handlers):
+                raise Unknown()
+            handler = arguments[0]
+            if opcode == SETUP_LOOP:
+                block = Block('loop', handler, depth)
+                reach(handler, depth, blocks, handlers)
+            elif opcode == SETUP_EXCEPT:
+                block = Block('setup-except', handler, depth)
+                reach(
+                    handler, depth + 3, blocks,
+                    handlers + (('except', depth),),
+                )
+            elif opcode == SETUP_FINALLY:
+                block = Block('finally', handler, depth)
+                reach(handler, depth + 1, blocks, handlers)
+            else:
+                # The context manager is replaced by its __exit__, and the
+                # result of __enter__ is pushed after the block.
+                block = Block('with', handler, depth)
+                reach(handler, depth + 1, blocks, handlers)
+                depth += 1
+            reach(next_offset, depth, blocks + (block,), handlers)
+            continue
+
+        if opcode == POP_BLOCK:
+            if not blocks:
+                raise Unknown()
+            reach(next_offset, depth, blocks[:-1], handlers)
+            continue
+
+        if opcode == END_FINALLY:
+            if handlers and handlers[-1] == ('except', depth - 3):
+                # The exception is re-raised.
+                continue
+            if not handlers or handlers[-1][0] != 'finally':
+                raise Unknown()
+            reach(next_offset, depth - 1, blocks, handlers[:-1])
+            continue
+
+        if opcode in JUMP_EFFECTS:
+            jump_depth = depth + JUMP_EFFECTS[opcode]
+            reach(
+                arguments[0], jump_depth, blocks,
+                live_handlers(handlers, jump_depth),
+            )
+        if opcode in NO_FALL_THROUGH:
+            continue
+        if opcode in STACK_EFFECTS:
+            depth += STACK_EFFECTS[opcode]
+        elif opcode in ARG_STACK_EFFECTS:
+            depth += ARG_STACK_EFFECTS[opcode](arguments[0])
+        else:
+            raise Unknown()
+        reach(next_offset, depth, blocks, live_handlers(handlers, depth))
+    return states
+
+
+def live_handlers(handlers, depth):
+    """Drop the 'except' handlers whose exception is no longer on the stack."""
+    while handlers and handlers[-1][0] == 'except' and (
+        depth < handlers[-1][1] + 3
+    ):
+        handlers = handlers[:-1]
+    return handlers
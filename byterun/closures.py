@@ -0,0 +1,587 @@
+"""Compiling decoded instructions to Python closures, for Byterun.
+
+The 'closure' engine runs code compiled into basic blocks of closures, one
+closure per instruction, with the instruction's arguments captured when it
+was made.  Running a block is just calling its closures in turn: nothing is
+decoded or dispatched.
+
+Most closures are ops, which are called with the VM, the frame, the frame's
+stack, the stack top and the frame's fast locals, and return the new stack
+top.  Ops never jump, return a why, or need frame.stacktop to be right.
+Each block ends with a terminator instead, which is called with the same
+arguments, but with frame.stacktop and frame.f_lasti up to date.  Like an
+opcode handler, a terminator leaves them up to date in turn, and returns
+the why, if any.
+
+Unconditional jumps are compiled away: a block continues wherever they go.
+Blocks are compiled when they are first run, so any offset can start one,
+and code that is never run is never compiled.
+
+"""
+
+from six.moves import builtins
+
+from .blocks import BLOCK_OPCODES, WHY_RETURN
+from .decode import UNCACHED, method_is_current, opmap
+from .pyobj import Method, UNBOUND, unbound_cell_error, unbound_local_error
+
+# Handlers that can jump or return a why.  Instructions that use them end
+# blocks.
+CONTROL_OPCODES = set(opmap[name] for name in [
+    'JUMP_FORWARD', 'JUMP_ABSOLUTE', 'JUMP_IF_TRUE', 'JUMP_IF_FALSE',
+    'POP_JUMP_IF_TRUE', 'POP_JUMP_IF_FALSE', 'JUMP_IF_TRUE_OR_POP',
+    'JUMP_IF_FALSE_OR_POP', 'FOR_ITER', 'BREAK_LOOP', 'CONTINUE_LOOP',
+    'END_FINALLY', 'RAISE_VARARGS', 'RETURN_VALUE', 'YIELD_VALUE',
+    'YIELD_FROM',
+] if name in opmap)
+
+# The unconditional jumps, which blocks follow.
+JUMPS = set([opmap['JUMP_ABSOLUTE'], opmap['JUMP_FORWARD']])
+
+COMPARE_OP = opmap['COMPARE_OP']
+
+
+class ClosureCode(object):
+    """The blocks of closures for some instructions, run by one VM class.
+
+    `blocks` is indexed by offset, like the instructions: the block starting
+    at an offset, or None if it hasn't been compiled yet.  A block is a
+    tuple of the ops, the terminator, the offset to set f_lasti to before
+    calling the terminator, and the offsets to set it to if each op raises
+    an exception.
+
+    With `skip_blocks`, the instructions that push and pop blocks are left
+    out, for frames that use a block table.
+
+    """
+    def __init__(self, vm_class, instructions, skip_blocks=False):
+        self.instructions = instructions
+        self.skip_blocks = skip_blocks
+        self.functions = vm_class.dispatch_functions()
+        self.op_makers, self.terminator_makers = vm_class.closure_tables()
+        self.blocks = [None] * len(instructions)
+
+    def block(self, offset):
+        """Compile and return the block starting at `offset`."""
+        start = offset
+        instructions = self.instructions
+        ops = []
+        nexts = []
+        seen = set()
+        while True:
+            if offset in seen:
+                # Back where the block has already been: jump there.
+                terminator, terminator_next = goto, offset
+                break
+            seen.add(offset)
+            opcode, arguments, after = instructions[offset]
+            if self.skip_blocks and opcode in BLOCK_OPCODES:
+                offset = after
+                continue
+            maker = self.op_makers[opcode]
+            if maker is not None:
+                op = maker(self.functions[opcode], arguments, after)
+                if op is not None:
+                    ops.append(op)
+                    nexts.append(after)
+                offset = after
+                continue
+            maker = self.terminator_makers[opcode]
+            if maker is None:
+                offset = arguments[0]
+                continue
+            terminator = maker(self.functions[opcode], arguments, after)
+            terminator_next = after
+            break
+        block = self.blocks[start] = (
+            tuple(ops), terminator, terminator_next, tuple(nexts),
+        )
+        return block
+
+
+def make_tables(functions, base_functions, operators, compare_operators):
+    """Make the tables for VirtualMachine.closure_tables.
+
+    `functions` are the opcode handlers of a VM class, `base_functions`
+    those of VirtualMachine itself, and `operators` the functions, indexed
+    by opcode, for the operator opcodes whose handlers are made from them.
+    `compare_operators` are the class's COMPARE_OPERATORS.  Returns two
+    lists, indexed by opcode, of functions making ops or terminators.  Each
+    maker is called with the opcode's handler, the instruction's arguments
+    and the offset of the next instruction.
+
+    An opcode has an op maker if its handler can't jump, otherwise a
+    terminator maker, except the unconditional jumps, which have neither, so
+    that blocks go on at their targets.  Handlers a subclass overrides are
+    always called, and so are those with no special closure here.
+
+    """
+    op_makers = [None] * len(functions)
+    terminator_makers = [None] * len(functions)
+    for op, function in enumerate(functions):
+        overridden = function is not base_functions[op]
+        if operators[op] is not None:
+            op_makers[op] = OPERATOR_MAKERS[op](operators[op])
+        elif op == COMPARE_OP and not overridden:
+            op_makers[op] = make_compare_maker(compare_operators)
+        elif op in CONTROL_OPCODES:
+            if op in JUMPS and not overridden:
+                continue
+            maker = None
+            if not overridden:
+                maker = TERMINATOR_MAKERS.get(op)
+            terminator_makers[op] = maker or make_handler_terminator
+        else:
+            maker = None
+            if not overridden:
+                maker = OP_MAKERS.get(op)
+            op_makers[op] = maker or make_handler_op
+    return op_makers, terminator_makers
+
+
+def make_handler_op(handler, arguments, after):
+    """Make an op calling `handler`, for opcodes with no closures here."""
+    def op(vm, frame, stack, sp, fastlocals):
+        frame.f_lasti = after
+        frame.stacktop = sp
+        handler(vm, *arguments)
+        return frame.stacktop
+    return op
+
+
+def make_handler_terminator(handler, arguments, after):
+    """Make a terminator calling `handler`."""
+    def terminator(vm, frame, stack, sp, fastlocals):
+        return handler(vm, *arguments)
+    return terminator
+
+
+def goto(vm, frame, stack, sp, fastlocals):
+    """The terminator for blocks that just go on at another offset."""
+    return None
+
+
+## Ops
+
+# OP_MAKERS maps opcodes to functions making their ops.  They are listed
+# by name with the `op_maker` decorator.
+
+OP_MAKERS = {}
+
+
+def op_maker(*names):
+    """Register the decorated function as the op maker for `names`."""
+    def decorator(maker):
+        for name in names:
+            if name in opmap:
+                OP_MAKERS[opmap[name]] = maker
+        return maker
+    return decorator
+
+
+@op_maker('NOP')
+def make_nop(handler, arguments, after):
+    # Nothing to do, so no op at all.
+    return None
+
+
+@op_maker('LOAD_FAST')
+def make_load_fast(handler, arguments, after):
+    slot, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        val = fastlocals[slot]
+        if val is UNBOUND:
+            raise unbound_local_error(frame, slot)
+        stack[sp] = val
+        return sp + 1
+    return op
+
+
+@op_maker('STORE_FAST')
+def make_store_fast(handler, arguments, after):
+    slot, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        sp -= 1
+        fastlocals[slot] = stack[sp]
+        stack[sp] = None
+        return sp
+    return op
+
+
+@op_maker('LOAD_DEREF')
+def make_load_deref(handler, arguments, after):
+    index, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        val = frame.cells[index].contents
+        if val is UNBOUND:
+            raise unbound_cell_error(frame, index)
+        stack[sp] = val
+        return sp + 1
+    return op
+
+
+@op_maker('STORE_DEREF')
+def make_store_deref(handler, arguments, after):
+    index, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        sp -= 1
+        frame.cells[index].contents = stack[sp]
+        stack[sp] = None
+        return sp
+    return op
+
+
+@op_maker('LOAD_CONST')
+def make_load_const(handler, arguments, after):
+    const, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        stack[sp] = const
+        return sp + 1
+    return op
+
+
+@op_maker('POP_TOP')
+def make_pop_top(handler, arguments, after):
+    def op(vm, frame, stack, sp, fastlocals):
+        sp -= 1
+        stack[sp] = None
+        return sp
+    return op
+
+
+@op_maker('DUP_TOP')
+def make_dup_top(handler, arguments, after):
+    def op(vm, frame, stack, sp, fastlocals):
+        stack[sp] = stack[sp-1]
+        return sp + 1
+    return op
+
+
+@op_maker('ROT_TWO')
+def make_rot_two(handler, arguments, after):
+    def op(vm, frame, stack, sp, fastlocals):
+        stack[sp-2], stack[sp-1] = stack[sp-1], stack[sp-2]
+        return sp
+    return op
+
+
+@op_maker('ROT_THREE')
+def make_rot_three(handler, arguments, after):
+    def op(vm, frame, stack, sp, fastlocals):
+        stack[sp-3], stack[sp-2], stack[sp-1] = (
+            stack[sp-1], stack[sp-3], stack[sp-2]
+        )
+        return sp
+    return op
+
+
+@op_maker('LOAD_GLOBAL')
+def make_load_global(handler, arguments, after):
+    name, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        f_globals = frame.f_globals
+        if name in f_globals:
+            stack[sp] = f_globals[name]
+        elif name in frame.f_builtins:
+            stack[sp] = frame.f_builtins[name]
+        else:
+            raise NameError("global name '%s' is not defined" % name)
+        return sp + 1
+    return op
+
+
+@op_maker('LOAD_NAME')
+def make_load_name(handler, arguments, after):
+    name, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        f_locals = frame.f_locals
+        if name in f_locals:
+            stack[sp] = f_locals[name]
+        elif name in frame.f_globals:
+            stack[sp] = frame.f_globals[name]
+        elif name in frame.f_builtins:
+            stack[sp] = frame.f_builtins[name]
+        else:
+            raise NameError("name '%s' is not defined" % name)
+        return sp + 1
+    return op
+
+
+@op_maker('STORE_NAME')
+def make_store_name(handler, arguments, after):
+    name, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        sp -= 1
+        frame.f_locals[name] = stack[sp]
+        stack[sp] = None
+        return sp
+    return op
+
+
+@op_maker('LOAD_ATTR')
+def make_load_attr(handler, arguments, after):
+    attr, cache = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        obj = stack[sp-1]
+        cls = cache[0]
+        if cls is UNCACHED:
+            stack[sp-1] = getattr(obj, attr)
+        elif type(obj) is cls and attr not in obj.__dict__ and (
+            cache[1][1].get(attr) is cache[1][0] and not cache[1][2] and
+            cls.__mro__ is cache[1][3]
+            or method_is_current(cache[1], cls, attr)
+        ):
+            stack[sp-1] = Method(obj, cls, cache[1][0])
+            vm.attr_cache_hits += 1
+        else:
+            stack[sp-1] = vm.load_attr(obj, attr, cache)
+        return sp
+    return op
+
+
+@op_maker('STORE_ATTR')
+def make_store_attr(handler, arguments, after):
+    attr, cache = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        val = stack[sp-2]
+        obj = stack[sp-1]
+        stack[sp-2] = stack[sp-1] = None
+        if type(obj) is cache[0]:
+            setattr(obj, attr, val)
+            vm.attr_cache_hits += 1
+        else:
+            vm.store_attr(obj, attr, val, cache)
+        return sp - 2
+    return op
+
+
+@op_maker('STORE_SUBSCR')
+def make_store_subscr(handler, arguments, after):
+    def op(vm, frame, stack, sp, fastlocals):
+        val, obj, subscr = stack[sp-3:sp]
+        stack[sp-3:sp] = NONES_3
+        obj[subscr] = val
+        return sp - 3
+    return op
+
+NONES_3 = (None, None, None)
+
+
+def make_compare_maker(compare_operators):
+    """Make the op maker for COMPARE_OP, with a VM's comparisons."""
+    def maker(handler, arguments, after):
+        fn = compare_operators[arguments[0]]
+        def op(vm, frame, stack, sp, fastlocals):
+            sp -= 1
+            y = stack[sp]
+            stack[sp] = None
+            stack[sp-1] = fn(stack[sp-1], y)
+            return sp
+        return op
+    return maker
+
+
+@op_maker('GET_ITER')
+def make_get_iter(handler, arguments, after):
+    def op(vm, frame, stack, sp, fastlocals):
+        stack[sp-1] = iter(stack[sp-1])
+        return sp
+    return op
+
+
+def make_build(kind):
+    """Make an op maker for building `kind` from the top of the stack."""
+    def maker(handler, arguments, after):
+        count, = arguments
+        nones = (None,) * max(count - 1, 0)
+        def op(vm, frame, stack, sp, fastlocals):
+            base = sp - count
+            elts = kind(stack[base:sp])
+            stack[base+1:sp] = nones
+            stack[base] = elts
+            return base + 1
+        return op
+    return maker
+
+op_maker('BUILD_TUPLE')(make_build(tuple))
+op_maker('BUILD_LIST')(make_build(list))
+
+
+@op_maker('UNPACK_SEQUENCE')
+def make_unpack_sequence(handler, arguments, after):
+    count, = arguments
+    def op(vm, frame, stack, sp, fastlocals):
+        seq = stack[sp-1]
+        if type(seq) in (tuple, list) and len(seq) == count:
+            stack[sp-1:sp-1+count] = seq[::-1]
+            return sp - 1 + count
+        # The handler makes the errors, and unpacks other iterables.
+        frame.stacktop = sp
+        handler(vm, count)
+        return frame.stacktop
+    return op
+
+
+@op_maker('CALL_FUNCTION')
+def make_call_function(handler, arguments, after):
+    arg, = arguments
+    if arg >= 256:
+        # Keyword arguments: leave them to the handler.
+        return make_handler_op(handler, arguments, after)
+    count = arg
+    nones = (None,) * count
+    def op(vm, frame, stack, sp, fastlocals):
+        posargs = stack[sp-count:sp]
+        stack[sp-count:sp] = nones
+        sp -= count + 1
+        func = stack[sp]
+        stack[sp] = None
+        if hasattr(func, 'im_func'):
+            # Methods get self as an implicit first parameter.
+            if func.im_self:
+                posargs.insert(0, func.im_self)
+            # The first parameter must be the correct type.
+            if not isinstance(posargs[0], func.im_class):
+                raise TypeError(
+                    'unbound method %s() must be called with %s '
+                    'instance as first argument (got %s instance '
+                    'instead)' % (
+                        func.im_func.func_name,
+                        func.im_class.__name__,
+                        type(posargs[0]).__name__,
+                    )
+                )
+            func = func.im_func
+        frame.f_lasti = after
+        if func is builtins.locals:
+            stack[sp] = frame.f_locals
+        else:
+            stack[sp] = func(*posargs)
+        return sp + 1
+    return op
+
+
+# OPERATOR_MAKERS maps operator opcodes to functions that take the operator
+# function and make an op maker.
+
+def make_unary_maker(fn):
+    def maker(handler, arguments, after):
+        def op(vm, frame, stack, sp, fastlocals):
+            stack[sp-1] = fn(stack[sp-1])
+            return sp
+        return op
+    return maker
+
+
+def make_binary_maker(fn):
+    def maker(handler, arguments, after):
+        def op(vm, frame, stack, sp, fastlocals):
+            sp -= 1
+            y = stack[sp]
+            stack[sp] = None
+            stack[sp-1] = fn(stack[sp-1], y)
+            return sp
+        return op
+    return maker
+
+OPERATOR_MAKERS = {}
+for name, op in opmap.items():
+    prefix = name.partition('_')[0]
+    if prefix == 'UNARY':
+        OPERATOR_MAKERS[op] = make_unary_maker
+    elif prefix in ('BINARY', 'INPLACE'):
+        OPERATOR_MAKERS[op] = make_binary_maker
+
+
+## Terminators
+
+TERMINATOR_MAKERS = {}
+
+
+def terminator_maker(*names):
+    """Register the decorated function as the terminator maker for `names`."""
+    def decorator(maker):
+        for name in names:
+            if name in opmap:
+                TERMINATOR_MAKERS[opmap[name]] = maker
+        return maker
+    return decorator
+
+
+@terminator_maker('POP_JUMP_IF_FALSE')
+def make_pop_jump_if_false(handler, arguments, after):
+    jump, = arguments
+    def terminator(vm, frame, stack, sp, fastlocals):
+        sp -= 1
+        val = stack[sp]
+        stack[sp] = None
+        frame.stacktop = sp
+        if not val:
+            frame.f_lasti = jump
+    return terminator
+
+
+@terminator_maker('POP_JUMP_IF_TRUE')
+def make_pop_jump_if_true(handler, arguments, after):
+    jump, = arguments
+    def terminator(vm, frame, stack, sp, fastlocals):
+        sp -= 1
+        val = stack[sp]
+        stack[sp] = None
+        frame.stacktop = sp
+        if val:
+            frame.f_lasti = jump
+    return terminator
+
+
+@terminator_maker('JUMP_IF_FALSE_OR_POP')
+def make_jump_if_false_or_pop(handler, arguments, after):
+    jump, = arguments
+    def terminator(vm, frame, stack, sp, fastlocals):
+        if not stack[sp-1]:
+            frame.f_lasti = jump
+        else:
+            stack[sp-1] = None
+            frame.stacktop = sp - 1
+    return terminator
+
+
+@terminator_maker('JUMP_IF_TRUE_OR_POP')
+def make_jump_if_true_or_pop(handler, arguments, after):
+    jump, = arguments
+    def terminator(vm, frame, stack, sp, fastlocals):
+        if stack[sp-1]:
+            frame.f_lasti = jump
+        else:
+            stack[sp-1] = None
+            frame.stacktop = sp - 1
+    return terminator
+
+
+@terminator_maker('FOR_ITER')
+def make_for_iter(handler, arguments, after):
+    jump, = arguments
+    def terminator(vm, frame, stack, sp, fastlocals):
+        try:
+            val = next(stack[sp-1])
+        except StopIteration:
+            stack[sp-1] = None
+            frame.stacktop = sp - 1
+            frame.f_lasti = jump
+        else:
+            stack[sp] = val
+            frame.stacktop = sp + 1
+    return terminator
+
+
+@terminator_maker('RETURN_VALUE')
+def make_return_value(handler, arguments, after):
+    def terminator(vm, frame, stack, sp, fastlocals):
+        sp -= 1
+        vm.return_value = stack[sp]
+        stack[sp] = None
+        frame.stacktop = sp
+        if frame.generator:
+            frame.generator.finished = True
+        return WHY_RETURN
+    return terminator
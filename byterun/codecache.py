@@ -0,0 +1,169 @@
+"""A cache of compiled and decoded code on disk, for Byterun."""
+
+import hashlib
+import imp
+import marshal
+import os
+import sys
+import tempfile
+import types
+
+from .decode import DUMP_FORMAT, DecodedCode
+
+
+def code_objects(code):
+    """Get `code` and all the code objects in its constants, depth first."""
+    codes = [code]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            codes.extend(code_objects(const))
+    return codes
+
+
+class CodeCache(object):
+    """A directory of compiled code, with the decoded instructions for it.
+
+    Each source file has an entry holding its marshalled code object and
+    the DecodedCode of every code object in it.  An entry is used only if
+    the file's path, modification time, size and source text, the Python
+    version and the decoded format all match.  Entries are written to a
+    temporary file and renamed into place, so readers only see whole ones,
+    and an entry that can't be read is treated as missing.  When the
+    entries take more than `maxsize` bytes, the least recently used are
+    removed.
+
+    """
+    SUFFIX = '.bcache'
+
+    def __init__(self, directory, maxsize=64 * 1024 * 1024):
+        self.directory = directory
+        self.maxsize = maxsize
+        # The parts of entries' keys that are the same for every file.
+        self.version = "%s %s %s" % (
+            sys.version, imp.get_magic(), DUMP_FORMAT,
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, filename):
+        """Get the path of the entry for the source file `filename`."""
+        name = hashlib.sha1(
+            os.path.abspath(filename).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.directory, name + self.SUFFIX)
+
+    def key(self, filename, source):
+        """Make the key identifying an entry's source and interpreter."""
+        stat = os.stat(filename)
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        return (
+            os.path.abspath(filename), int(stat.st_mtime * 1e9),
+            stat.st_size, hashlib.sha1(source).hexdigest(), self.version,
+        )
+
+    def compile(self, source, filename, decode_cache):
+        """Compile `source` from `filename`, using the cache if possible.
+
+        The decoded instructions for the code objects are put in
+        `decode_cache`, so the VM won't decode them again.
+
+        """
+        key = self.key(filename, source)
+        path = self.entry_path(filename)
+        entry = self.read(path, key)
+        if entry is not None:
+            self.hits += 1
+            code, dumps = entry
+            for each, dumped in zip(code_objects(code), dumps):
+                decode_cache.put(each, DecodedCode.load(each, dumped))
+            return code
+
+        self.misses += 1
+        code = compile(source, filename, "exec")
+        dumps = []
+        for each in code_objects(code):
+            decoded = DecodedCode(each)
+            decode_cache.put(each, decoded)
+            dumps.append(decoded.dump(each))
+        self.write(path, key, (code, dumps))
+        return code
+
+    def read(self, path, key):
+        """Read the entry at `path`, or None if it's missing or stale."""
+        try:
+            with open(path, 'rb') as f:
+                if marshal.load(f) != key:
+                    return None
+                entry = marshal.load(f)
+            # Note that it was used, for choosing what to evict.
+            os.utime(path, None)
+        except Exception:
+            return None
+        return entry
+
+    def write(self, path, key, entry):
+        """Write an entry, if we can, and evict old ones if needed."""
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temp = tempfile.mkstemp(
+                dir=self.directory, suffix='.tmp',
+            )
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    marshal.dump(key, f)
+                    marshal.dump(entry, f)
+                replace(temp, path)
+            except:
+                os.remove(temp)
+                raise
+        except (IOError, OSError):
+            # The cache is only an optimization.
+            return
+        self.evict()
+
+    def entries(self):
+        """Get a list of (last used time, size, path) for the entries."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries, to fit in `maxsize`."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process removed it first.
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+if hasattr(os, 'replace'):
+    replace = os.replace
+else:
+    def replace(src, dst):
+        """Rename `src` to `dst`, replacing it if it exists."""
+        if sys.platform == 'win32' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
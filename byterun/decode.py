@@ -0,0 +1,386 @@
+"""Decoding code objects into instruction arrays for Byterun."""
+
+import bisect
+import collections
+import dis
+import weakref
+
+import six
+
+from .blocks import block_table
+
+if six.PY3:
+    byteint = lambda b: b
+else:
+    byteint = ord
+
+
+# Superinstructions are pseudo-opcodes for common pairs of instructions.
+# They are numbered after the real opcodes, and named after their parts.
+SUPERINSTRUCTIONS = [
+    ('LOAD_FAST', 'LOAD_FAST'),
+    ('LOAD_FAST', 'LOAD_ATTR'),
+    ('COMPARE_OP', 'POP_JUMP_IF_FALSE'),
+    ('LOAD_CONST', 'RETURN_VALUE'),
+    ('FOR_ITER', 'STORE_FAST'),
+]
+
+# The names of all opcodes, real and super, indexed by opcode.
+opname = list(dis.opname) + ['%s__%s' % pair for pair in SUPERINSTRUCTIONS]
+opmap = dict((name, op) for op, name in enumerate(opname))
+
+# Maps pairs of real opcodes to the superinstruction that fuses them.
+super_opcodes = dict(
+    ((dis.opmap[first], dis.opmap[second]), opmap['%s__%s' % (first, second)])
+    for first, second in SUPERINSTRUCTIONS
+)
+
+
+# One decoded instruction.  `arguments` is a tuple holding the resolved
+# argument, or empty if the opcode takes none.  Names, constants and jump
+# targets are resolved, local variables are left as slot numbers.  `next` is the offset of the
+# following instruction.
+Instruction = collections.namedtuple("Instruction", "opcode, arguments, next")
+
+# Opcodes whose arguments end with an attribute cache for the instruction: a
+# list of [type, value, more], all None until the VM fills it in.
+ATTR_CACHED = set([dis.opmap['LOAD_ATTR'], dis.opmap['STORE_ATTR']])
+
+# The type in an attribute cache for LOAD_ATTR instructions that aren't
+# cached.  The cache is [type, found, {type: found or None}] for instructions
+# that bind interpreted methods: one type in the list, and more in the dict.
+# `found` is what pyvm2.interpreted_method returned for the type.
+UNCACHED = 'uncached'
+
+# Every live DecodedCode with caches, so they can all be reset.
+_cached = weakref.WeakSet()
+
+
+def method_is_current(found, cls, name):
+    """Check that the classes haven't changed since pyvm2.interpreted_method.
+
+    `found` is what interpreted_method returned for an instance of `cls`.
+    Classes can be changed by native code the VM never sees, so attribute
+    caches check this on each hit: `cls` must have the same MRO, since
+    assigning __bases__ makes a new one, and `name` must still be found
+    first in the same class, as the same Function.  The engines check the
+    usual case, a method found first in the MRO, themselves, and only call
+    this for inherited methods.
+
+    """
+    func, namespace, before, mro = found
+    if cls.__mro__ is not mro:
+        return False
+    for earlier in before:
+        if name in earlier:
+            return False
+    return namespace.get(name) is func
+
+
+def reset_attr_caches():
+    """Forget what all attribute caches know about types.
+
+    Call this when a class changes.
+
+    """
+    for decoded in list(_cached):
+        for cache in decoded.attr_caches:
+            cache[:] = [None, None, None]
+
+
+def decode_instructions(code):
+    """Decode the bytecode of `code` into a list of Instructions.
+
+    The list is indexed by bytecode offset: each offset that starts an
+    instruction holds its Instruction, the other slots hold None.
+
+    """
+    co_code = code.co_code
+    instructions = [None] * len(co_code)
+    offset = 0
+    while offset < len(co_code):
+        byteCode = byteint(co_code[offset])
+        next_offset = offset + 1
+        arguments = ()
+        if byteCode >= dis.HAVE_ARGUMENT:
+            intArg = (
+                byteint(co_code[next_offset]) +
+                (byteint(co_code[next_offset+1]) << 8)
+            )
+            next_offset += 2
+            if byteCode in dis.hasconst:
+                arg = code.co_consts[intArg]
+            elif byteCode in dis.hasname:
+                arg = code.co_names[intArg]
+            elif byteCode in dis.hasjrel:
+                arg = next_offset + intArg
+            elif byteCode in dis.hasjabs:
+                arg = intArg
+            else:
+                # Fast locals are referred to by their slot number, the
+                # same as their index in co_varnames, and cells by their
+                # index in co_cellvars + co_freevars, like frame.cells.
+                arg = intArg
+            arguments = (arg,)
+            if byteCode in ATTR_CACHED:
+                arguments += ([None, None, None],)
+        instructions[offset] = Instruction(byteCode, arguments, next_offset)
+        offset = next_offset
+    return instructions
+
+
+def fuse_instructions(instructions):
+    """Make a copy of `instructions` using superinstructions where possible.
+
+    When an instruction and the one after it form one of the
+    SUPERINSTRUCTIONS pairs, the first is replaced by the superinstruction.
+    Its arguments are those of the pair, followed by the offset after the
+    second instruction.  Its `next` is still the offset of the second
+    instruction, so handlers can keep f_lasti exactly as it would be if the
+    pair ran separately: they set it to the last argument once the first
+    half is done.
+
+    The second instruction is left in place, so jumps to it still work.
+
+    """
+    fused = list(instructions)
+    for offset, instr in enumerate(instructions):
+        if instr is None or instr.next >= len(instructions):
+            continue
+        second = instructions[instr.next]
+        if second is None:
+            # The peephole optimizer removed it: instr never falls through.
+            continue
+        superop = super_opcodes.get((instr.opcode, second.opcode))
+        if superop is not None:
+            fused[offset] = Instruction(
+                superop,
+                instr.arguments + second.arguments + (second.next,),
+                instr.next,
+            )
+    return fused
+
+
+class LineTable(object):
+    """The line numbers of a code object, from its co_lnotab.
+
+    `offsets` is the sorted list of bytecode offsets where lines start, and
+    `lines` the line number starting at each.  `starts` is the same offsets
+    as a set, for checking if an instruction starts a line.
+
+    """
+    __slots__ = ['offsets', 'lines', 'starts']
+
+    def __init__(self, code):
+        self.offsets = [0]
+        self.lines = [code.co_firstlineno]
+        lnotab = code.co_lnotab
+        byte_num = 0
+        line_num = code.co_firstlineno
+        for byte_incr, line_incr in zip(
+            six.iterbytes(lnotab[0::2]), six.iterbytes(lnotab[1::2])
+        ):
+            byte_num += byte_incr
+            line_num += line_incr
+            if byte_num == self.offsets[-1]:
+                # Big line jumps take more than one entry.
+                self.lines[-1] = line_num
+            elif line_num != self.lines[-1]:
+                self.offsets.append(byte_num)
+                self.lines.append(line_num)
+        self.starts = frozenset(self.offsets)
+
+    def line_number(self, offset):
+        """Get the line number of the bytecode at `offset`."""
+        return self.lines[bisect.bisect_right(self.offsets, offset) - 1]
+
+
+# Identifies the format of DecodedCode.dump(), which depends on the opcodes.
+DUMP_FORMAT = "1 %s" % " ".join(opname)
+
+HASCONST = frozenset(dis.hasconst)
+
+
+class DecodedCode(object):
+    """The decoded form of one code object.
+
+    This deliberately holds no reference to the code object itself, so that
+    caching it doesn't keep the code alive.
+
+    """
+    __slots__ = [
+        'instructions', 'fused', 'optimized', 'closures', 'lines', 'binding',
+        'attr_caches', 'runs', 'transpiled', 'block_table',
+        '__weakref__',
+    ]
+
+    def __init__(self, code):
+        self.instructions = decode_instructions(code)
+        # What the engines run: the instructions with superinstructions.
+        self.fused = fuse_instructions(self.instructions)
+        self.lines = LineTable(code)
+        self.setup()
+
+    def setup(self):
+        """Finish initializing, once the instructions and lines are set."""
+        self.attr_caches = [
+            instr.arguments[-1] for instr in self.instructions
+            if instr is not None and instr.opcode in ATTR_CACHED
+        ]
+        if self.attr_caches:
+            _cached.add(self)
+        # The pyobj.BindingPlan for calls, made when a function first calls
+        # this code.
+        self.binding = None
+        # What engines run when optimizing: the fused instructions from
+        # peephole.optimize, made when a VM that optimizes first runs them.
+        self.optimized = None
+        # The closures.ClosureCode for the closure engine, by VM class and
+        # whether it optimizes, made when first run.
+        self.closures = None
+        # How many times VMs that transpile have run this code, and the
+        # functions from transpile.transpile they run instead, by VM class,
+        # or False if it can't be transpiled.
+        self.runs = None
+        self.transpiled = None
+        # The blocks.block_table for the instructions, or None if frames
+        # have to push and pop their blocks as they run.
+        self.block_table = block_table(self.instructions)
+
+    def dump(self, code):
+        """Get the decoded form of `code` as data marshal can save.
+
+        Constants are saved as their index in co_consts, so that code objects
+        among them are the ones in `code` when the data is loaded.  Caches
+        aren't saved, they start empty.
+
+        """
+        instructions = []
+        for offset, instr in enumerate(self.instructions):
+            if instr is None:
+                continue
+            arguments = instr.arguments
+            if instr.opcode in HASCONST:
+                co_code = code.co_code
+                arguments = (
+                    byteint(co_code[offset+1]) +
+                    (byteint(co_code[offset+2]) << 8),
+                )
+            elif instr.opcode in ATTR_CACHED:
+                arguments = arguments[:-1]
+            instructions.append((offset, instr.opcode, arguments, instr.next))
+        fused = [
+            (offset, instr.opcode)
+            for offset, instr in enumerate(self.fused)
+            if instr is not self.instructions[offset]
+        ]
+        return (
+            len(self.instructions), tuple(instructions), tuple(fused),
+            tuple(self.lines.offsets), tuple(self.lines.lines),
+        )
+
+    @classmethod
+    def load(cls, code, data):
+        """Make the DecodedCode for `code` from what dump() returned."""
+        size, dumped, fused_ops, offsets, lines = data
+        consts = code.co_consts
+        # Instruction(...) is slow, this is what it does.
+        make = tuple.__new__
+        instructions = [None] * size
+        for offset, opcode, arguments, next_offset in dumped:
+            if opcode in HASCONST:
+                arguments = (consts[arguments[0]],)
+            elif opcode in ATTR_CACHED:
+                arguments += ([None, None, None],)
+            instructions[offset] = make(
+                Instruction, (opcode, arguments, next_offset)
+            )
+        fused = list(instructions)
+        for offset, superop in fused_ops:
+            instr = instructions[offset]
+            second = instructions[instr.next]
+            fused[offset] = Instruction(
+                superop,
+                instr.arguments + second.arguments + (second.next,),
+                instr.next,
+            )
+
+        self = cls.__new__(cls)
+        self.instructions = instructions
+        self.fused = fused
+        self.lines = table = LineTable.__new__(LineTable)
+        table.offsets = list(offsets)
+        table.lines = list(lines)
+        table.starts = frozenset(offsets)
+        self.setup()
+        return self
+
+
+class DecodeCache(object):
+    """A bounded cache of DecodedCode objects, keyed weakly by code object.
+
+    Code objects compare equal by value, so entries are keyed by identity,
+    and dropped when their code object is collected.  When more than
+    `maxsize` code objects are cached, the least recently used is evicted.
+
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        # Maps id(code) to (weakref to code, DecodedCode), oldest first.
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, code):
+        """Return the DecodedCode for `code`, decoding it if needed."""
+        key = id(code)
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0]() is code:
+            self.hits += 1
+            self._entries[key] = entry
+            return entry[1]
+
+        self.misses += 1
+        decoded = DecodedCode(code)
+        self.put(code, decoded)
+        return decoded
+
+    def put(self, code, decoded):
+        """Add `decoded`, decoded elsewhere, as the DecodedCode for `code`."""
+        key = id(code)
+        self._entries.pop(key, None)
+        self._entries[key] = (weakref.ref(code, self._forget(key)), decoded)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _forget(self, key):
+        """Make a weakref callback that drops the entry for `key`."""
+        entries = self._entries
+        def callback(ref):
+            entry = entries.get(key)
+            if entry is not None and entry[0] is ref:
+                del entries[key]
+        return callback
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dict of the cache's counters."""
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# The cache shared by all VirtualMachines unless they are given their own.
+decode_cache = DecodeCache()
@@ -1,8 +1,10 @@
 """Execute files of Python code."""
 
+import fnmatch
 import imp
 import os
 import sys
+import threading
 import tokenize
 
 from .pyvm2 import VirtualMachine
@@ -19,8 +21,23 @@ except:
 NoSource = Exception
 
 
-def exec_code_object(code, env):
-    vm = VirtualMachine()
+def read_source(filename):
+    """Read the source in `filename`, ready to compile."""
+    source_file = open_source(filename)
+    try:
+        source = source_file.read()
+    finally:
+        source_file.close()
+
+    # `compile` still needs the last line to be clean, so make sure it is.
+    if not source or source[-1] != '\n':
+        source += '\n'
+    return source
+
+
+def exec_code_object(code, env, vm=None):
+    if vm is None:
+        vm = VirtualMachine()
     vm.run_code(code, f_globals=env)
 
 
@@ -40,12 +57,14 @@ def rsplit1(s, sep):
     return sep.join(parts[:-1]), parts[-1]
 
 
-def run_python_module(modulename, args):
+def run_python_module(modulename, args, vm=None, code_cache=None):
     """Run a python module, as though with ``python -m name args...``.
 
     `modulename` is the name of the module, possibly a dot-separated name.
     `args` is the argument array to present as sys.argv, including the first
-    element naming the module being executed.
+    element naming the module being executed.  `vm` is the VirtualMachine to
+    run it in, a new one if not given.  `code_cache` is a codecache.CodeCache
+    to get the compiled code from, if any.
 
     """
     openfile = None
@@ -86,16 +105,20 @@ def run_python_module(modulename, args):
 
     # Finally, hand the file off to run_python_file for execution.
     args[0] = pathname
-    run_python_file(pathname, args, package=packagename)
+    run_python_file(
+        pathname, args, package=packagename, vm=vm, code_cache=code_cache,
+    )
 
 
-def run_python_file(filename, args, package=None):
+def run_python_file(filename, args, package=None, vm=None, code_cache=None):
     """Run a python file as if it were the main program on the command line.
 
     `filename` is the path to the file to execute, it need not be a .py file.
     `args` is the argument array to present as sys.argv, including the first
     element naming the file being executed.  `package` is the name of the
-    enclosing package, if any.
+    enclosing package, if any.  `vm` is the VirtualMachine to run it in, a
+    new one if not given.  `code_cache` is a codecache.CodeCache to get the
+    compiled code from, if any.
 
     """
     # Create a module to serve as __main__
@@ -117,25 +140,21 @@ def run_python_file(filename, args, package=None):
         sys.path[0] = os.path.abspath(os.path.dirname(filename))
 
     try:
-        # Open the source file.
+        # Read the source file, and compile a code object from it.
         try:
-            source_file = open_source(filename)
+            source = read_source(filename)
         except IOError:
             raise NoSource("No file to run: %r" % filename)
 
-        try:
-            source = source_file.read()
-        finally:
-            source_file.close()
-
-        # We have the source.  `compile` still needs the last line to be clean,
-        # so make sure it is, then compile a code object from it.
-        if not source or source[-1] != '\n':
-            source += '\n'
-        code = compile(source, filename, "exec")
+        if vm is None:
+            vm = VirtualMachine()
+        if code_cache is None:
+            code = compile(source, filename, "exec")
+        else:
+            code = code_cache.compile(source, filename, vm.decode_cache)
 
         # Execute the source file.
-        exec_code_object(code, main_mod.__dict__)
+        exec_code_object(code, main_mod.__dict__, vm)
     finally:
         # Restore the old __main__
         sys.modules['__main__'] = old_main_mod
@@ -143,3 +162,160 @@ def run_python_file(filename, args, package=None):
         # Restore the old argv and path
         sys.argv = old_argv
         sys.path[0] = old_path0
+
+
+class CompiledSources(object):
+    """Code objects compiled from source files, to share in a process.
+
+    VMs using the same DecodeCache, as they do by default, then also share
+    the decoded instructions for the code.
+
+    """
+    def __init__(self):
+        # Maps absolute paths to ((mtime, size), code).
+        self._codes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, vm, code_cache=None):
+        """Get the code object for the source file `filename`.
+
+        It's compiled if it isn't known or has changed, with the
+        codecache.CodeCache `code_cache` if there is one.
+
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._codes.get(path)
+            if entry is not None and entry[0] == stamp:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        source = read_source(filename)
+        if code_cache is None:
+            code = compile(source, filename, "exec")
+        else:
+            code = code_cache.compile(source, filename, vm.decode_cache)
+        with self._lock:
+            self._codes[path] = (stamp, code)
+        return code
+
+
+# The code shared by all InterpretedImporters unless they are given their own.
+compiled_sources = CompiledSources()
+
+
+class InterpretedImporter(object):
+    """An import hook to run imported modules in a VirtualMachine.
+
+    Once installed in sys.meta_path, modules whose names match one of
+    `patterns` are run by `vm` when they are imported.  Patterns are
+    fnmatch patterns for full module names, and a package's name also
+    matches the modules in it.  Only modules with source files are
+    interpreted, others are imported as usual.
+
+    """
+    def __init__(
+        self, vm, patterns, sources=compiled_sources, code_cache=None,
+    ):
+        self.vm = vm
+        self.patterns = list(patterns)
+        self.sources = sources
+        self.code_cache = code_cache
+        # Maps the modules found to their source file and package directory.
+        self._found = {}
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def matches(self, fullname):
+        """Should the module `fullname` be interpreted?"""
+        parts = fullname.split('.')
+        for i in range(len(parts)):
+            # The module itself, or a package it's in.
+            name = '.'.join(parts[:i+1])
+            for pattern in self.patterns:
+                if fnmatch.fnmatchcase(name, pattern):
+                    return True
+        return False
+
+    def find_module(self, fullname, path=None):
+        if not self.matches(fullname):
+            return None
+        try:
+            openfile, pathname, (_, _, kind) = imp.find_module(
+                fullname.rpartition('.')[2], path,
+            )
+        except ImportError:
+            return None
+        if openfile:
+            openfile.close()
+
+        package_dir = None
+        if kind == imp.PKG_DIRECTORY:
+            package_dir = pathname
+            try:
+                openfile, pathname, (_, _, kind) = imp.find_module(
+                    '__init__', [package_dir],
+                )
+            except ImportError:
+                return None
+            if openfile:
+                openfile.close()
+        if kind != imp.PY_SOURCE:
+            return None
+
+        self._found[fullname] = (pathname, package_dir)
+        return self
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        if fullname not in self._found:
+            # Look for submodules in their package, as the import system
+            # would have before calling find_module.
+            parent = fullname.rpartition('.')[0]
+            path = None
+            if parent:
+                path = getattr(sys.modules.get(parent), '__path__', None)
+                if path is None:
+                    raise ImportError("No module named %s" % fullname)
+            if self.find_module(fullname, path) is None:
+                raise ImportError("No module named %s" % fullname)
+        filename, package_dir = self._found.pop(fullname)
+        code = self.sources.get(filename, self.vm, self.code_cache)
+
+        mod = imp.new_module(fullname)
+        mod.__file__ = filename
+        mod.__loader__ = self
+        mod.__builtins__ = BUILTINS
+        if package_dir is None:
+            mod.__package__ = fullname.rpartition('.')[0]
+        else:
+            mod.__path__ = [package_dir]
+            mod.__package__ = fullname
+
+        sys.modules[fullname] = mod
+        try:
+            frame = self.vm.make_frame(code, f_globals=mod.__dict__)
+            self.vm.run_frame(frame)
+        except:
+            sys.modules.pop(fullname, None)
+            raise
+        return sys.modules[fullname]
@@ -0,0 +1,289 @@
+"""A peephole optimizer for decoded instructions, for Byterun.
+
+The optimizer rewrites the list of Instructions from decode_instructions.
+Instructions can't be removed or added, since they are indexed by offset,
+but an instruction's `next` can point anywhere.  So most rewrites replace
+the first instruction of a sequence with one that does the work of the whole
+sequence, and continues after it.  The rest of the sequence stays where it
+is for any other instructions that jump into it.
+
+The instructions skipped over never run, so frames report the line number
+of where they'll continue, which can be a different line.
+
+"""
+
+import dis
+import operator
+
+import six
+
+from .decode import Instruction
+
+
+def _opcode(name):
+    return dis.opmap.get(name, -1)
+
+NOP = _opcode('NOP')
+POP_TOP = _opcode('POP_TOP')
+DUP_TOP = _opcode('DUP_TOP')
+ROT_TWO = _opcode('ROT_TWO')
+ROT_THREE = _opcode('ROT_THREE')
+LOAD_CONST = _opcode('LOAD_CONST')
+STORE_FAST = _opcode('STORE_FAST')
+BUILD_TUPLE = _opcode('BUILD_TUPLE')
+BUILD_LIST = _opcode('BUILD_LIST')
+UNPACK_SEQUENCE = _opcode('UNPACK_SEQUENCE')
+COMPARE_OP = _opcode('COMPARE_OP')
+JUMP_ABSOLUTE = _opcode('JUMP_ABSOLUTE')
+JUMP_FORWARD = _opcode('JUMP_FORWARD')
+YIELD_FROM = _opcode('YIELD_FROM')
+
+# Jumps that always jump.
+UNCONDITIONAL_JUMPS = set([JUMP_ABSOLUTE, JUMP_FORWARD])
+
+# Jumps whose target can be moved along a chain of jumps.
+THREADABLE_JUMPS = set(_opcode(name) for name in [
+    'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE',
+    'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP', 'FOR_ITER',
+])
+
+# Every opcode whose argument is an offset to go to, including handlers.
+TARGETED = set(dis.hasjrel) | set(dis.hasjabs)
+
+# Opcodes that never go on to their `next`.
+NO_FALL_THROUGH = UNCONDITIONAL_JUMPS | set(_opcode(name) for name in [
+    'RETURN_VALUE', 'RAISE_VARARGS', 'BREAK_LOOP', 'CONTINUE_LOOP',
+])
+
+# Opcodes whose handlers use their own offset, so must keep their `next`.
+FIXED_NEXT = set([YIELD_FROM])
+
+UNARY_OPERATORS = {
+    _opcode('UNARY_POSITIVE'): operator.pos,
+    _opcode('UNARY_NEGATIVE'): operator.neg,
+    _opcode('UNARY_NOT'): operator.not_,
+    _opcode('UNARY_INVERT'): operator.invert,
+}
+
+# Division is left out: in Python 2, what / means depends on the module.
+BINARY_OPERATORS = {
+    _opcode('BINARY_POWER'): pow,
+    _opcode('BINARY_MULTIPLY'): operator.mul,
+    _opcode('BINARY_MODULO'): operator.mod,
+    _opcode('BINARY_ADD'): operator.add,
+    _opcode('BINARY_SUBTRACT'): operator.sub,
+    _opcode('BINARY_SUBSCR'): operator.getitem,
+    _opcode('BINARY_FLOOR_DIVIDE'): operator.floordiv,
+    _opcode('BINARY_TRUE_DIVIDE'): operator.truediv,
+    _opcode('BINARY_LSHIFT'): operator.lshift,
+    _opcode('BINARY_RSHIFT'): operator.rshift,
+    _opcode('BINARY_AND'): operator.and_,
+    _opcode('BINARY_XOR'): operator.xor,
+    _opcode('BINARY_OR'): operator.or_,
+}
+UNARY_OPERATORS.pop(-1, None)
+BINARY_OPERATORS.pop(-1, None)
+
+# The comparisons, by COMPARE_OP argument, that can be folded.
+COMPARE_OPERATORS = [
+    operator.lt, operator.le, operator.eq, operator.ne, operator.gt,
+    operator.ge, lambda x, y: x in y, lambda x, y: x not in y,
+]
+
+# The types of constants that folding works on, and the largest sized
+# sequence it will make.
+FOLDABLE_TYPES = six.integer_types + (
+    bool, float, complex, six.binary_type, six.text_type, tuple, frozenset,
+)
+MAX_FOLDED_SIZE = 20
+
+
+def optimize(instructions):
+    """Return an optimized copy of `instructions`, from decode_instructions."""
+    code = list(instructions)
+    targets = jump_targets(code)
+    fold_constants(code)
+    simplify_unpacking(code, targets)
+    drop_pops(code)
+    thread_jumps(code)
+    remove_unreachable(code)
+    return code
+
+
+def jump_targets(code):
+    """Get the set of offsets that some instruction can go to by jumping."""
+    return set(
+        instr.arguments[0] for instr in code
+        if instr is not None and instr.opcode in TARGETED
+    )
+
+
+def foldable(value):
+    """Can `value`, the result of an operation, be made a constant?"""
+    if not isinstance(value, FOLDABLE_TYPES):
+        return False
+    if isinstance(value, (tuple, frozenset)):
+        return len(value) <= MAX_FOLDED_SIZE and all(
+            foldable(item) for item in value
+        )
+    if isinstance(value, (six.binary_type, six.text_type)):
+        return len(value) <= MAX_FOLDED_SIZE
+    return True
+
+
+def fold_constants(code):
+    """Compute operations on constants when optimizing, not when running.
+
+    LOAD_CONST followed by a unary operator, or two LOAD_CONSTs followed by
+    a binary operator or comparison, become one LOAD_CONST of the result.
+
+    """
+    changed = True
+    while changed:
+        changed = False
+        for offset, instr in enumerate(code):
+            if instr is None or instr.opcode != LOAD_CONST:
+                continue
+            value = instr.arguments[0]
+            if not foldable(value):
+                continue
+            second = code[instr.next]
+            try:
+                if second.opcode in UNARY_OPERATORS:
+                    result = UNARY_OPERATORS[second.opcode](value)
+                    after = second.next
+                elif second.opcode == LOAD_CONST:
+                    other = second.arguments[0]
+                    third = code[second.next]
+                    if not foldable(other):
+                        continue
+                    if third.opcode in BINARY_OPERATORS:
+                        fn = BINARY_OPERATORS[third.opcode]
+                    elif (
+                        third.opcode == COMPARE_OP and
+                        third.arguments[0] < len(COMPARE_OPERATORS)
+                    ):
+                        fn = COMPARE_OPERATORS[third.arguments[0]]
+                    else:
+                        continue
+                    result = fn(value, other)
+                    after = third.next
+                else:
+                    continue
+            except Exception:
+                # Leave it to raise the error when it runs.
+                continue
+            if foldable(result):
+                code[offset] = Instruction(LOAD_CONST, (result,), after)
+                changed = True
+
+
+def simplify_unpacking(code, targets):
+    """Simplify building a sequence only to unpack it, and swapping.
+
+    BUILD_TUPLE or BUILD_LIST followed by UNPACK_SEQUENCE of up to three
+    items just reverses the top of the stack, with ROT_TWO or ROT_THREE.
+    ROT_TWO followed by two STORE_FASTs to different slots stores them in
+    the other order instead.
+
+    """
+    for offset, instr in enumerate(code):
+        if instr is None:
+            continue
+        if instr.opcode in (BUILD_TUPLE, BUILD_LIST):
+            count = instr.arguments[0]
+            unpack = code[instr.next]
+            if unpack.opcode != UNPACK_SEQUENCE or unpack.arguments[0] != count:
+                continue
+            if count == 1:
+                code[offset] = Instruction(NOP, (), unpack.next)
+            elif count == 2:
+                code[offset] = Instruction(ROT_TWO, (), unpack.next)
+            elif count == 3 and instr.next not in targets:
+                code[offset] = Instruction(ROT_THREE, (), instr.next)
+                code[instr.next] = Instruction(ROT_TWO, (), unpack.next)
+
+    for offset, instr in enumerate(code):
+        if instr is None or instr.opcode != ROT_TWO:
+            continue
+        first = code[instr.next]
+        if first.opcode != STORE_FAST or instr.next in targets:
+            continue
+        second = code[first.next]
+        if second.opcode != STORE_FAST:
+            continue
+        if first.arguments == second.arguments:
+            continue
+        code[offset] = Instruction(STORE_FAST, second.arguments, instr.next)
+        code[instr.next] = Instruction(
+            STORE_FAST, first.arguments, second.next
+        )
+
+
+def drop_pops(code):
+    """Skip pushing a value only to pop it.
+
+    LOAD_CONST or DUP_TOP followed by POP_TOP does nothing.
+
+    """
+    for offset, instr in enumerate(code):
+        if instr is None or instr.opcode not in (LOAD_CONST, DUP_TOP):
+            continue
+        pop = code[instr.next]
+        if pop.opcode == POP_TOP:
+            code[offset] = Instruction(NOP, (), pop.next)
+
+
+def follow(code, offset):
+    """Find where going to `offset` really goes, past NOPs and jumps."""
+    seen = set()
+    while offset not in seen:
+        seen.add(offset)
+        instr = code[offset]
+        if instr.opcode == NOP:
+            offset = instr.next
+        elif instr.opcode in UNCONDITIONAL_JUMPS:
+            offset = instr.arguments[0]
+        else:
+            break
+    return offset
+
+
+def thread_jumps(code):
+    """Go straight to where chains of NOPs and jumps lead.
+
+    Jumps to NOPs or unconditional jumps are moved to the end of the chain.
+    So is the `next` of every instruction: an instruction that would be
+    followed by a jump continues where the jump goes, without running it.
+
+    """
+    for offset, instr in enumerate(code):
+        if instr is None:
+            continue
+        arguments = instr.arguments
+        if instr.opcode in THREADABLE_JUMPS:
+            arguments = (follow(code, arguments[0]),) + arguments[1:]
+        next_offset = instr.next
+        if instr.opcode not in FIXED_NEXT and next_offset < len(code):
+            next_offset = follow(code, next_offset)
+        if arguments != instr.arguments or next_offset != instr.next:
+            code[offset] = Instruction(instr.opcode, arguments, next_offset)
+
+
+def remove_unreachable(code):
+    """Remove the instructions nothing can go to."""
+    reachable = set()
+    todo = [0]
+    while todo:
+        offset = todo.pop()
+        if offset in reachable or offset >= len(code):
+            continue
+        reachable.add(offset)
+        instr = code[offset]
+        if instr.opcode not in NO_FALL_THROUGH:
+            todo.append(instr.next)
+        if instr.opcode in TARGETED:
+            todo.append(instr.arguments[0])
+    for offset in range(len(code)):
+        if offset not in reachable:
+            code[offset] = None
@@ -0,0 +1,366 @@
+"""Profiling interpreted code, for Byterun."""
+
+import collections
+import json
+import marshal
+import threading
+import time
+from timeit import default_timer
+
+import six
+
+from .decode import LineTable, opname
+
+
+class OpcodeProfiler(object):
+    """Count and time the instructions a VirtualMachine runs.
+
+    Set it as a VM's `opcode_profiler` before running code.  Each instruction
+    is counted, and the time spent in it is added to its opcode name, its
+    site (the code object and offset it's at) and the handler that ran it.
+    Times are exclusive: an instruction that runs other frames, like a call,
+    isn't charged for the instructions they run.
+
+    """
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        # Maps opcode names to [count, time].
+        self.opcodes = {}
+        # Maps handler names to [count, time].
+        self.handlers = {}
+        # Maps (code, offset) to [count, time, inclusive time].
+        self.sites = {}
+        # The time spent in instructions nested in each instruction running.
+        self._nested = []
+
+    def dispatch(self, vm, frame, offset, byteCode, arguments):
+        """Run one instruction in `vm` with vm.dispatch, timing it."""
+        nested = self._nested
+        nested.append(0.0)
+        start = self.timer()
+        why = vm.dispatch(byteCode, arguments)
+        elapsed = self.timer() - start
+        exclusive = elapsed - nested.pop()
+
+        name = opname[byteCode]
+        stats = self.opcodes.get(name)
+        if stats is None:
+            stats = self.opcodes[name] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += exclusive
+
+        name = vm.dispatch_table[byteCode].__name__
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += exclusive
+
+        site = (frame.f_code, offset)
+        stats = self.sites.get(site)
+        if stats is None:
+            stats = self.sites[site] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += exclusive
+        stats[2] += elapsed
+        if nested:
+            # Our bookkeeping isn't the enclosing instruction's own time.
+            nested[-1] += self.timer() - start
+        return why
+
+    def clear(self):
+        self.opcodes.clear()
+        self.handlers.clear()
+        self.sites.clear()
+
+    def site_details(self):
+        """Iterate over the sites, with their details.
+
+        Yields (code, offset, line number, opcode name, stats) tuples.
+
+        """
+        lines = {}
+        for (code, offset), stats in self.sites.items():
+            table = lines.get(code)
+            if table is None:
+                table = lines[code] = LineTable(code)
+            name = opname[six.indexbytes(code.co_code, offset)]
+            yield code, offset, table.line_number(offset), name, stats
+
+    def stats(self):
+        """Return the results as a dict, ready to save as JSON.
+
+        'opcodes' and 'handlers' map names to counts and times, 'sites' is a
+        list of the sites, most time first.
+
+        """
+        def totals(table):
+            return dict(
+                (name, {'count': count, 'time': time})
+                for name, (count, time) in table.items()
+            )
+        sites = []
+        for code, offset, line, name, stats in self.site_details():
+            count, time, inclusive = stats
+            sites.append({
+                'filename': code.co_filename,
+                'function': code.co_name,
+                'line': line,
+                'offset': offset,
+                'opcode': name,
+                'count': count,
+                'time': time,
+                'inclusive_time': inclusive,
+            })
+        sites.sort(key=lambda site: site['time'], reverse=True)
+        return {
+            'opcodes': totals(self.opcodes),
+            'handlers': totals(self.handlers),
+            'sites': sites,
+        }
+
+    def write_json(self, filename):
+        """Save the results to `filename` as JSON."""
+        with open(filename, 'w') as f:
+            json.dump(self.stats(), f, indent=1, sort_keys=True)
+
+    def pstats(self):
+        """Return the sites in the format the pstats module reads.
+
+        Each site is a "function" named for its code, opcode and offset,
+        called once per time it ran.
+
+        """
+        result = {}
+        for code, offset, line, name, stats in self.site_details():
+            count, time, inclusive = stats
+            key = (
+                code.co_filename, line,
+                "%s:%s@%d" % (code.co_name, name, offset),
+            )
+            result[key] = (count, count, time, inclusive, {})
+        return result
+
+    def write_pstats(self, filename):
+        """Save the results to `filename` for pstats.Stats to load."""
+        write_pstats(self.pstats(), filename)
+
+
+def write_pstats(stats, filename):
+    """Save a dict in pstats format to `filename`, as cProfile does."""
+    with open(filename, 'wb') as f:
+        marshal.dump(stats, f)
+
+
+def code_label(code):
+    """Get the (filename, line number, name) pstats uses for `code`."""
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class FunctionProfiler(object):
+    """Count and time the frames a VirtualMachine runs, like cProfile.
+
+    Set it as a VM's `function_profiler` before running code.  Frames are
+    grouped by their code object.  For each, it counts the calls, and the
+    time spent in the frame itself and in total, both overall and for each
+    code object that called it.  Calls that recurse are counted, but not
+    primitive, and only the outermost one's total time is counted.  As in
+    cProfile, a call from a caller only recurses if another call from the
+    same caller is running.  Each run of a generator, up to when it yields,
+    is a call.
+
+    """
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        # Maps code objects to [primitive calls, calls, time, total time,
+        # {calling code: [calls, primitive calls, time, total time]}], the
+        # orders pstats uses.
+        self.functions = {}
+        # The frames running: [code, time spent in the frames they call].
+        self._stack = []
+        # How many frames for each code object are running, and for each
+        # (calling code, code) pair.
+        self._running = {}
+        self._running_edges = {}
+
+    def run_frame(self, run, frame):
+        """Run `frame` with the function `run`, timing it."""
+        code = frame.f_code
+        stack = self._stack
+        running = self._running
+        running_edges = self._running_edges
+        caller = stack[-1][0] if stack else None
+        edge = caller, code
+        stack.append([code, 0.0])
+        running[code] = running.get(code, 0) + 1
+        running_edges[edge] = running_edges.get(edge, 0) + 1
+        start = self.timer()
+        try:
+            return run(frame)
+        finally:
+            elapsed = self.timer() - start
+            inner = stack.pop()[1]
+            running[code] -= 1
+            running_edges[edge] -= 1
+            self.record(
+                code, caller, elapsed - inner, elapsed,
+                running[code] == 0, running_edges[edge] == 0,
+            )
+            if stack:
+                stack[-1][1] += self.timer() - start
+
+    def record(self, code, caller, time, total, primitive, edge_primitive):
+        """Record one call of `code` from `caller`.
+
+        `primitive` is whether no other call of `code` is running, and
+        `edge_primitive` whether no other call of it from `caller` is.
+
+        """
+        stats = self.functions.get(code)
+        if stats is None:
+            stats = self.functions[code] = [0, 0, 0.0, 0.0, {}]
+        stats[1] += 1
+        stats[2] += time
+        if primitive:
+            stats[0] += 1
+            stats[3] += total
+        if caller is not None:
+            edge = stats[4].get(caller)
+            if edge is None:
+                edge = stats[4][caller] = [0, 0, 0.0, 0.0]
+            edge[0] += 1
+            edge[2] += time
+            if edge_primitive:
+                edge[1] += 1
+                edge[3] += total
+
+    def clear(self):
+        self.functions.clear()
+
+    def pstats(self):
+        """Return the results in the format the pstats module reads."""
+        result = {}
+        for code, (cc, nc, tt, ct, callers) in self.functions.items():
+            result[code_label(code)] = (cc, nc, tt, ct, dict(
+                (code_label(caller), tuple(edge))
+                for caller, edge in callers.items()
+            ))
+        return result
+
+    def write_pstats(self, filename):
+        """Save the results to `filename` for pstats.Stats to load."""
+        write_pstats(self.pstats(), filename)
+
+
+
+class SamplingProfiler(object):
+    """Sample the stack of interpreted frames in a VirtualMachine.
+
+    A background thread looks at `vm.frames` every `interval` seconds, and
+    counts each stack it sees, as a tuple of (filename, function, line)
+    from the outermost frame in.  The VM itself does no extra work, so this
+    is cheap enough to leave running.
+
+    Lines come from each frame's f_lasti, which only the 'dispatch' engine
+    keeps up to date as every instruction runs.  The other engines, and
+    transpiled code, only set it before calls and exceptions, so the frame
+    running when a sample is taken gets the line of its last call.  Use
+    engine='dispatch' without transpile_after for line-accurate samples.
+
+    Use start() and stop(), or use it as a context manager.
+
+    """
+    def __init__(self, vm, interval=0.005):
+        self.vm = vm
+        self.interval = interval
+        # Maps stacks to how many times they were seen.
+        self.samples = collections.Counter()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """Take one sample of the VM's stack."""
+        # Copying the list is atomic, the VM can keep running meanwhile.
+        frames = list(self.vm.frames)
+        if frames:
+            stack = tuple(
+                (f.f_code.co_filename, f.f_code.co_name, f.line_number())
+                for f in frames
+            )
+            self.samples[stack] += 1
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="byterun sampler",
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, for flame graph tools.
+
+        Each line is a stack, its frames separated by semicolons, then a
+        space and its count.
+
+        """
+        lines = []
+        for stack, count in self.samples.items():
+            frames = ";".join(
+                "%s (%s:%d)" % (function, filename, line)
+                for filename, function, line in stack
+            )
+            lines.append("%s %d\n" % (frames, count))
+        return "".join(sorted(lines))
+
+    def write_collapsed(self, filename):
+        """Save the collapsed stacks to `filename`."""
+        with open(filename, 'w') as f:
+            f.write(self.collapsed())
+
+    def top(self, n=10):
+        """Get the `n` places most often on top of the stack.
+
+        Returns a list of ((filename, function, line), count on top, count
+        anywhere on the stack), most often on top first.
+
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.samples.items():
+            own[stack[-1]] += count
+            for place in set(stack):
+                total[place] += count
+        return [
+            (place, count, total[place])
+            for place, count in own.most_common(n)
+        ]
+
+    def summary(self, n=10):
+        """Make a text table of the top `n` places."""
+        samples = sum(self.samples.values())
+        lines = ["%d samples" % samples, "  own  total  place"]
+        for (filename, function, line), own, total in self.top(n):
+            lines.append("%5.1f%% %5.1f%%  %s (%s:%d)" % (
+                100.0 * own / samples, 100.0 * total / samples,
+                function, filename, line,
+            ))
+        return "\n".join(lines) + "\n"
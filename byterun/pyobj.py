@@ -1,31 +1,272 @@
 """Implementations of Python fundamental objects for Byterun."""
 
-import collections
-import inspect
-import types
+import sys
 
 import six
 
+from .decode import LineTable
+
 PY3, PY2 = six.PY3, not six.PY3
 
+# Code flags.
+CO_OPTIMIZED = 0x0001       # locals are in fast slots, not a dict
+CO_VARARGS = 0x0004         # the code takes *args
+CO_VARKEYWORDS = 0x0008     # the code takes **kwargs
+CO_GENERATOR = 0x0020       # the code uses yield
+
+# The value of a fast local slot or cell that hasn't been assigned.
+UNBOUND = object()
+
+# Finished frames are only reused if nothing else refers to them, which only
+# implementations with reference counts can tell.
+getrefcount = getattr(sys, 'getrefcount', None)
+
+
+def unbound_local_error(frame, slot):
+    """Make the exception for reading an unassigned fast local of `frame`."""
+    return UnboundLocalError(
+        "local variable '%s' referenced before assignment" %
+        frame.f_code.co_varnames[slot]
+    )
+
+
+def unbound_cell_error(frame, index):
+    """Make the exception for reading an unassigned cell of `frame`."""
+    code = frame.f_code
+    if index < len(code.co_cellvars):
+        return UnboundLocalError(
+            "local variable '%s' referenced before assignment" %
+            code.co_cellvars[index]
+        )
+    return NameError(
+        "free variable '%s' referenced before assignment in enclosing "
+        "scope" % code.co_freevars[index - len(code.co_cellvars)]
+    )
 
-def make_cell(value):
-    # Thanks to Alex Gaynor for help with this bit of twistiness.
-    # Construct an actual cell object by creating a closure right here,
-    # and grabbing the cell object out of the function we create.
-    fn = (lambda x: lambda: x)(value)
-    if PY3:
-        return fn.__closure__[0]
-    else:
-        return fn.func_closure[0]
+
+def plural(n):
+    return "" if n == 1 else "s"
+
+
+class BindingPlan(object):
+    """How to bind call arguments to the local slots of a code object.
+
+    This is worked out once per code object, and replaces
+    inspect.getcallargs: `bind` fills a list of initial fast local values
+    directly, raising the same TypeErrors as CPython for bad calls.
+
+    """
+    __slots__ = [
+        'name', 'argcount', 'kwonlyargcount', 'varnames', 'slots',
+        'varargs_slot', 'varkw_slot', 'tail', 'simple',
+    ]
+
+    def __init__(self, code):
+        self.name = code.co_name
+        self.argcount = code.co_argcount
+        self.kwonlyargcount = getattr(code, 'co_kwonlyargcount', 0)
+        total = self.argcount + self.kwonlyargcount
+        self.varnames = code.co_varnames
+        # Maps the names that can be passed by keyword to their slots.
+        self.slots = dict(
+            (name, slot) for slot, name in enumerate(self.varnames[:total])
+        )
+        self.varargs_slot = self.varkw_slot = None
+        if code.co_flags & CO_VARARGS:
+            self.varargs_slot = total
+            total += 1
+        if code.co_flags & CO_VARKEYWORDS:
+            self.varkw_slot = total
+        # Calls to simple code with just `argcount` positional arguments
+        # need no binding beyond copying them.
+        self.simple = (
+            not self.kwonlyargcount and
+            self.varargs_slot is None and self.varkw_slot is None
+        )
+        # The other locals, unbound until the code assigns them.
+        self.tail = [UNBOUND] * (code.co_nlocals - self.argcount)
+
+    def bind(self, args, kwargs, defaults, kwdefaults=None):
+        """Return the list of initial local values for a call."""
+        if PY2:
+            return self.bind2(args, kwargs, defaults)
+        else:
+            return self.bind3(args, kwargs, defaults, kwdefaults)
+
+    def bind2(self, args, kwargs, defaults):
+        # This follows PyEval_EvalCodeEx in Python 2.7's ceval.c, so the
+        # same errors are found first.
+        argcount = self.argcount
+        nargs = len(args)
+        values = self.start_values(args)
+        if self.simple and not argcount:
+            if nargs or kwargs:
+                raise TypeError("%s() takes no arguments (%d given)" % (
+                    self.name, nargs + len(kwargs),
+                ))
+            return values
+
+        kwdict = None
+        if self.varkw_slot is not None:
+            kwdict = values[self.varkw_slot] = {}
+        n = nargs
+        if nargs > argcount:
+            if self.varargs_slot is None:
+                raise TypeError("%s() takes %s %d argument%s (%d given)" % (
+                    self.name, "at most" if defaults else "exactly",
+                    argcount, plural(argcount), nargs + len(kwargs),
+                ))
+            n = argcount
+        if self.varargs_slot is not None:
+            values[self.varargs_slot] = tuple(args[n:])
+        for key, value in kwargs.items():
+            slot = self.slots.get(key)
+            if slot is None:
+                if kwdict is None:
+                    raise TypeError(
+                        "%s() got an unexpected keyword argument '%s'" % (
+                            self.name, key,
+                        )
+                    )
+                kwdict[key] = value
+                continue
+            if values[slot] is not UNBOUND:
+                raise TypeError(
+                    "%s() got multiple values for keyword argument '%s'" % (
+                        self.name, key,
+                    )
+                )
+            values[slot] = value
+        if nargs < argcount:
+            self.fill_defaults(values, n, defaults)
+        return values
+
+    def bind3(self, args, kwargs, defaults, kwdefaults):
+        # This follows PyEval_EvalCodeEx in Python 3.3's ceval.c, so the
+        # same errors are found first.
+        argcount = self.argcount
+        nargs = len(args)
+        n = min(nargs, argcount)
+        values = self.start_values(args)
+
+        kwdict = None
+        if self.varkw_slot is not None:
+            kwdict = values[self.varkw_slot] = {}
+        if self.varargs_slot is not None:
+            values[self.varargs_slot] = tuple(args[n:])
+        for key, value in kwargs.items():
+            slot = self.slots.get(key)
+            if slot is None:
+                if kwdict is None:
+                    raise TypeError(
+                        "%s() got an unexpected keyword argument '%s'" % (
+                            self.name, key,
+                        )
+                    )
+                kwdict[key] = value
+                continue
+            if values[slot] is not UNBOUND:
+                raise TypeError(
+                    "%s() got multiple values for argument '%s'" % (
+                        self.name, key,
+                    )
+                )
+            values[slot] = value
+        if nargs > argcount and self.varargs_slot is None:
+            self.too_many_positional(values, nargs, defaults)
+        if nargs < argcount:
+            self.fill_defaults(values, n, defaults)
+        if self.kwonlyargcount:
+            missing = []
+            for slot in range(argcount, argcount + self.kwonlyargcount):
+                if values[slot] is not UNBOUND:
+                    continue
+                name = self.varnames[slot]
+                if kwdefaults and name in kwdefaults:
+                    values[slot] = kwdefaults[name]
+                else:
+                    missing.append(name)
+            if missing:
+                self.missing_arguments("keyword-only", missing)
+        return values
+
+    def start_values(self, args):
+        """Make the list of local values, with the positional arguments."""
+        n = min(len(args), self.argcount)
+        return list(args[:n]) + [UNBOUND] * (self.argcount - n) + self.tail
+
+    def fill_defaults(self, values, n, defaults):
+        """Fill in defaults for the arguments not passed, if none are
+        missing.  `n` is the number of positional arguments bound."""
+        m = self.argcount - len(defaults)
+        for slot in range(n, m):
+            if values[slot] is UNBOUND:
+                if PY2:
+                    given = sum(
+                        1 for v in values[:self.argcount] if v is not UNBOUND
+                    )
+                    raise TypeError(
+                        "%s() takes %s %d argument%s (%d given)" % (
+                            self.name,
+                            "at least"
+                            if self.varargs_slot is not None or defaults
+                            else "exactly",
+                            m, plural(m), given,
+                        )
+                    )
+                self.missing_arguments("positional", [
+                    name for name, v in zip(self.varnames[:m], values)
+                    if v is UNBOUND
+                ])
+        for i in range(max(n - m, 0), len(defaults)):
+            if values[m + i] is UNBOUND:
+                values[m + i] = defaults[i]
+
+    def missing_arguments(self, kind, names):
+        names = [repr(name) for name in names]
+        if len(names) == 1:
+            name_str = names[0]
+        elif len(names) == 2:
+            name_str = "%s and %s" % tuple(names)
+        else:
+            name_str = "%s, and %s" % (", ".join(names[:-1]), names[-1])
+        raise TypeError("%s() missing %d required %s argument%s: %s" % (
+            self.name, len(names), kind, plural(len(names)), name_str,
+        ))
+
+    def too_many_positional(self, values, given, defaults):
+        argcount = self.argcount
+        kwonly_given = sum(
+            1 for v in values[argcount:argcount + self.kwonlyargcount]
+            if v is not UNBOUND
+        )
+        if defaults:
+            sig = "from %d to %d" % (argcount - len(defaults), argcount)
+            plural_sig = "s"
+        else:
+            sig = "%d" % argcount
+            plural_sig = plural(argcount)
+        kwonly_sig = ""
+        if kwonly_given:
+            kwonly_sig = (
+                " positional argument%s (and %d keyword-only argument%s)" % (
+                    plural(given), kwonly_given, plural(kwonly_given),
+                )
+            )
+        raise TypeError(
+            "%s() takes %s positional argument%s but %d%s %s given" % (
+                self.name, sig, plural_sig, given, kwonly_sig,
+                "was" if given == 1 and not kwonly_given else "were",
+            )
+        )
 
 
 class Function(object):
     __slots__ = [
         'func_code', 'func_name', 'func_defaults', 'func_globals',
-        'func_locals', 'func_dict', 'func_closure',
+        'func_closure',
         '__name__', '__dict__', '__doc__',
-        '_vm', '_func',
+        '_vm', '_decoded',
     ]
 
     def __init__(self, name, code, globs, defaults, closure, vm):
@@ -34,18 +275,15 @@ class Function(object):
         self.func_name = self.__name__ = name or code.co_name
         self.func_defaults = tuple(defaults)
         self.func_globals = globs
-        self.func_locals = self._vm.frame.f_locals
-        self.__dict__ = {}
+        # __dict__ is left alone: it's only made when an attribute is set.
         self.func_closure = closure
         self.__doc__ = code.co_consts[0] if code.co_consts else None
+        # The DecodedCode for our code, found when we're first called.
+        self._decoded = None
 
-        # Sometimes, we need a real Python function.  This is for that.
-        kw = {
-            'argdefs': self.func_defaults,
-        }
-        if closure:
-            kw['closure'] = tuple(make_cell(0) for _ in closure)
-        self._func = types.FunctionType(code, globs, **kw)
+    @property
+    def func_dict(self):
+        return self.__dict__
 
     def __repr__(self):         # pragma: no cover
         return '<Function %s at 0x%08x>' % (
@@ -61,28 +299,61 @@ class Function(object):
             return self
 
     def __call__(self, *args, **kwargs):
-        if PY2 and self.func_name in ["<setcomp>", "<dictcomp>", "<genexpr>"]:
-            # D'oh! http://bugs.python.org/issue19611 Py2 doesn't know how to
-            # inspect set comprehensions, dict comprehensions, or generator
-            # expressions properly.  They are always functions of one argument,
-            # so just do the right thing.
-            assert len(args) == 1 and not kwargs, "Surprising comprehension!"
-            callargs = {".0": args[0]}
+        decoded = self._decoded
+        if decoded is None:
+            code = self.func_code
+            decoded = self._decoded = self._vm.decode_cache.get(code)
+            if decoded.binding is None:
+                decoded.binding = BindingPlan(code)
+        plan = decoded.binding
+        if plan.simple and not kwargs and len(args) == plan.argcount:
+            fastlocals = list(args) + plan.tail
         else:
-            callargs = inspect.getcallargs(self._func, *args, **kwargs)
-        frame = self._vm.make_frame(
-            self.func_code, callargs, self.func_globals, {}
-        )
-        CO_GENERATOR = 32           # flag for "this code uses yield"
-        if self.func_code.co_flags & CO_GENERATOR:
-            gen = Generator(frame, self._vm)
+            fastlocals = plan.bind(args, kwargs, self.func_defaults)
+        code = self.func_code
+        vm = self._vm
+        if code.co_flags & CO_OPTIMIZED:
+            frame = vm.spare_frames.pop(decoded, None)
+            if frame is None:
+                frame = vm.make_frame(
+                    code, f_globals=self.func_globals, fastlocals=fastlocals,
+                    closure=self.func_closure,
+                )
+            else:
+                frame.reuse(self.func_globals, vm.frame, fastlocals)
+        else:
+            # Class bodies, and Python 2 functions using exec, keep their
+            # locals in a dict.
+            callargs = dict(
+                (name, val) for name, val in zip(code.co_varnames, fastlocals)
+                if val is not UNBOUND
+            )
+            frame = vm.make_frame(
+                code, callargs, self.func_globals, {},
+                closure=self.func_closure,
+            )
+        frame.decoded = decoded
+        if not vm.optimize:
+            frame.instructions = decoded.fused
+        if vm.use_block_tables:
+            frame.block_table = decoded.block_table
+        if code.co_flags & CO_GENERATOR:
+            gen = Generator(frame, vm)
             frame.generator = gen
             retval = gen
         else:
-            retval = self._vm.run_frame(frame)
+            retval = vm.run_frame(frame)
+            # Keep the frame to reuse for the next call of the code, if
+            # nothing else has it.
+            if getrefcount is not None and getrefcount(frame) == 2 and (
+                frame.retire()
+            ):
+                vm.spare_frames[decoded] = frame
         return retval
 
 class Method(object):
+    __slots__ = ['im_self', 'im_class', 'im_func', '__weakref__']
+
     def __init__(self, obj, _class, func):
         self.im_self = obj
         self.im_class = _class
@@ -106,104 +377,191 @@ class Cell(object):
     """A fake cell for closures.
 
     Closures keep names in scope by storing them not in a frame, but in a
-    separate object called a cell.  Frames share references to cells, and
-    the LOAD_DEREF and STORE_DEREF opcodes get and set the value from cells.
+    separate object called a cell.  A frame's cells are a list indexed like
+    co_cellvars + co_freevars: its own, then those of its function's
+    closure, which came from the frame that made the function.  The
+    LOAD_DEREF and STORE_DEREF opcodes get and set the value from cells.
 
-    This class acts as a cell, though it has to jump through two hoops to make
-    the simulation complete:
-
-        1. In order to create actual FunctionType functions, we have to have
-           actual cell objects, which are difficult to make. See the twisty
-           double-lambda in __init__.
-
-        2. Actual cell objects can't be modified, so to implement STORE_DEREF,
-           we store a one-element list in our cell, and then use [0] as the
-           actual value.
+    A Cell just holds its value in `contents`, which is UNBOUND until the
+    variable is assigned.  The opcodes use it directly.
 
     """
-    def __init__(self, value):
-        self.contents = value
+    __slots__ = ['contents']
 
-    def get(self):
-        return self.contents
-
-    def set(self, value):
+    def __init__(self, value):
         self.contents = value
 
 
-Block = collections.namedtuple("Block", "type, handler, level")
+def find_builtins(f_globals, f_back):
+    """Find the builtins dict for a frame with globals `f_globals`."""
+    if f_back and f_back.f_globals is f_globals:
+        # If we share the globals, we share the builtins.
+        return f_back.f_builtins
+    try:
+        f_builtins = f_globals['__builtins__']
+    except KeyError:
+        # No builtins! Make up a minimal one with None.
+        return {'None': None}
+    if hasattr(f_builtins, '__dict__'):
+        f_builtins = f_builtins.__dict__
+    return f_builtins
 
 
 class Frame(object):
-    def __init__(self, f_code, f_globals, f_locals, f_back):
+    # Function frames don't set f_locals: see __getattr__.
+    __slots__ = [
+        'f_code', 'f_globals', 'f_locals', 'f_builtins', 'f_back', 'f_lineno',
+        'f_lasti', 'f_trace', 'fastlocals', '_locals_dict', 'stack',
+        'stacktop', 'decoded', 'instructions', 'cells', 'block_stack',
+        'block_table', 'generator',
+    ]
+
+    def __init__(
+        self, f_code, f_globals, f_locals, f_back, fastlocals=None,
+        closure=None,
+    ):
         self.f_code = f_code
         self.f_globals = f_globals
-        self.f_locals = f_locals
-        self.f_back = f_back
-        self.stack = []
-        if f_back and f_back.f_globals is f_globals:
-            # If we share the globals, we share the builtins.
-            self.f_builtins = f_back.f_builtins
+        if f_code.co_flags & CO_OPTIMIZED:
+            # Function frames keep their locals in a list indexed like
+            # co_varnames.  The initial values are `fastlocals` if given,
+            # or else come from `f_locals`.  The f_locals dict is only made
+            # if asked for, see __getattr__.
+            if fastlocals is None:
+                fastlocals = [
+                    f_locals.get(name, UNBOUND) for name in f_code.co_varnames
+                ]
+            self.fastlocals = fastlocals
+            self._locals_dict = None
         else:
-            try:
-                self.f_builtins = f_globals['__builtins__']
-                if hasattr(self.f_builtins, '__dict__'):
-                    self.f_builtins = self.f_builtins.__dict__
-            except KeyError:
-                # No builtins! Make up a minimal one with None.
-                self.f_builtins = {'None': None}
+            self.fastlocals = None
+            self.f_locals = f_locals
+        self.f_back = f_back
+        # The value stack, preallocated: stacktop is how much is in use.
+        self.stack = [None] * f_code.co_stacksize
+        self.stacktop = 0
+        self.f_builtins = find_builtins(f_globals, f_back)
 
         self.f_lineno = f_code.co_firstlineno
         self.f_lasti = 0
-
-        if f_code.co_cellvars:
-            self.cells = {}
-            if not f_back.cells:
-                f_back.cells = {}
+        # The DecodedCode and its instructions, filled in when the frame
+        # first runs.
+        self.decoded = None
+        self.instructions = None
+
+        if f_code.co_cellvars or f_code.co_freevars:
+            # The cells, indexed like co_cellvars + co_freevars: new ones for
+            # our cell variables, then those of the function's closure for
+            # its free variables.
+            cells = []
             for var in f_code.co_cellvars:
-                # Make a cell for the variable in our locals, or None.
-                cell = Cell(self.f_locals.get(var))
-                f_back.cells[var] = self.cells[var] = cell
+                # Make a cell for the variable in our locals, or UNBOUND.
+                if fastlocals is not None:
+                    value = UNBOUND
+                    if var in f_code.co_varnames:
+                        value = fastlocals[f_code.co_varnames.index(var)]
+                else:
+                    value = f_locals.get(var, UNBOUND)
+                cells.append(Cell(value))
+            if f_code.co_freevars:
+                assert len(closure) == len(f_code.co_freevars), (
+                    "closure: %r" % (closure,)
+                )
+                cells.extend(closure)
+            self.cells = cells
         else:
             self.cells = None
 
-        if f_code.co_freevars:
-            if not self.cells:
-                self.cells = {}
-            for var in f_code.co_freevars:
-                assert self.cells is not None
-                assert f_back.cells, "f_back.cells: %r" % (f_back.cells,)
-                self.cells[var] = f_back.cells[var]
-
         self.block_stack = []
+        # The blocks.block_table of the code, if the VM uses it instead of
+        # pushing and popping blocks on block_stack.
+        self.block_table = None
         self.generator = None
+        # The local trace function, see VirtualMachine.settrace.
+        self.f_trace = None
+
+    def reuse(self, f_globals, f_back, fastlocals):
+        """Set up a retired frame to run its code again, as a new frame.
+
+        Only function frames without cells are retired, so only the
+        attributes a call sets up need setting again.
+
+        """
+        self.f_globals = f_globals
+        self.fastlocals = fastlocals
+        self.f_back = f_back
+        self.f_builtins = find_builtins(f_globals, f_back)
+        self.f_lineno = self.f_code.co_firstlineno
+        self.f_lasti = 0
+
+    def retire(self):
+        """Drop what a finished frame refers to, so it can be reused.
+
+        Returns False if the frame can't be reused.  The stacks of a frame
+        that returned normally are empty.
+
+        """
+        if self.cells is not None or self.fastlocals is None or (
+            self.stacktop or self.block_stack or self.generator is not None
+        ):
+            return False
+        self.f_globals = self.f_builtins = self.f_back = None
+        self.fastlocals = self._locals_dict = self.f_trace = None
+        self.instructions = self.block_table = None
+        return True
 
     def __repr__(self):         # pragma: no cover
         return '<Frame at 0x%08x: %r @ %d>' % (
             id(self), self.f_code.co_filename, self.f_lineno
         )
 
+    def __getattr__(self, name):
+        # Only called for attributes we don't have: function frames don't
+        # have f_locals until someone asks.
+        if name == 'f_locals' and self.fastlocals is not None:
+            return self.fast_to_locals()
+        raise AttributeError(name)
+
+    def fast_to_locals(self):
+        """Update and return the dict of a function frame's local variables.
+
+        Like CPython, the same dict is returned each time, refreshed from the
+        fast locals and cells.  Changing it doesn't change the variables.
+
+        """
+        if self._locals_dict is None:
+            self._locals_dict = {}
+        locals_dict = self._locals_dict
+        code = self.f_code
+        for name, val in zip(code.co_varnames, self.fastlocals):
+            if val is UNBOUND:
+                locals_dict.pop(name, None)
+            else:
+                locals_dict[name] = val
+        if self.cells:
+            names = code.co_cellvars + code.co_freevars
+            for name, cell in zip(names, self.cells):
+                val = cell.contents
+                if val is UNBOUND:
+                    locals_dict.pop(name, None)
+                else:
+                    locals_dict[name] = val
+        return locals_dict
+
     def line_number(self):
         """Get the current line number the frame is executing."""
         # We don't keep f_lineno up to date, so calculate it based on the
         # instruction address and the line number table.
-        lnotab = self.f_code.co_lnotab
-        byte_increments = six.iterbytes(lnotab[0::2])
-        line_increments = six.iterbytes(lnotab[1::2])
-
-        byte_num = 0
-        line_num = self.f_code.co_firstlineno
-
-        for byte_incr, line_incr in zip(byte_increments, line_increments):
-            byte_num += byte_incr
-            if byte_num > self.f_lasti:
-                break
-            line_num += line_incr
-
-        return line_num
+        if self.decoded is None:
+            lines = LineTable(self.f_code)
+        else:
+            lines = self.decoded.lines
+        return lines.line_number(self.f_lasti)
 
 
 class Generator(object):
+    __slots__ = ['gi_frame', 'vm', 'started', 'finished', '__weakref__']
+
     def __init__(self, g_frame, vm):
         self.gi_frame = g_frame
         self.vm = vm
@@ -219,7 +577,11 @@ class Generator(object):
     def send(self, value=None):
         if not self.started and value is not None:
             raise TypeError("Can't send non-None value to a just-started generator")
-        self.gi_frame.stack.append(value)
+        if self.started:
+            # The value of the yield expression the frame is paused at.
+            frame = self.gi_frame
+            frame.stack[frame.stacktop] = value
+            frame.stacktop += 1
         self.started = True
         val = self.vm.resume_frame(self.gi_frame)
         if self.finished:
@@ -5,25 +5,34 @@
 from __future__ import print_function, division
 import dis
 import inspect
+import itertools
 import linecache
 import logging
 import operator
 import sys
+import types
 
 import six
-from six.moves import reprlib
+from six.moves import builtins, reprlib
 
 PY3, PY2 = six.PY3, not six.PY3
 
-from .pyobj import Frame, Block, Method, Function, Generator
+from .decode import (
+    SUPERINSTRUCTIONS, UNCACHED, decode_cache, fuse_instructions,
+    method_is_current, opmap, opname, reset_attr_caches,
+)
+from . import closures, peephole, transpile
+from .blocks import (
+    BLOCK_OPCODES, Block, WHY_BREAK, WHY_CONTINUE, WHY_EXCEPTION, WHY_RERAISE,
+    WHY_RETURN, WHY_SILENCED, WHY_YIELD,
+)
+from .pyobj import (
+    Frame, Method, Function, Generator, UNBOUND, unbound_cell_error,
+    unbound_local_error,
+)
 
 log = logging.getLogger(__name__)
 
-if six.PY3:
-    byteint = lambda b: b
-else:
-    byteint = ord
-
 # Create a repr that won't overflow.
 repr_obj = reprlib.Repr()
 repr_obj.maxother = 120
@@ -35,18 +44,384 @@ class VirtualMachineError(Exception):
     pass
 
 
+class NoneTuples(dict):
+    """Tuples of Nones, by length, for clearing stack slots.
+
+    Assigning one of these to a slice of the stack clears it without
+    allocating anything.
+
+    """
+    def __missing__(self, n):
+        nones = self[n] = (None,) * n
+        return nones
+
+NONES = NoneTuples()
+
+
+# Opcode numbers run_frame_inline compares against.  Opcodes that don't exist
+# in this version of Python get -1, which never matches.
+def _opcode(name):
+    return opmap.get(name, -1)
+
+LOAD_FAST = _opcode('LOAD_FAST')
+STORE_FAST = _opcode('STORE_FAST')
+LOAD_DEREF = _opcode('LOAD_DEREF')
+STORE_DEREF = _opcode('STORE_DEREF')
+LOAD_CONST = _opcode('LOAD_CONST')
+LOAD_GLOBAL = _opcode('LOAD_GLOBAL')
+LOAD_NAME = _opcode('LOAD_NAME')
+STORE_NAME = _opcode('STORE_NAME')
+LOAD_ATTR = _opcode('LOAD_ATTR')
+STORE_ATTR = _opcode('STORE_ATTR')
+COMPARE_OP = _opcode('COMPARE_OP')
+POP_TOP = _opcode('POP_TOP')
+POP_JUMP_IF_FALSE = _opcode('POP_JUMP_IF_FALSE')
+POP_JUMP_IF_TRUE = _opcode('POP_JUMP_IF_TRUE')
+JUMP_ABSOLUTE = _opcode('JUMP_ABSOLUTE')
+JUMP_FORWARD = _opcode('JUMP_FORWARD')
+JUMP_IF_FALSE_OR_POP = _opcode('JUMP_IF_FALSE_OR_POP')
+JUMP_IF_TRUE_OR_POP = _opcode('JUMP_IF_TRUE_OR_POP')
+GET_ITER = _opcode('GET_ITER')
+FOR_ITER = _opcode('FOR_ITER')
+CALL_FUNCTION = _opcode('CALL_FUNCTION')
+RETURN_VALUE = _opcode('RETURN_VALUE')
+LOAD_FAST__LOAD_FAST = _opcode('LOAD_FAST__LOAD_FAST')
+LOAD_FAST__LOAD_ATTR = _opcode('LOAD_FAST__LOAD_ATTR')
+COMPARE_OP__POP_JUMP_IF_FALSE = _opcode('COMPARE_OP__POP_JUMP_IF_FALSE')
+LOAD_CONST__RETURN_VALUE = _opcode('LOAD_CONST__RETURN_VALUE')
+FOR_ITER__STORE_FAST = _opcode('FOR_ITER__STORE_FAST')
+
+# The kind run_frame_inline uses for binary and in-place operators.
+BINARY_OPERATOR = -2
+# The kind for the opcodes frames with a block table skip.
+BLOCK = -3
+
+
+def unary_handler(fn):
+    """Make an opcode handler applying `fn` to the top of the stack."""
+    def handler(vm):
+        vm.push(fn(vm.pop()))
+    return handler
+
+
+def binary_handler(fn):
+    """Make an opcode handler applying `fn` to the top two stack values."""
+    def handler(vm):
+        x, y = vm.popn(2)
+        vm.push(fn(x, y))
+    return handler
+
+
+def slice_handler(op, count):
+    """Make an opcode handler for the Py2 slice opcode `op`+`count`."""
+    def handler(vm):
+        start = 0
+        end = None          # we will take this to mean end
+        if count == 1:
+            start = vm.pop()
+        elif count == 2:
+            end = vm.pop()
+        elif count == 3:
+            end = vm.pop()
+            start = vm.pop()
+        l = vm.pop()
+        if end is None:
+            end = len(l)
+        if op == 'STORE_SLICE':
+            l[start:end] = vm.pop()
+        elif op == 'DELETE_SLICE':
+            del l[start:end]
+        else:
+            vm.push(l[start:end])
+    return handler
+
+
+def pair_handler(first, second, nargs):
+    """Make a superinstruction handler that calls the handlers of its parts.
+
+    `first` takes the first `nargs` arguments, `second` takes the rest but
+    the last, which is the offset after the pair.
+
+    """
+    def handler(vm, *args):
+        frame = vm.frame
+        resume = frame.f_lasti
+        why = first(vm, *args[:nargs])
+        if why or frame.f_lasti != resume:
+            # The first instruction ended or jumped: skip the second.
+            return why
+        frame.f_lasti = args[-1]
+        return second(vm, *args[nargs:-1])
+    return handler
+
+
+def interpreted_method(obj, name):
+    """Find the Function that getting `name` from `obj` binds as a method.
+
+    Returns None unless the lookup depends only on the type of `obj`: its
+    attribute access is the standard one, it has a dict, and `name` is a
+    Function found in its class.  Otherwise returns a tuple of the
+    Function, the dict of the class it was found in, the dicts of the
+    classes before that one in the MRO, and the MRO itself, for
+    method_is_current.  The instance's dict can still hide the Function, so
+    that has to be checked on each lookup too.
+
+    """
+    cls = type(obj)
+    if PY2 and cls is types.InstanceType:
+        # Old-style instances all have the same type.
+        return None
+    if cls.__getattribute__ is not object.__getattribute__:
+        return None
+    if not isinstance(getattr(obj, '__dict__', None), dict):
+        return None
+    before = []
+    for klass in cls.__mro__:
+        namespace = klass.__dict__
+        if name in namespace:
+            found = namespace[name]
+            if type(found) is Function:
+                return found, namespace, tuple(before), cls.__mro__
+            return None
+        before.append(namespace)
+    return None
+
+
+def hit_stats(hits, misses):
+    """Make the dict of counters a VM reports for one kind of cache."""
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / lookups if lookups else 0.0,
+    }
+
+
+# How many types an attribute cache remembers.
+ATTR_CACHE_TYPES = 4
+
+
+def unknown_handler(byteName):
+    """Make an opcode handler for an opcode we don't implement."""
+    def handler(vm, *args):     # pragma: no cover
+        raise VirtualMachineError("unknown bytecode type: %s" % byteName)
+    return handler
+
+
 class VirtualMachine(object):
-    def __init__(self):
+    # The ways frames can be run.  Each is a run_frame_* method.
+    ENGINES = ('dispatch', 'inline', 'closure')
+
+    def __init__(
+        self, decode_cache=decode_cache, engine='dispatch', optimize=False,
+        transpile_after=None,
+    ):
         # The call stack of frames.
         self.frames = []
         # The current frame.
         self.frame = None
         self.return_value = None
         self.last_exception = None
+        # Where decoded instructions are kept, shared between frames.
+        self.decode_cache = decode_cache
+        # The opcode handlers, bound to this VM, indexed by opcode.
+        cls = type(self)
+        self.dispatch_table = [
+            fn.__get__(self, cls) for fn in cls.dispatch_functions()
+        ]
+        if engine not in self.ENGINES:
+            raise ValueError("Unknown engine: %r" % (engine,))
+        self.engine = engine
+        self._run_frame = getattr(self, 'run_frame_%s' % engine)
+        # Whether the engines run code rewritten by peephole.optimize.
+        self.optimize = optimize
+        # How many times a function's code runs in the engine before it is
+        # transpiled to Python source and run natively, or None to never.
+        self.transpile_after = transpile_after
+        # Whether frames find their blocks in a blocks.block_table.
+        self.use_block_tables = cls.uses_block_tables()
+        # A finished function frame for each DecodedCode, to reuse for the
+        # next call instead of making a new one.  See Frame.retire.
+        self.spare_frames = {}
+        # How often attributes were found in the attribute caches, or not.
+        self.attr_cache_hits = 0
+        self.attr_cache_misses = 0
+        # The trace function set with settrace().
+        self.tracefunc = None
+        # A profiling.OpcodeProfiler to time each instruction with, if any.
+        self.opcode_profiler = None
+        # A profiling.FunctionProfiler to time each frame with, if any.
+        self.function_profiler = None
+
+    @classmethod
+    def dispatch_functions(cls):
+        """Get the unbound opcode handlers for this class, indexed by opcode.
+
+        The list is built once per class.  A `byte_*` method defined on the
+        class or any base is used for its opcode, otherwise operator opcodes
+        are handled by the functions in the `*_OPERATORS` tables.
+
+        If a subclass overrides the handler for either half of a
+        superinstruction, but not the superinstruction itself, the
+        superinstruction calls the two handlers instead.
+
+        """
+        functions = cls.__dict__.get('_dispatch_functions')
+        if functions is None:
+            functions = [cls.find_handler(name) for name in opname]
+            if cls is not VirtualMachine:
+                base_functions = VirtualMachine.dispatch_functions()
+                for first, second in SUPERINSTRUCTIONS:
+                    op = opmap['%s__%s' % (first, second)]
+                    first, second = opmap[first], opmap[second]
+                    if functions[op] is base_functions[op] and (
+                        functions[first] is not base_functions[first] or
+                        functions[second] is not base_functions[second]
+                    ):
+                        nargs = 1 if first >= dis.HAVE_ARGUMENT else 0
+                        functions[op] = pair_handler(
+                            functions[first], functions[second], nargs
+                        )
+            cls._dispatch_functions = functions
+        return functions
+
+    @classmethod
+    def find_handler(cls, byteName):
+        """Find the unbound handler function for the opcode `byteName`."""
+        method = getattr(cls, 'byte_%s' % byteName, None)
+        if method is not None:
+            return six.get_unbound_function(method)
+        prefix, _, op = byteName.partition('_')
+        if prefix == 'UNARY' and op in cls.UNARY_OPERATORS:
+            handler = unary_handler(cls.UNARY_OPERATORS[op])
+        elif prefix == 'BINARY' and op in cls.BINARY_OPERATORS:
+            handler = binary_handler(cls.BINARY_OPERATORS[op])
+        elif prefix == 'INPLACE' and op in cls.INPLACE_OPERATORS:
+            handler = binary_handler(cls.INPLACE_OPERATORS[op])
+        elif 'SLICE+' in byteName:
+            op, count = byteName.split('+')
+            handler = slice_handler(op, int(count))
+        else:
+            handler = unknown_handler(byteName)
+        # Name it like the method it stands in for, for profiles and logs.
+        handler.__name__ = str('byte_%s' % byteName.replace('+', '_'))
+        return handler
+
+    # The opcodes run_frame_inline executes itself, without calling their
+    # byte_* methods.  Binary and in-place operators are also executed inline.
+    INLINE_OPCODES = [
+        'LOAD_FAST', 'STORE_FAST', 'LOAD_CONST', 'LOAD_GLOBAL', 'LOAD_NAME',
+        'STORE_NAME', 'LOAD_ATTR', 'STORE_ATTR', 'COMPARE_OP', 'POP_TOP',
+        'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE', 'JUMP_ABSOLUTE',
+        'JUMP_FORWARD', 'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP',
+        'GET_ITER', 'FOR_ITER', 'CALL_FUNCTION', 'RETURN_VALUE', 'LOAD_DEREF',
+        'STORE_DEREF',
+    ] + ['%s__%s' % pair for pair in SUPERINSTRUCTIONS]
+
+    @classmethod
+    def inline_tables(cls):
+        """Get the tables run_frame_inline uses for this class.
+
+        Returns two lists indexed by opcode.  The first gives the kind of
+        inline code to run: the opcode itself, BINARY_OPERATOR, BLOCK, or None
+        to call the handler.  Opcodes whose handler a subclass overrides are
+        always called.  The second gives the operator function for binary
+        and in-place opcodes.
+
+        """
+        tables = cls.__dict__.get('_inline_tables')
+        if tables is None:
+            functions = cls.dispatch_functions()
+            base_functions = VirtualMachine.dispatch_functions()
+            kinds = [None] * len(opname)
+            operators = [None] * len(opname)
+            for name in cls.INLINE_OPCODES:
+                op = opmap.get(name)
+                if op is not None and functions[op] is base_functions[op]:
+                    kinds[op] = op
+            if cls.uses_block_tables():
+                for op in BLOCK_OPCODES:
+                    kinds[op] = BLOCK
+            for byteName, op in dis.opmap.items():
+                if hasattr(cls, 'byte_%s' % byteName):
+                    continue
+                prefix, _, name = byteName.partition('_')
+                if prefix == 'BINARY':
+                    fn = cls.BINARY_OPERATORS.get(name)
+                elif prefix == 'INPLACE':
+                    fn = cls.INPLACE_OPERATORS.get(name)
+                else:
+                    fn = None
+                if fn is not None:
+                    kinds[op] = BINARY_OPERATOR
+                    operators[op] = fn
+            tables = cls._inline_tables = (kinds, operators)
+        return tables
+
+    @classmethod
+    def closure_tables(cls):
+        """Get the tables of closure makers closures.ClosureCode uses.
+
+        See closures.make_tables.  The tables are made once per class.
+
+        """
+        tables = cls.__dict__.get('_closure_tables')
+        if tables is None:
+            _, operators = cls.inline_tables()
+            operators = list(operators)
+            for name, fn in cls.UNARY_OPERATORS.items():
+                byteName = 'UNARY_%s' % name
+                if byteName in opmap and not hasattr(cls, 'byte_' + byteName):
+                    operators[opmap[byteName]] = fn
+            tables = cls._closure_tables = closures.make_tables(
+                cls.dispatch_functions(), VirtualMachine.dispatch_functions(),
+                operators, cls.COMPARE_OPERATORS,
+            )
+        return tables
+
+    @classmethod
+    def transpile_opcodes(cls):
+        """Get the set of opcodes transpile.transpile can do for this class.
+
+        See transpile.transpilable_opcodes.  The set is made once per class.
+
+        """
+        opcodes = cls.__dict__.get('_transpile_opcodes')
+        if opcodes is None:
+            opcodes = cls._transpile_opcodes = transpile.transpilable_opcodes(
+                cls, VirtualMachine,
+            )
+        return opcodes
+
+    # The handlers that push and pop blocks.  Frames of classes that don't
+    # change them use the block tables made when decoding, and don't push or
+    # pop blocks at all, see blocks.block_table.
+    BLOCK_HANDLERS = [
+        'SETUP_LOOP', 'SETUP_EXCEPT', 'SETUP_FINALLY', 'SETUP_WITH',
+        'POP_BLOCK',
+    ]
+
+    @classmethod
+    def uses_block_tables(cls):
+        """Do frames run by this class use block tables?"""
+        uses = cls.__dict__.get('_uses_block_tables')
+        if uses is None:
+            functions = cls.dispatch_functions()
+            base_functions = VirtualMachine.dispatch_functions()
+            uses = cls._uses_block_tables = all(
+                functions[opmap[name]] is base_functions[opmap[name]]
+                for name in cls.BLOCK_HANDLERS if name in opmap
+            )
+        return uses
+
+    # The value stack of a frame is a list preallocated to the code's
+    # co_stacksize.  frame.stacktop is the number of values on it, and the
+    # slots above that hold None.
 
     def top(self):
         """Return the value at the top of the stack, with no changes."""
-        return self.frame.stack[-1]
+        frame = self.frame
+        return frame.stack[frame.stacktop-1]
 
     def pop(self, i=0):
         """Pop a value from the stack.
@@ -55,11 +430,22 @@ class VirtualMachine(object):
         instead.
 
         """
-        return self.frame.stack.pop(-1-i)
+        frame = self.frame
+        stack = frame.stack
+        top = frame.stacktop - 1
+        val = stack[top-i]
+        if i:
+            stack[top-i:top] = stack[top-i+1:top+1]
+        stack[top] = None
+        frame.stacktop = top
+        return val
 
     def push(self, *vals):
         """Push values onto the value stack."""
-        self.frame.stack.extend(vals)
+        frame = self.frame
+        top = frame.stacktop
+        frame.stacktop = top + len(vals)
+        frame.stack[top:frame.stacktop] = vals
 
     def popn(self, n):
         """Pop a number of values from the value stack.
@@ -67,16 +453,18 @@ class VirtualMachine(object):
         A list of `n` values is returned, the deepest value first.
 
         """
-        if n:
-            ret = self.frame.stack[-n:]
-            self.frame.stack[-n:] = []
-            return ret
-        else:
-            return []
+        frame = self.frame
+        stack = frame.stack
+        top = frame.stacktop
+        ret = stack[top-n:top]
+        stack[top-n:top] = NONES[n]
+        frame.stacktop = top - n
+        return ret
 
     def peek(self, n):
         """Get a value `n` entries down in the stack, without changing the stack."""
-        return self.frame.stack[-n]
+        frame = self.frame
+        return frame.stack[frame.stacktop-n]
 
     def jump(self, jump):
         """Move the bytecode pointer to `jump`, so it will execute next."""
@@ -84,14 +472,20 @@ class VirtualMachine(object):
 
     def push_block(self, type, handler=None, level=None):
         if level is None:
-            level = len(self.frame.stack)
+            level = self.frame.stacktop
         self.frame.block_stack.append(Block(type, handler, level))
 
     def pop_block(self):
         return self.frame.block_stack.pop()
 
-    def make_frame(self, code, callargs={}, f_globals=None, f_locals=None):
-        log.info("make_frame: code=%r, callargs=%s" % (code, repper(callargs)))
+    def make_frame(
+        self, code, callargs={}, f_globals=None, f_locals=None, fastlocals=None,
+        closure=None,
+    ):
+        if log.isEnabledFor(logging.INFO):
+            log.info(
+                "make_frame: code=%r, callargs=%s" % (code, repper(callargs))
+            )
         if f_globals is not None:
             f_globals = f_globals
             if f_locals is None:
@@ -106,8 +500,11 @@ class VirtualMachine(object):
                 '__doc__': None,
                 '__package__': None,
             }
-        f_locals.update(callargs)
-        frame = Frame(code, f_globals, f_locals, self.frame)
+        if callargs:
+            f_locals.update(callargs)
+        frame = Frame(
+            code, f_globals, f_locals, self.frame, fastlocals, closure,
+        )
         return frame
 
     def push_frame(self, frame):
@@ -121,6 +518,22 @@ class VirtualMachine(object):
         else:
             self.frame = None
 
+    def decode_frame(self, frame):
+        """Give `frame` the decoded form of its code, and what engines run."""
+        decoded = frame.decoded
+        if decoded is None:
+            decoded = frame.decoded = self.decode_cache.get(frame.f_code)
+        if self.use_block_tables:
+            frame.block_table = decoded.block_table
+        if self.optimize:
+            if decoded.optimized is None:
+                decoded.optimized = fuse_instructions(
+                    peephole.optimize(decoded.instructions)
+                )
+            frame.instructions = decoded.optimized
+        else:
+            frame.instructions = decoded.fused
+
     def print_frames(self):
         """Print the call stack, for debugging."""
         for f in self.frames:
@@ -146,8 +559,11 @@ class VirtualMachine(object):
         # Check some invariants
         if self.frames:            # pragma: no cover
             raise VirtualMachineError("Frames left over!")
-        if self.frame and self.frame.stack:             # pragma: no cover
-            raise VirtualMachineError("Data left on stack! %r" % self.frame.stack)
+        if self.frame and self.frame.stacktop:          # pragma: no cover
+            raise VirtualMachineError(
+                "Data left on stack! %r" %
+                self.frame.stack[:self.frame.stacktop]
+            )
 
         return val
 
@@ -157,48 +573,23 @@ class VirtualMachine(object):
         else:
             offset = 0
 
-        while len(self.frame.stack) > block.level + offset:
-            self.pop()
+        frame = self.frame
+        level = block.level + offset
+        if frame.stacktop > level:
+            frame.stack[level:frame.stacktop] = NONES[frame.stacktop - level]
+            frame.stacktop = level
 
         if block.type == 'except-handler':
             tb, value, exctype = self.popn(3)
             self.last_exception = exctype, value, tb
 
     def parse_byte_and_args(self):
-        """ Parse 1 - 3 bytes of bytecode into
-        an instruction and optionally arguments."""
+        """Get the next instruction from the frame's decoded instructions,
+        and advance past it."""
         f = self.frame
         opoffset = f.f_lasti
-        byteCode = byteint(f.f_code.co_code[opoffset])
-        f.f_lasti += 1
-        byteName = dis.opname[byteCode]
-        arg = None
-        arguments = []
-        if byteCode >= dis.HAVE_ARGUMENT:
-            arg = f.f_code.co_code[f.f_lasti:f.f_lasti+2]
-            f.f_lasti += 2
-            intArg = byteint(arg[0]) + (byteint(arg[1]) << 8)
-            if byteCode in dis.hasconst:
-                arg = f.f_code.co_consts[intArg]
-            elif byteCode in dis.hasfree:
-                if intArg < len(f.f_code.co_cellvars):
-                    arg = f.f_code.co_cellvars[intArg]
-                else:
-                    var_idx = intArg - len(f.f_code.co_cellvars)
-                    arg = f.f_code.co_freevars[var_idx]
-            elif byteCode in dis.hasname:
-                arg = f.f_code.co_names[intArg]
-            elif byteCode in dis.hasjrel:
-                arg = f.f_lasti + intArg
-            elif byteCode in dis.hasjabs:
-                arg = intArg
-            elif byteCode in dis.haslocal:
-                arg = f.f_code.co_varnames[intArg]
-            else:
-                arg = intArg
-            arguments = [arg]
-
-        return byteName, arguments, opoffset
+        byteCode, arguments, f.f_lasti = f.instructions[opoffset]
+        return byteCode, arguments, opoffset
 
     def log(self, byteName, arguments, opoffset):
         """ Log arguments, block stack, and data stack for each opcode."""
@@ -206,51 +597,62 @@ class VirtualMachine(object):
         if arguments:
             op += " %r" % (arguments[0],)
         indent = "    "*(len(self.frames)-1)
-        stack_rep = repper(self.frame.stack)
-        block_stack_rep = repper(self.frame.block_stack)
+        stack_rep = repper(self.frame.stack[:self.frame.stacktop])
+        if self.frame.block_table is None:
+            block_stack_rep = repper(self.frame.block_stack)
+        else:
+            block_stack_rep = repper(self.frame.block_table[opoffset])
 
         log.info("  %sdata: %s" % (indent, stack_rep))
         log.info("  %sblks: %s" % (indent, block_stack_rep))
         log.info("%s%s" % (indent, op))
 
-    def dispatch(self, byteName, arguments):
-        """ Dispatch by bytename to the corresponding methods.
+    def dispatch(self, byteCode, arguments):
+        """ Dispatch by opcode to the corresponding handler.
         Exceptions are caught and set on the virtual machine."""
-        why = None
         try:
-            if byteName.startswith('UNARY_'):
-                self.unaryOperator(byteName[6:])
-            elif byteName.startswith('BINARY_'):
-                self.binaryOperator(byteName[7:])
-            elif byteName.startswith('INPLACE_'):
-                self.inplaceOperator(byteName[8:])
-            elif 'SLICE+' in byteName:
-                self.sliceOperator(byteName)
-            else:
-                # dispatch
-                bytecode_fn = getattr(self, 'byte_%s' % byteName, None)
-                if not bytecode_fn:            # pragma: no cover
-                    raise VirtualMachineError(
-                        "unknown bytecode type: %s" % byteName
-                    )
-                why = bytecode_fn(*arguments)
-
+            return self.dispatch_table[byteCode](*arguments)
         except:
             # deal with exceptions encountered while executing the op.
             self.last_exception = sys.exc_info()[:2] + (None,)
             log.exception("Caught exception during execution")
-            why = 'exception'
+            return WHY_EXCEPTION
 
+    def unwind_blocks(self, why):
+        """Unwind the frame's blocks for `why`, until one deals with it.
+
+        Returns the why left over, if no block dealt with it: the engines
+        call this for any true why, and stop running the frame if it returns
+        one.  A yield leaves the blocks alone, and a re-raise unwinds as an
+        exception.  Frames with a block table get their block stack from it
+        first, for wherever execution would go on, and leave it empty again.
+
+        """
+        if why == WHY_YIELD:
+            return why
+        if why == WHY_RERAISE:
+            why = WHY_EXCEPTION
+        frame = self.frame
+        table = frame.block_table
+        if table is not None:
+            blocks = table[frame.f_lasti]
+            if not blocks:
+                return why
+            frame.block_stack = list(blocks)
+        while why and frame.block_stack:
+            why = self.manage_block_stack(why)
+        if table is not None:
+            frame.block_stack = []
         return why
 
     def manage_block_stack(self, why):
         """ Manage a frame's block stack.
         Manipulate the block stack and data stack for looping,
         exception handling, or returning."""
-        assert why != 'yield'
+        assert why != WHY_YIELD
 
         block = self.frame.block_stack[-1]
-        if block.type == 'loop' and why == 'continue':
+        if block.type == 'loop' and why == WHY_CONTINUE:
             self.jump(self.return_value)
             why = None
             return why
@@ -258,7 +660,7 @@ class VirtualMachine(object):
         self.pop_block()
         self.unwind_block(block)
 
-        if block.type == 'loop' and why == 'break':
+        if block.type == 'loop' and why == WHY_BREAK:
             why = None
             self.jump(block.handler)
             return why
@@ -266,14 +668,14 @@ class VirtualMachine(object):
         if PY2:
             if (
                 block.type == 'finally' or
-                (block.type == 'setup-except' and why == 'exception') or
+                (block.type == 'setup-except' and why == WHY_EXCEPTION) or
                 block.type == 'with'
             ):
-                if why == 'exception':
+                if why == WHY_EXCEPTION:
                     exctype, value, tb = self.last_exception
                     self.push(tb, value, exctype)
                 else:
-                    if why in ('return', 'continue'):
+                    if why == WHY_RETURN or why == WHY_CONTINUE:
                         self.push(self.return_value)
                     self.push(why)
 
@@ -283,7 +685,7 @@ class VirtualMachine(object):
 
         elif PY3:
             if (
-                why == 'exception' and
+                why == WHY_EXCEPTION and
                 block.type in ['setup-except', 'finally']
             ):
                 self.push_block('except-handler')
@@ -296,7 +698,7 @@ class VirtualMachine(object):
                 return why
 
             elif block.type == 'finally':
-                if why in ('return', 'continue'):
+                if why == WHY_RETURN or why == WHY_CONTINUE:
                     self.push(self.return_value)
                 self.push(why)
 
@@ -312,42 +714,551 @@ class VirtualMachine(object):
 
         Exceptions are raised, the return value is returned.
 
+        """
+        if (
+            self.tracefunc is not None or self.opcode_profiler is not None or
+            log.isEnabledFor(logging.INFO)
+        ):
+            run = self.run_frame_traced
+        elif self.transpile_after is not None and self.transpiled(frame):
+            run = self.run_frame_source
+        else:
+            run = self._run_frame
+        if self.function_profiler is not None:
+            return self.function_profiler.run_frame(run, frame)
+        return run(frame)
+
+    def settrace(self, tracefunc):
+        """Set a trace function for interpreted code, like sys.settrace.
+
+        The function is called with 'call', 'line', 'return' and 'exception'
+        events for the frames the VM runs, as sys.settrace describes.  It
+        applies to frames started after it is set.
+
+        """
+        self.tracefunc = tracefunc
+
+    def gettrace(self):
+        """Get the trace function set with settrace()."""
+        return self.tracefunc
+
+    def trace(self, frame, event, arg):
+        """Send a trace event for `frame`, as sys.settrace does.
+
+        'call' events go to the settrace() function, others to the frame's
+        f_trace.  What they return becomes the frame's f_trace, unless it's
+        None.  If the trace function raises an exception, tracing stops, and
+        WHY_EXCEPTION is returned for the frame to deal with.
+
+        """
+        if event == 'call':
+            tracer = self.tracefunc
+        else:
+            tracer = frame.f_trace
+        if tracer is None or self.tracefunc is None:
+            return None
+        try:
+            result = tracer(frame, event, arg)
+        except:
+            self.settrace(None)
+            frame.f_trace = None
+            self.last_exception = sys.exc_info()[:2] + (None,)
+            return WHY_EXCEPTION
+        if result is not None:
+            frame.f_trace = result
+        return None
+
+    def run_frame_traced(self, frame):
+        """Run a frame by dispatching, with tracing, profiling and logging.
+
+        run_frame uses this instead of the engine when there is a trace
+        function or an opcode profiler, or logging is at INFO, so that the
+        engines never have to check for them.  The instructions are run
+        without superinstructions or optimization, so every one of them is
+        traced and logged.
+
         """
         self.push_frame(frame)
+        if frame.decoded is None:
+            self.decode_frame(frame)
+        instructions = frame.decoded.instructions
+        lines = frame.decoded.lines
+        logging_on = log.isEnabledFor(logging.INFO)
+        profiler = self.opcode_profiler
+        why = self.trace(frame, 'call', None)
+        prev = -1
+        while not why:
+            opoffset = frame.f_lasti
+            if frame.f_trace is not None and (
+                opoffset in lines.starts or opoffset < prev
+            ):
+                # A new line, or a jump back into one.
+                frame.f_lineno = lines.line_number(opoffset)
+                why = self.trace(frame, 'line', None)
+            prev = opoffset
+            if not why:
+                byteCode, arguments, frame.f_lasti = instructions[opoffset]
+                if logging_on:
+                    self.log(opname[byteCode], arguments, opoffset)
+                if profiler is None:
+                    why = self.dispatch(byteCode, arguments)
+                else:
+                    why = profiler.dispatch(
+                        self, frame, opoffset, byteCode, arguments
+                    )
+                if why == WHY_EXCEPTION:
+                    why = self.trace(
+                        frame, 'exception', self.last_exception
+                    ) or why
+
+            if why:
+                why = self.unwind_blocks(why)
+
+        if why == WHY_EXCEPTION:
+            self.trace(frame, 'return', None)
+        else:
+            why = self.trace(frame, 'return', self.return_value) or why
+
+        self.pop_frame()
+
+        if why == WHY_EXCEPTION:
+            six.reraise(*self.last_exception)
+
+        return self.return_value
+
+    def run_frame_dispatch(self, frame):
+        """Run a frame by dispatching each instruction to its handler."""
+        self.push_frame(frame)
+        if frame.instructions is None:
+            self.decode_frame(frame)
         while True:
-            byteName, arguments, opoffset = self.parse_byte_and_args()
-            if log.isEnabledFor(logging.INFO):
-                self.log(byteName, arguments, opoffset)
+            byteCode, arguments, opoffset = self.parse_byte_and_args()
 
             # When unwinding the block stack, we need to keep track of why we
             # are doing it.
-            why = self.dispatch(byteName, arguments)
-            if why == 'exception':
-                # TODO: ceval calls PyTraceBack_Here, not sure what that does.
-                pass
+            why = self.dispatch(byteCode, arguments)
+            if why:
+                # Deal with any block management we need to do.
+                # TODO: ceval calls PyTraceBack_Here for exceptions, not sure
+                # what that does.
+                why = self.unwind_blocks(why)
+                if why:
+                    break
 
-            if why == 'reraise':
-                why = 'exception'
+        # TODO: handle generator exception state
+
+        self.pop_frame()
+
+        if why == WHY_EXCEPTION:
+            six.reraise(*self.last_exception)
+
+        return self.return_value
 
-            if why != 'yield':
-                while why and frame.block_stack:
-                    # Deal with any block management we need to do.
-                    why = self.manage_block_stack(why)
+    def run_frame_inline(self, frame):
+        """Run a frame with the common opcodes executed inline.
+
+        The frame's stack, stack top, locals and instruction pointer are kept
+        in local variables.  Other opcodes are dispatched to their handlers,
+        which see the frame's state as usual: frame.f_lasti and
+        frame.stacktop are written before calling out, and re-read
+        afterwards.
+
+        """
+        self.push_frame(frame)
+        if frame.instructions is None:
+            self.decode_frame(frame)
+        instructions = frame.instructions
+        kinds, operators = self.inline_tables()
+        dispatch_table = self.dispatch_table
+        compare_operators = self.COMPARE_OPERATORS
+        stack = frame.stack
+        sp = frame.stacktop
+        f_globals = frame.f_globals
+        f_builtins = frame.f_builtins
+        fastlocals = frame.fastlocals
+        if fastlocals is None:
+            f_locals = frame.f_locals
+        lasti = frame.f_lasti
+        block_table = frame.block_table
+        cells = frame.cells
+        attr_hits = 0
+        uncached = UNCACHED
+        method = Method
+        # Only a handler, a return or an exception sets why, and it's false
+        # again whenever the loop goes on.
+        why = None
+        while True:
+            byteCode, arguments, lasti = instructions[lasti]
+            kind = kinds[byteCode]
+            try:
+                if kind == LOAD_FAST:
+                    val = fastlocals[arguments[0]]
+                    if val is UNBOUND:
+                        raise unbound_local_error(frame, arguments[0])
+                    stack[sp] = val
+                    sp += 1
+                elif kind == LOAD_FAST__LOAD_FAST:
+                    slot, slot2, after = arguments
+                    val = fastlocals[slot]
+                    if val is UNBOUND:
+                        raise unbound_local_error(frame, slot)
+                    stack[sp] = val
+                    sp += 1
+                    lasti = after
+                    val = fastlocals[slot2]
+                    if val is UNBOUND:
+                        raise unbound_local_error(frame, slot2)
+                    stack[sp] = val
+                    sp += 1
+                elif kind == STORE_FAST:
+                    sp -= 1
+                    fastlocals[arguments[0]] = stack[sp]
+                    stack[sp] = None
+                elif kind == LOAD_CONST:
+                    stack[sp] = arguments[0]
+                    sp += 1
+                elif kind == BINARY_OPERATOR:
+                    sp -= 1
+                    y = stack[sp]
+                    stack[sp] = None
+                    stack[sp-1] = operators[byteCode](stack[sp-1], y)
+                elif kind == LOAD_FAST__LOAD_ATTR:
+                    slot, attr, cache, after = arguments
+                    obj = fastlocals[slot]
+                    if obj is UNBOUND:
+                        raise unbound_local_error(frame, slot)
+                    lasti = after
+                    cls = cache[0]
+                    if cls is uncached:
+                        stack[sp] = getattr(obj, attr)
+                    elif type(obj) is cls and attr not in obj.__dict__ and (
+                        cache[1][1].get(attr) is cache[1][0] and
+                        not cache[1][2] and cls.__mro__ is cache[1][3]
+                        or method_is_current(cache[1], cls, attr)
+                    ):
+                        stack[sp] = method(obj, cls, cache[1][0])
+                        attr_hits += 1
+                    else:
+                        stack[sp] = self.load_attr(obj, attr, cache)
+                    sp += 1
+                elif kind == LOAD_ATTR:
+                    attr, cache = arguments
+                    obj = stack[sp-1]
+                    cls = cache[0]
+                    if cls is uncached:
+                        stack[sp-1] = getattr(obj, attr)
+                    elif type(obj) is cls and attr not in obj.__dict__ and (
+                        cache[1][1].get(attr) is cache[1][0] and
+                        not cache[1][2] and cls.__mro__ is cache[1][3]
+                        or method_is_current(cache[1], cls, attr)
+                    ):
+                        stack[sp-1] = method(obj, cls, cache[1][0])
+                        attr_hits += 1
+                    else:
+                        stack[sp-1] = self.load_attr(obj, attr, cache)
+                elif kind == COMPARE_OP__POP_JUMP_IF_FALSE:
+                    opnum, jump, after = arguments
+                    sp -= 2
+                    x = stack[sp]
+                    y = stack[sp+1]
+                    stack[sp] = stack[sp+1] = None
+                    val = compare_operators[opnum](x, y)
+                    lasti = after
+                    if not val:
+                        lasti = jump
+                elif kind == POP_JUMP_IF_FALSE:
+                    sp -= 1
+                    val = stack[sp]
+                    stack[sp] = None
+                    if not val:
+                        lasti = arguments[0]
+                elif kind == COMPARE_OP:
+                    sp -= 1
+                    y = stack[sp]
+                    stack[sp] = None
+                    stack[sp-1] = compare_operators[arguments[0]](
+                        stack[sp-1], y
+                    )
+                elif kind == LOAD_GLOBAL:
+                    name = arguments[0]
+                    if name in f_globals:
+                        stack[sp] = f_globals[name]
+                    elif name in f_builtins:
+                        stack[sp] = f_builtins[name]
+                    else:
+                        raise NameError(
+                            "global name '%s' is not defined" % name
+                        )
+                    sp += 1
+                elif kind == FOR_ITER__STORE_FAST:
+                    jump, slot, after = arguments
+                    try:
+                        val = next(stack[sp-1])
+                    except StopIteration:
+                        sp -= 1
+                        stack[sp] = None
+                        lasti = jump
+                    else:
+                        lasti = after
+                        fastlocals[slot] = val
+                elif kind == FOR_ITER:
+                    try:
+                        val = next(stack[sp-1])
+                    except StopIteration:
+                        sp -= 1
+                        stack[sp] = None
+                        lasti = arguments[0]
+                    else:
+                        stack[sp] = val
+                        sp += 1
+                elif kind == JUMP_ABSOLUTE or kind == JUMP_FORWARD:
+                    lasti = arguments[0]
+                elif kind == CALL_FUNCTION and arguments[0] < 256:
+                    # Only positional arguments: others go to call_function.
+                    count = arguments[0]
+                    posargs = stack[sp-count:sp]
+                    stack[sp-count:sp] = NONES[count]
+                    sp -= count + 1
+                    func = stack[sp]
+                    stack[sp] = None
+                    if hasattr(func, 'im_func'):
+                        # Methods get self as an implicit first parameter.
+                        if func.im_self:
+                            posargs.insert(0, func.im_self)
+                        # The first parameter must be the correct type.
+                        if not isinstance(posargs[0], func.im_class):
+                            raise TypeError(
+                                'unbound method %s() must be called with %s '
+                                'instance as first argument (got %s instance '
+                                'instead)' % (
+                                    func.im_func.func_name,
+                                    func.im_class.__name__,
+                                    type(posargs[0]).__name__,
+                                )
+                            )
+                        func = func.im_func
+                    frame.f_lasti = lasti
+                    if func is builtins.locals:
+                        stack[sp] = frame.f_locals
+                    else:
+                        stack[sp] = func(*posargs)
+                    sp += 1
+                elif kind == POP_TOP:
+                    sp -= 1
+                    stack[sp] = None
+                elif kind == POP_JUMP_IF_TRUE:
+                    sp -= 1
+                    val = stack[sp]
+                    stack[sp] = None
+                    if val:
+                        lasti = arguments[0]
+                elif kind == STORE_ATTR:
+                    sp -= 2
+                    val = stack[sp]
+                    obj = stack[sp+1]
+                    stack[sp] = stack[sp+1] = None
+                    attr, cache = arguments
+                    if type(obj) is cache[0]:
+                        setattr(obj, attr, val)
+                        attr_hits += 1
+                    else:
+                        self.store_attr(obj, attr, val, cache)
+                elif kind == LOAD_NAME:
+                    name = arguments[0]
+                    if name in f_locals:
+                        stack[sp] = f_locals[name]
+                    elif name in f_globals:
+                        stack[sp] = f_globals[name]
+                    elif name in f_builtins:
+                        stack[sp] = f_builtins[name]
+                    else:
+                        raise NameError("name '%s' is not defined" % name)
+                    sp += 1
+                elif kind == STORE_NAME:
+                    sp -= 1
+                    f_locals[arguments[0]] = stack[sp]
+                    stack[sp] = None
+                elif kind == GET_ITER:
+                    stack[sp-1] = iter(stack[sp-1])
+                elif kind == JUMP_IF_FALSE_OR_POP:
+                    if not stack[sp-1]:
+                        lasti = arguments[0]
+                    else:
+                        sp -= 1
+                        stack[sp] = None
+                elif kind == JUMP_IF_TRUE_OR_POP:
+                    if stack[sp-1]:
+                        lasti = arguments[0]
+                    else:
+                        sp -= 1
+                        stack[sp] = None
+                elif kind == RETURN_VALUE:
+                    sp -= 1
+                    self.return_value = stack[sp]
+                    stack[sp] = None
+                    if frame.generator:
+                        frame.generator.finished = True
+                    why = WHY_RETURN
+                elif kind == LOAD_CONST__RETURN_VALUE:
+                    lasti = arguments[1]
+                    self.return_value = arguments[0]
+                    if frame.generator:
+                        frame.generator.finished = True
+                    why = WHY_RETURN
+                elif kind == LOAD_DEREF:
+                    val = cells[arguments[0]].contents
+                    if val is UNBOUND:
+                        raise unbound_cell_error(frame, arguments[0])
+                    stack[sp] = val
+                    sp += 1
+                elif kind == STORE_DEREF:
+                    sp -= 1
+                    cells[arguments[0]].contents = stack[sp]
+                    stack[sp] = None
+                elif kind == BLOCK and block_table is not None:
+                    pass
+                else:
+                    frame.f_lasti = lasti
+                    frame.stacktop = sp
+                    kind = None
+                    why = dispatch_table[byteCode](*arguments)
+                    lasti = frame.f_lasti
+                    sp = frame.stacktop
+                    if fastlocals is None:
+                        f_locals = frame.f_locals
+            except:
+                if kind is None:
+                    # The handler has the up-to-date frame state.
+                    lasti = frame.f_lasti
+                    sp = frame.stacktop
+                self.last_exception = sys.exc_info()[:2] + (None,)
+                log.exception("Caught exception during execution")
+                why = WHY_EXCEPTION
 
             if why:
-                break
+                frame.f_lasti = lasti
+                frame.stacktop = sp
+                why = self.unwind_blocks(why)
+                if why:
+                    break
+                lasti = frame.f_lasti
+                sp = frame.stacktop
+
+        self.attr_cache_hits += attr_hits
+        self.pop_frame()
 
-        # TODO: handle generator exception state
+        if why == WHY_EXCEPTION:
+            six.reraise(*self.last_exception)
+
+        return self.return_value
+
+    def transpiled(self, frame):
+        """Count a run of `frame`'s code, and transpile it if it's hot.
+
+        Returns the function from transpile.transpile that runs the code, or
+        None if it isn't transpiled (yet).  Only function frames are counted.
+
+        """
+        decoded = frame.decoded
+        if decoded is None or frame.fastlocals is None:
+            return None
+        if decoded.transpiled is None:
+            decoded.runs = {}
+            decoded.transpiled = {}
+        cls = type(self)
+        runs = decoded.runs[cls] = decoded.runs.get(cls, 0) + 1
+        if runs < self.transpile_after:
+            return None
+        fn = decoded.transpiled.get(cls)
+        if fn is None:
+            fn = decoded.transpiled[cls] = transpile.transpile(
+                frame.f_code, decoded.instructions, cls.transpile_opcodes(),
+            ) or False
+        return fn or None
+
+    def run_frame_source(self, frame):
+        """Run a frame with the native function its code is transpiled to."""
+        fn = frame.decoded.transpiled[type(self)]
+        self.push_frame(frame)
+        try:
+            return fn(self, frame)
+        finally:
+            self.pop_frame()
+
+    def run_frame_closure(self, frame):
+        """Run a frame by calling the closures its code is compiled into.
+
+        The code is compiled by closures.ClosureCode, once for each VM class,
+        from its instructions without superinstructions.  The stack top is
+        kept in a local variable while a block's ops run, and written to the
+        frame before its terminator.
+
+        """
+        self.push_frame(frame)
+        if frame.decoded is None:
+            self.decode_frame(frame)
+        decoded = frame.decoded
+        if decoded.closures is None:
+            decoded.closures = {}
+        key = (type(self), self.optimize)
+        code = decoded.closures.get(key)
+        if code is None:
+            instructions = decoded.instructions
+            if self.optimize:
+                instructions = peephole.optimize(instructions)
+            code = decoded.closures[key] = closures.ClosureCode(
+                type(self), instructions,
+                skip_blocks=frame.block_table is not None,
+            )
+        blocks = code.blocks
+        stack = frame.stack
+        fastlocals = frame.fastlocals
+        lasti = frame.f_lasti
+        sp = frame.stacktop
+        while True:
+            block = blocks[lasti]
+            if block is None:
+                block = code.block(lasti)
+            ops, terminator, terminator_next, nexts = block
+            # The iterator tells us which op raised an exception, if one
+            # does.  It's None once the terminator is running.
+            remaining = iter(ops)
+            try:
+                for op in remaining:
+                    sp = op(self, frame, stack, sp, fastlocals)
+                remaining = None
+                frame.stacktop = sp
+                frame.f_lasti = terminator_next
+                why = terminator(self, frame, stack, sp, fastlocals)
+            except:
+                if remaining is not None:
+                    frame.stacktop = sp
+                    frame.f_lasti = nexts[
+                        len(ops) - remaining.__length_hint__() - 1
+                    ]
+                self.last_exception = sys.exc_info()[:2] + (None,)
+                log.exception("Caught exception during execution")
+                why = WHY_EXCEPTION
+
+            if why:
+                why = self.unwind_blocks(why)
+                if why:
+                    break
+            lasti = frame.f_lasti
+            sp = frame.stacktop
 
         self.pop_frame()
 
-        if why == 'exception':
+        if why == WHY_EXCEPTION:
             six.reraise(*self.last_exception)
 
         return self.return_value
 
     ## Stack manipulation
 
+    def byte_NOP(self):
+        pass
+
     def byte_LOAD_CONST(self, const):
         self.push(const)
 
@@ -355,29 +1266,39 @@ class VirtualMachine(object):
         self.pop()
 
     def byte_DUP_TOP(self):
-        self.push(self.top())
+        frame = self.frame
+        top = frame.stacktop
+        frame.stack[top] = frame.stack[top-1]
+        frame.stacktop = top + 1
 
     def byte_DUP_TOPX(self, count):
-        items = self.popn(count)
-        for i in [1, 2]:
-            self.push(*items)
+        frame = self.frame
+        top = frame.stacktop
+        frame.stack[top:top+count] = frame.stack[top-count:top]
+        frame.stacktop = top + count
 
     def byte_DUP_TOP_TWO(self):
         # Py3 only
-        a, b = self.popn(2)
-        self.push(a, b, a, b)
+        self.byte_DUP_TOPX(2)
 
     def byte_ROT_TWO(self):
-        a, b = self.popn(2)
-        self.push(b, a)
+        stack = self.frame.stack
+        top = self.frame.stacktop
+        stack[top-2], stack[top-1] = stack[top-1], stack[top-2]
 
     def byte_ROT_THREE(self):
-        a, b, c = self.popn(3)
-        self.push(c, a, b)
+        stack = self.frame.stack
+        top = self.frame.stacktop
+        stack[top-3], stack[top-2], stack[top-1] = (
+            stack[top-1], stack[top-3], stack[top-2]
+        )
 
     def byte_ROT_FOUR(self):
-        a, b, c, d = self.popn(4)
-        self.push(d, a, b, c)
+        stack = self.frame.stack
+        top = self.frame.stacktop
+        stack[top-4], stack[top-3], stack[top-2], stack[top-1] = (
+            stack[top-1], stack[top-4], stack[top-3], stack[top-2]
+        )
 
     ## Names
 
@@ -399,20 +1320,19 @@ class VirtualMachine(object):
     def byte_DELETE_NAME(self, name):
         del self.frame.f_locals[name]
 
-    def byte_LOAD_FAST(self, name):
-        if name in self.frame.f_locals:
-            val = self.frame.f_locals[name]
-        else:
-            raise UnboundLocalError(
-                "local variable '%s' referenced before assignment" % name
-            )
+    def byte_LOAD_FAST(self, slot):
+        val = self.frame.fastlocals[slot]
+        if val is UNBOUND:
+            raise unbound_local_error(self.frame, slot)
         self.push(val)
 
-    def byte_STORE_FAST(self, name):
-        self.frame.f_locals[name] = self.pop()
+    def byte_STORE_FAST(self, slot):
+        self.frame.fastlocals[slot] = self.pop()
 
-    def byte_DELETE_FAST(self, name):
-        del self.frame.f_locals[name]
+    def byte_DELETE_FAST(self, slot):
+        if self.frame.fastlocals[slot] is UNBOUND:
+            raise unbound_local_error(self.frame, slot)
+        self.frame.fastlocals[slot] = UNBOUND
 
     def byte_LOAD_GLOBAL(self, name):
         f = self.frame
@@ -428,11 +1348,14 @@ class VirtualMachine(object):
         f = self.frame
         f.f_globals[name] = self.pop()
 
-    def byte_LOAD_DEREF(self, name):
-        self.push(self.frame.cells[name].get())
+    def byte_LOAD_DEREF(self, index):
+        val = self.frame.cells[index].contents
+        if val is UNBOUND:
+            raise unbound_cell_error(self.frame, index)
+        self.push(val)
 
-    def byte_STORE_DEREF(self, name):
-        self.frame.cells[name].set(self.pop())
+    def byte_STORE_DEREF(self, index):
+        self.frame.cells[index].contents = self.pop()
 
     def byte_LOAD_LOCALS(self):
         self.push(self.frame.f_locals)
@@ -447,10 +1370,6 @@ class VirtualMachine(object):
         'INVERT':   operator.invert,
     }
 
-    def unaryOperator(self, op):
-        x = self.pop()
-        self.push(self.UNARY_OPERATORS[op](x))
-
     BINARY_OPERATORS = {
         'POWER':    pow,
         'MULTIPLY': operator.mul,
@@ -468,60 +1387,21 @@ class VirtualMachine(object):
         'OR':       operator.or_,
     }
 
-    def binaryOperator(self, op):
-        x, y = self.popn(2)
-        self.push(self.BINARY_OPERATORS[op](x, y))
-
-    def inplaceOperator(self, op):
-        x, y = self.popn(2)
-        if op == 'POWER':
-            x **= y
-        elif op == 'MULTIPLY':
-            x *= y
-        elif op in ['DIVIDE', 'FLOOR_DIVIDE']:
-            x //= y
-        elif op == 'TRUE_DIVIDE':
-            x /= y
-        elif op == 'MODULO':
-            x %= y
-        elif op == 'ADD':
-            x += y
-        elif op == 'SUBTRACT':
-            x -= y
-        elif op == 'LSHIFT':
-            x <<= y
-        elif op == 'RSHIFT':
-            x >>= y
-        elif op == 'AND':
-            x &= y
-        elif op == 'XOR':
-            x ^= y
-        elif op == 'OR':
-            x |= y
-        else:           # pragma: no cover
-            raise VirtualMachineError("Unknown in-place operator: %r" % op)
-        self.push(x)
-
-    def sliceOperator(self, op):
-        start = 0
-        end = None          # we will take this to mean end
-        op, count = op[:-2], int(op[-1])
-        if count == 1:
-            start = self.pop()
-        elif count == 2:
-            end = self.pop()
-        elif count == 3:
-            end = self.pop()
-            start = self.pop()
-        l = self.pop()
-        if end is None:
-            end = len(l)
-        if op.startswith('STORE_'):
-            l[start:end] = self.pop()
-        elif op.startswith('DELETE_'):
-            del l[start:end]
-        else:
-            self.push(l[start:end])
+    INPLACE_OPERATORS = {
+        'POWER':    operator.ipow,
+        'MULTIPLY': operator.imul,
+        'DIVIDE':   getattr(operator, 'idiv', lambda x, y: None),
+        'FLOOR_DIVIDE': operator.ifloordiv,
+        'TRUE_DIVIDE':  operator.itruediv,
+        'MODULO':   operator.imod,
+        'ADD':      operator.iadd,
+        'SUBTRACT': operator.isub,
+        'LSHIFT':   operator.ilshift,
+        'RSHIFT':   operator.irshift,
+        'AND':      operator.iand,
+        'XOR':      operator.ixor,
+        'OR':       operator.ior,
+    }
 
     COMPARE_OPERATORS = [
         operator.lt,
@@ -538,23 +1418,118 @@ class VirtualMachine(object):
     ]
 
     def byte_COMPARE_OP(self, opnum):
-        x, y = self.popn(2)
-        self.push(self.COMPARE_OPERATORS[opnum](x, y))
+        frame = self.frame
+        stack = frame.stack
+        top = frame.stacktop - 1
+        y = stack[top]
+        stack[top] = None
+        frame.stacktop = top
+        stack[top-1] = self.COMPARE_OPERATORS[opnum](stack[top-1], y)
 
     ## Attributes and indexing
 
-    def byte_LOAD_ATTR(self, attr):
-        obj = self.pop()
-        val = getattr(obj, attr)
-        self.push(val)
+    # LOAD_ATTR and STORE_ATTR have an attribute cache for the instruction,
+    # see decode.ATTR_CACHED.  Plain getattr is as fast as anything we could
+    # do for most attributes, so LOAD_ATTR only caches interpreted methods:
+    # by type, the Function to bind, skipping Function.__get__.  STORE_ATTR
+    # caches the types whose attributes can be set without us having to
+    # notice: anything but classes.  Changes to classes that the
+    # VM sees reset all the attribute caches, and LOAD_ATTR checks the
+    # classes on each hit for changes it didn't see, see method_is_current.
+
+    def load_attr(self, obj, attr, cache):
+        """Get `attr` from `obj`, after its attribute `cache` missed."""
+        cls = type(obj)
+        if cache[0] is None:
+            found = interpreted_method(obj, attr)
+            if found is None:
+                cache[0] = UNCACHED
+            else:
+                cache[0], cache[1] = cls, found
+        elif cls is cache[0]:
+            # The instance's dict hides the method, or the class changed.
+            found = None
+            if attr not in obj.__dict__:
+                found = cache[1] = interpreted_method(obj, attr)
+                if found is None:
+                    cache[0] = UNCACHED
+        else:
+            others = cache[2]
+            if others is None:
+                others = cache[2] = {}
+            found = None
+            if cls in others:
+                found = others[cls]
+                if found is None or attr in obj.__dict__:
+                    return getattr(obj, attr)
+                if method_is_current(found, cls, attr):
+                    self.attr_cache_hits += 1
+                    return Method(obj, cls, found[0])
+                found = others[cls] = interpreted_method(obj, attr)
+            elif len(others) < ATTR_CACHE_TYPES:
+                found = others[cls] = interpreted_method(obj, attr)
+        self.attr_cache_misses += 1
+        if found is not None and attr not in obj.__dict__:
+            return Method(obj, cls, found[0])
+        return getattr(obj, attr)
+
+    def store_attr(self, obj, attr, val, cache):
+        """Set `attr` on `obj`, after its attribute `cache` missed."""
+        self.attr_cache_misses += 1
+        setattr(obj, attr, val)
+        cls = type(obj)
+        if isinstance(obj, type):
+            self.attr_changed(obj)
+        elif cache[0] is None:
+            cache[0] = cls
+        else:
+            if cache[2] is None:
+                cache[2] = set()
+            if cls in cache[2]:
+                self.attr_cache_misses -= 1
+                self.attr_cache_hits += 1
+            elif len(cache[2]) < ATTR_CACHE_TYPES:
+                cache[2].add(cls)
+
+    def attr_changed(self, obj):
+        """An attribute of `obj` was set or deleted: reset any caches that
+        might know about it."""
+        if isinstance(obj, type):
+            reset_attr_caches()
+
+    def attr_cache_stats(self):
+        """Return a dict of the attribute cache counters for this VM."""
+        return hit_stats(self.attr_cache_hits, self.attr_cache_misses)
+
+    def byte_LOAD_ATTR(self, attr, cache):
+        frame = self.frame
+        obj = frame.stack[frame.stacktop-1]
+        cls = cache[0]
+        if cls is UNCACHED:
+            val = getattr(obj, attr)
+        elif type(obj) is cls and attr not in obj.__dict__ and (
+            cache[1][1].get(attr) is cache[1][0] and not cache[1][2] and
+            cls.__mro__ is cache[1][3]
+            or method_is_current(cache[1], cls, attr)
+        ):
+            val = Method(obj, cls, cache[1][0])
+            self.attr_cache_hits += 1
+        else:
+            val = self.load_attr(obj, attr, cache)
+        frame.stack[frame.stacktop-1] = val
 
-    def byte_STORE_ATTR(self, name):
+    def byte_STORE_ATTR(self, name, cache):
         val, obj = self.popn(2)
-        setattr(obj, name, val)
+        if type(obj) is cache[0]:
+            setattr(obj, name, val)
+            self.attr_cache_hits += 1
+        else:
+            self.store_attr(obj, name, val, cache)
 
     def byte_DELETE_ATTR(self, name):
         obj = self.pop()
         delattr(obj, name)
+        self.attr_changed(obj)
 
     def byte_STORE_SUBSCR(self):
         val, obj, subscr = self.popn(3)
@@ -566,18 +1541,28 @@ class VirtualMachine(object):
 
     ## Building
 
+    def build(self, count, kind):
+        """Replace the top `count` stack values with `kind` made from them."""
+        frame = self.frame
+        stack = frame.stack
+        base = frame.stacktop - count
+        elts = stack[base:frame.stacktop]
+        if kind is not list:
+            elts = kind(elts)
+        if count:
+            stack[base+1:frame.stacktop] = NONES[count-1]
+        stack[base] = elts
+        frame.stacktop = base + 1
+
     def byte_BUILD_TUPLE(self, count):
-        elts = self.popn(count)
-        self.push(tuple(elts))
+        self.build(count, tuple)
 
     def byte_BUILD_LIST(self, count):
-        elts = self.popn(count)
-        self.push(elts)
+        self.build(count, list)
 
     def byte_BUILD_SET(self, count):
         # TODO: Not documented in Py2 docs.
-        elts = self.popn(count)
-        self.push(set(elts))
+        self.build(count, set)
 
     def byte_BUILD_MAP(self, size):
         # size is ignored.
@@ -589,9 +1574,23 @@ class VirtualMachine(object):
         self.push(the_map)
 
     def byte_UNPACK_SEQUENCE(self, count):
-        seq = self.pop()
-        for x in reversed(seq):
-            self.push(x)
+        frame = self.frame
+        top = frame.stacktop - 1
+        # Take one extra value, to know if there are too many.
+        vals = list(itertools.islice(frame.stack[top], count + 1))
+        if len(vals) != count:
+            if len(vals) > count:
+                msg = "too many values to unpack"
+                if PY3:
+                    msg += " (expected %d)" % count
+            else:
+                msg = "need more than %d value%s to unpack" % (
+                    len(vals), "" if len(vals) == 1 else "s"
+                )
+            raise ValueError(msg)
+        vals.reverse()
+        frame.stack[top:top+count] = vals
+        frame.stacktop = top + count
 
     def byte_BUILD_SLICE(self, count):
         if count == 2:
@@ -705,7 +1704,8 @@ class VirtualMachine(object):
     ## Blocks
 
     def byte_SETUP_LOOP(self, dest):
-        self.push_block('loop', dest)
+        if self.frame.block_table is None:
+            self.push_block('loop', dest)
 
     def byte_GET_ITER(self):
         self.push(iter(self.pop()))
@@ -720,7 +1720,7 @@ class VirtualMachine(object):
             self.jump(jump)
 
     def byte_BREAK_LOOP(self):
-        return 'break'
+        return WHY_BREAK
 
     def byte_CONTINUE_LOOP(self, dest):
         # This is a trick with the return value.
@@ -730,21 +1730,23 @@ class VirtualMachine(object):
         # pushed on the stack for both, so continue puts the jump destination
         # into return_value.
         self.return_value = dest
-        return 'continue'
+        return WHY_CONTINUE
 
     def byte_SETUP_EXCEPT(self, dest):
-        self.push_block('setup-except', dest)
+        if self.frame.block_table is None:
+            self.push_block('setup-except', dest)
 
     def byte_SETUP_FINALLY(self, dest):
-        self.push_block('finally', dest)
+        if self.frame.block_table is None:
+            self.push_block('finally', dest)
 
     def byte_END_FINALLY(self):
         v = self.pop()
-        if isinstance(v, str):
+        if isinstance(v, int):
             why = v
-            if why in ('return', 'continue'):
+            if why == WHY_RETURN or why == WHY_CONTINUE:
                 self.return_value = self.pop()
-            if why == 'silenced':       # PY3
+            if why == WHY_SILENCED:       # PY3
                 block = self.pop_block()
                 assert block.type == 'except-handler'
                 self.unwind_block(block)
@@ -756,13 +1758,14 @@ class VirtualMachine(object):
             val = self.pop()
             tb = self.pop()
             self.last_exception = (exctype, val, tb)
-            why = 'reraise'
+            why = WHY_RERAISE
         else:       # pragma: no cover
             raise VirtualMachineError("Confused END_FINALLY")
         return why
 
     def byte_POP_BLOCK(self):
-        self.pop_block()
+        if self.frame.block_table is None:
+            self.pop_block()
 
     if PY2:
         def byte_RAISE_VARARGS(self, argc):
@@ -789,9 +1792,9 @@ class VirtualMachine(object):
             self.last_exception = (exctype, val, tb)
 
             if tb:
-                return 'reraise'
+                return WHY_RERAISE
             else:
-                return 'exception'
+                return WHY_EXCEPTION
 
     elif PY3:
         def byte_RAISE_VARARGS(self, argc):
@@ -807,9 +1810,9 @@ class VirtualMachine(object):
             if exc is None:         # reraise
                 exc_type, val, tb = self.last_exception
                 if exc_type is None:
-                    return 'exception'      # error
+                    return WHY_EXCEPTION  # error
                 else:
-                    return 'reraise'
+                    return WHY_RERAISE
 
             elif type(exc) == type:
                 # As in `raise ValueError`
@@ -820,7 +1823,7 @@ class VirtualMachine(object):
                 exc_type = type(exc)
                 val = exc
             else:
-                return 'exception'      # error
+                return WHY_EXCEPTION  # error
 
             # If you reach this point, you're guaranteed that
             # val is a valid exception instance and exc_type is its class.
@@ -829,12 +1832,12 @@ class VirtualMachine(object):
                 if type(cause) == type:
                     cause = cause()
                 elif not isinstance(cause, BaseException):
-                    return 'exception'  # error
+                    return WHY_EXCEPTION  # error
 
                 val.__cause__ = cause
 
             self.last_exception = exc_type, val, val.__traceback__
-            return 'exception'
+            return WHY_EXCEPTION
 
     def byte_POP_EXCEPT(self):
         block = self.pop_block()
@@ -846,7 +1849,9 @@ class VirtualMachine(object):
         ctxmgr = self.pop()
         self.push(ctxmgr.__exit__)
         ctxmgr_obj = ctxmgr.__enter__()
-        if PY2:
+        if self.frame.block_table is not None:
+            pass
+        elif PY2:
             self.push_block('with', dest)
         elif PY3:
             self.push_block('finally', dest)
@@ -860,8 +1865,8 @@ class VirtualMachine(object):
         u = self.top()
         if u is None:
             exit_func = self.pop(1)
-        elif isinstance(u, str):
-            if u in ('return', 'continue'):
+        elif isinstance(u, int):
+            if u == WHY_RETURN or u == WHY_CONTINUE:
                 exit_func = self.pop(2)
             else:
                 exit_func = self.pop(1)
@@ -891,7 +1896,7 @@ class VirtualMachine(object):
                 self.popn(3)
                 self.push(None)
             elif PY3:
-                self.push('silenced')
+                self.push(WHY_SILENCED)
 
     ## Functions
 
@@ -906,8 +1911,8 @@ class VirtualMachine(object):
         fn = Function(name, code, globs, defaults, None, self)
         self.push(fn)
 
-    def byte_LOAD_CLOSURE(self, name):
-        self.push(self.frame.cells[name])
+    def byte_LOAD_CLOSURE(self, index):
+        self.push(self.frame.cells[index])
 
     def byte_MAKE_CLOSURE(self, argc):
         if PY3:
@@ -963,18 +1968,22 @@ class VirtualMachine(object):
                     )
                 )
             func = func.im_func
-        retval = func(*posargs, **namedargs)
+        if func is builtins.locals:
+            # The real locals() would see the VM's own locals.
+            retval = frame.f_locals
+        else:
+            retval = func(*posargs, **namedargs)
         self.push(retval)
 
     def byte_RETURN_VALUE(self):
         self.return_value = self.pop()
         if self.frame.generator:
             self.frame.generator.finished = True
-        return "return"
+        return WHY_RETURN
 
     def byte_YIELD_VALUE(self):
         self.return_value = self.pop()
-        return "yield"
+        return WHY_YIELD
 
     def byte_YIELD_FROM(self):
         u = self.pop()
@@ -994,17 +2003,83 @@ class VirtualMachine(object):
             # YIELD_FROM decrements f_lasti, so that it will be called
             # repeatedly until a StopIteration is raised.
             self.jump(self.frame.f_lasti - 1)
-            # Returning "yield" prevents the block stack cleanup code
+            # Returning WHY_YIELD prevents the block stack cleanup code
             # from executing, suspending the frame in its current state.
-            return "yield"
+            return WHY_YIELD
+
+    ## Superinstructions
+    #
+    # Each of these runs a pair of instructions, see decode.fuse_instructions.
+    # f_lasti points to the second instruction while the first one runs, and
+    # is moved to `after` before the second one runs.
+
+    def byte_LOAD_FAST__LOAD_FAST(self, slot1, slot2, after):
+        frame = self.frame
+        val = frame.fastlocals[slot1]
+        if val is UNBOUND:
+            raise unbound_local_error(frame, slot1)
+        frame.stack[frame.stacktop] = val
+        frame.stacktop += 1
+        frame.f_lasti = after
+        val = frame.fastlocals[slot2]
+        if val is UNBOUND:
+            raise unbound_local_error(frame, slot2)
+        frame.stack[frame.stacktop] = val
+        frame.stacktop += 1
+
+    def byte_LOAD_FAST__LOAD_ATTR(self, slot, attr, cache, after):
+        frame = self.frame
+        val = frame.fastlocals[slot]
+        if val is UNBOUND:
+            raise unbound_local_error(frame, slot)
+        frame.f_lasti = after
+        frame.stack[frame.stacktop] = val
+        frame.stacktop += 1
+        self.byte_LOAD_ATTR(attr, cache)
+
+    def byte_COMPARE_OP__POP_JUMP_IF_FALSE(self, opnum, jump, after):
+        frame = self.frame
+        stack = frame.stack
+        top = frame.stacktop - 2
+        x, y = stack[top], stack[top+1]
+        stack[top] = stack[top+1] = None
+        frame.stacktop = top
+        val = self.COMPARE_OPERATORS[opnum](x, y)
+        frame.f_lasti = after
+        if not val:
+            frame.f_lasti = jump
+
+    def byte_LOAD_CONST__RETURN_VALUE(self, const, after):
+        self.frame.f_lasti = after
+        self.return_value = const
+        if self.frame.generator:
+            self.frame.generator.finished = True
+        return WHY_RETURN
+
+    def byte_FOR_ITER__STORE_FAST(self, jump, slot, after):
+        frame = self.frame
+        iterobj = frame.stack[frame.stacktop-1]
+        try:
+            v = next(iterobj)
+        except StopIteration:
+            self.pop()
+            frame.f_lasti = jump
+        else:
+            frame.f_lasti = after
+            frame.fastlocals[slot] = v
 
     ## Importing
 
     def byte_IMPORT_NAME(self, name):
         level, fromlist = self.popn(2)
         frame = self.frame
+        # Like CPython, function frames pass None rather than make f_locals.
+        if frame.fastlocals is None:
+            f_locals = frame.f_locals
+        else:
+            f_locals = None
         self.push(
-            __import__(name, frame.f_globals, frame.f_locals, fromlist, level)
+            __import__(name, frame.f_globals, f_locals, fromlist, level)
         )
 
     def byte_IMPORT_STAR(self):
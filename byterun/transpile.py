@@ -0,0 +1,514 @@
+"""Transpiling hot code objects to Python source, for Byterun.
+
+A VM made with `transpile_after=N` counts how often each function's code
+runs.  After N runs, the code's instructions are translated to the source
+of a Python function, which is compiled once and run natively from then on,
+in place of the VM's engine.
+
+The generated function keeps each fast local and each stack slot in a
+local variable of its own: `l0` for fast local 0, `s0` for the bottom of
+the stack, and so on.  The depth of the stack is the same every time an
+instruction runs, so each instruction becomes a few statements on those
+variables.  Basic blocks are guarded by `if pc == offset:` in a `while
+True:` loop, so jumps just set `pc`.
+
+Only code that uses the opcodes in SOURCE_OPCODES can be transpiled, and
+only if the VM class hasn't changed their handlers.  So there's no
+exception handling, generators, closures, or anything that needs the frame
+to be up to date: the code runs just as it would in the VM, except that
+the frame's f_lasti is only set before calls, and its fast locals only
+before calls to methods and locals(), which go through call_function.
+
+"""
+
+import dis
+import operator
+
+import six
+from six.moves import builtins
+
+from .pyobj import CO_GENERATOR, CO_VARARGS, CO_VARKEYWORDS, UNBOUND
+from .pyobj import unbound_local_error
+
+PY3, PY2 = six.PY3, not six.PY3
+
+
+def _opcode(name):
+    return dis.opmap.get(name, -1)
+
+# Source templates for operators, filled in with the operand variables.
+UNARY_SOURCE = {
+    'UNARY_POSITIVE': '+%s',
+    'UNARY_NEGATIVE': '-%s',
+    'UNARY_NOT': 'not %s',
+    'UNARY_INVERT': '~%s',
+    'UNARY_CONVERT': 'REPR(%s)',
+}
+
+BINARY_SOURCE = {
+    'POWER': '%s ** %s',
+    'MULTIPLY': '%s * %s',
+    'FLOOR_DIVIDE': '%s // %s',
+    'MODULO': '%s %% %s',
+    'ADD': '%s + %s',
+    'SUBTRACT': '%s - %s',
+    'LSHIFT': '%s << %s',
+    'RSHIFT': '%s >> %s',
+    'AND': '%s & %s',
+    'XOR': '%s ^ %s',
+    'OR': '%s | %s',
+}
+if PY2:
+    # The source is compiled without `from __future__ import division`.
+    BINARY_SOURCE['DIVIDE'] = '%s / %s'
+    BINARY_SOURCE['TRUE_DIVIDE'] = 'TRUEDIV(%s, %s)'
+else:
+    BINARY_SOURCE['TRUE_DIVIDE'] = '%s / %s'
+
+# In-place operators are augmented assignments, like `%s += %s`.
+INPLACE_SOURCE = dict(
+    ('INPLACE_' + name, '%%s %s= %%s' % template.split()[1])
+    for name, template in BINARY_SOURCE.items()
+    if not template.endswith(')')
+)
+if PY2:
+    INPLACE_SOURCE['INPLACE_TRUE_DIVIDE'] = '%s = ITRUEDIV(%s, %s)'
+BINARY_SOURCE = dict(
+    ('BINARY_' + name, template) for name, template in BINARY_SOURCE.items()
+)
+BINARY_SOURCE['BINARY_SUBSCR'] = '%s[%s]'
+
+COMPARE_SOURCE = [
+    '%s < %s', '%s <= %s', '%s == %s', '%s != %s', '%s > %s', '%s >= %s',
+    '%s in %s', '%s not in %s', '%s is %s', '%s is not %s',
+]
+
+# The opcodes that can be transpiled, other than the operators.
+SOURCE_OPCODES = set(_opcode(name) for name in [
+    'NOP', 'POP_TOP', 'ROT_TWO', 'ROT_THREE', 'DUP_TOP', 'LOAD_FAST',
+    'STORE_FAST', 'LOAD_CONST', 'LOAD_GLOBAL', 'LOAD_ATTR', 'STORE_ATTR',
+    'STORE_SUBSCR', 'COMPARE_OP', 'BUILD_TUPLE', 'BUILD_LIST', 'BUILD_MAP',
+    'STORE_MAP', 'UNPACK_SEQUENCE', 'LIST_APPEND', 'GET_ITER', 'FOR_ITER',
+    'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE',
+    'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP', 'SETUP_LOOP',
+    'POP_BLOCK', 'BREAK_LOOP', 'CALL_FUNCTION', 'RETURN_VALUE',
+])
+SOURCE_OPCODES.discard(-1)
+
+def call_function(frame, func, posargs, namedargs):
+    """Call `func` the way VirtualMachine.call_function does.
+
+    The generated source calls other functions itself.  For locals(), the
+    frame's fastlocals must already be up to date.
+
+    """
+    if hasattr(func, 'im_func'):
+        # Methods get self as an implicit first parameter.
+        if func.im_self:
+            posargs.insert(0, func.im_self)
+        # The first parameter must be the correct type.
+        if not isinstance(posargs[0], func.im_class):
+            raise TypeError(
+                'unbound method %s() must be called with %s instance '
+                'as first argument (got %s instance instead)' % (
+                    func.im_func.func_name,
+                    func.im_class.__name__,
+                    type(posargs[0]).__name__,
+                )
+            )
+        func = func.im_func
+    if func is builtins.locals:
+        # The real locals() would see the generated function's locals.
+        return frame.f_locals
+    return func(*posargs, **namedargs)
+
+
+# Values the generated source uses, by the names it uses for them.
+HELPERS = {
+    'UNBOUND': UNBOUND,
+    'unbound_local_error': unbound_local_error,
+    'NEXT': next,
+    'ITER': iter,
+    'REPR': repr,
+    'TRUEDIV': operator.truediv,
+    'ITRUEDIV': operator.itruediv,
+    'StopIteration': StopIteration,
+    'NameError': NameError,
+    'isinstance': isinstance,
+    'hasattr': hasattr,
+    'LOCALS': builtins.locals,
+    'call_function': call_function,
+    # Setting attributes of these can change what the VM has cached.
+    'CACHED_TYPES': type,
+}
+
+# Code that uses these names needs its frame to be up to date.  Calls to
+# locals() by another name go through call_function.
+FRAME_NAMES = set(['locals', 'vars', 'eval', 'exec', 'execfile', 'dir'])
+
+
+def transpilable_opcodes(vm_class, base_class):
+    """Get the set of opcodes `vm_class` runs the same as `base_class`.
+
+    These are the opcodes the source backend can transpile for the class:
+    those in SOURCE_OPCODES, and the operators, whose handlers `vm_class`
+    hasn't changed from the VirtualMachine `base_class`.
+
+    """
+    functions = vm_class.dispatch_functions()
+    base_functions = base_class.dispatch_functions()
+    _, operators = vm_class.inline_tables()
+    _, base_operators = base_class.inline_tables()
+    opcodes = set()
+    for op in SOURCE_OPCODES:
+        if functions[op] is base_functions[op]:
+            opcodes.add(op)
+    if vm_class.COMPARE_OPERATORS is not base_class.COMPARE_OPERATORS:
+        opcodes.discard(_opcode('COMPARE_OP'))
+    for name in list(BINARY_SOURCE) + list(INPLACE_SOURCE):
+        op = _opcode(name)
+        if op >= 0 and operators[op] is not None and (
+            operators[op] is base_operators[op]
+        ):
+            opcodes.add(op)
+    for name in UNARY_SOURCE:
+        op = _opcode(name)
+        _, _, kind = name.partition('_')
+        fn = vm_class.UNARY_OPERATORS.get(kind)
+        if op >= 0 and not hasattr(vm_class, 'byte_' + name) and (
+            fn is not None and fn is base_class.UNARY_OPERATORS.get(kind)
+        ):
+            opcodes.add(op)
+    return opcodes
+
+
+def transpile(code, instructions, opcodes):
+    """Make a native function running `code`, or return None if we can't.
+
+    `instructions` are the decoded instructions of `code`, and `opcodes` the
+    set of opcodes we can transpile, from transpilable_opcodes.  The
+    function is called with the VM and the frame to run, which must already
+    be pushed, and returns the value the code returns.
+
+    """
+    source, constants = generate_source(code, instructions, opcodes)
+    if source is None:
+        return None
+    namespace = {'__builtins__': builtins}
+    exec(compile(
+        source, "<transpiled %s>" % code.co_name, "exec", dont_inherit=True,
+    ), namespace)
+    helpers = dict(HELPERS)
+    for i, const in enumerate(constants):
+        helpers['k%d' % i] = const
+    run = namespace['make'](**helpers)
+    run.source = source
+    return run
+
+
+def stack_states(code, instructions, opcodes):
+    """Work out the state of the stack before each instruction of `code`.
+
+    Returns a dict mapping offsets to (depth, loops), where `loops` is a
+    tuple of (end offset, depth) for the loops the instruction is in.  Only
+    the instructions that can run are in the dict.  Returns None if any of
+    them can't be transpiled.
+
+    """
+    states = {0: (0, ())}
+    todo = [0]
+    while todo:
+        offset = todo.pop()
+        depth, loops = states[offset]
+        opcode, arguments, after = instructions[offset]
+        if opcode not in opcodes:
+            return None
+        name = dis.opname[opcode]
+        if name == 'COMPARE_OP' and arguments[0] >= len(COMPARE_SOURCE):
+            # Exception matching only happens in handlers, which we don't do.
+            return None
+        successors = []
+        if name in ('JUMP_ABSOLUTE', 'JUMP_FORWARD'):
+            successors.append((arguments[0], depth, loops))
+        elif name in ('POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE'):
+            successors.append((arguments[0], depth - 1, loops))
+            successors.append((after, depth - 1, loops))
+        elif name in ('JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP'):
+            successors.append((arguments[0], depth, loops))
+            successors.append((after, depth - 1, loops))
+        elif name == 'FOR_ITER':
+            successors.append((arguments[0], depth - 1, loops))
+            successors.append((after, depth + 1, loops))
+        elif name == 'SETUP_LOOP':
+            successors.append((after, depth, loops + ((arguments[0], depth),)))
+        elif name == 'POP_BLOCK':
+            successors.append((after, depth, loops[:-1]))
+        elif name == 'BREAK_LOOP':
+            end, level = loops[-1]
+            successors.append((end, level, loops[:-1]))
+        elif name != 'RETURN_VALUE':
+            depth += stack_effect(name, arguments)
+            successors.append((after, depth, loops))
+        for successor, depth, loops in successors:
+            state = states.get(successor)
+            if state is None:
+                states[successor] = depth, loops
+                todo.append(successor)
+            elif state != (depth, loops):
+                return None
+    return states
+
+
+def stack_effect(name, arguments):
+    """How much the instruction `name` changes the stack depth by."""
+    if name in ('NOP', 'ROT_TWO', 'ROT_THREE', 'LOAD_ATTR', 'GET_ITER'):
+        return 0
+    if name in UNARY_SOURCE:
+        return 0
+    if name in ('DUP_TOP', 'LOAD_FAST', 'LOAD_CONST', 'LOAD_GLOBAL',
+                'BUILD_MAP'):
+        return 1
+    if name == 'STORE_ATTR':
+        return -2
+    if name == 'STORE_MAP':
+        return -2
+    if name == 'STORE_SUBSCR':
+        return -3
+    if name in ('BUILD_TUPLE', 'BUILD_LIST'):
+        return 1 - arguments[0]
+    if name == 'UNPACK_SEQUENCE':
+        return arguments[0] - 1
+    if name == 'CALL_FUNCTION':
+        return -(arguments[0] & 0xFF) - 2 * (arguments[0] >> 8)
+    # POP_TOP, STORE_FAST, LIST_APPEND, COMPARE_OP, binary operators.
+    return -1
+
+
+# The instructions that end a basic block, other than jumps.
+BLOCK_ENDS = set([
+    'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE', 'JUMP_IF_FALSE_OR_POP',
+    'JUMP_IF_TRUE_OR_POP', 'FOR_ITER', 'BREAK_LOOP', 'RETURN_VALUE',
+    'JUMP_ABSOLUTE', 'JUMP_FORWARD',
+])
+
+
+def generate_source(code, instructions, opcodes):
+    """Generate the source of the function transpile makes for `code`.
+
+    Returns the source, and the list of constants it uses as `k0`, `k1`,
+    and so on, or (None, None) if `code` can't be transpiled.
+
+    """
+    if code.co_flags & CO_GENERATOR or code.co_cellvars or code.co_freevars:
+        return None, None
+    if FRAME_NAMES.intersection(code.co_names):
+        return None, None
+    states = stack_states(code, instructions, opcodes)
+    if states is None:
+        return None, None
+
+    # Arguments are always bound, other locals may not be.
+    nargs = code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)
+    if code.co_flags & CO_VARARGS:
+        nargs += 1
+    if code.co_flags & CO_VARKEYWORDS:
+        nargs += 1
+
+    offsets = sorted(states)
+    starts = set([0])
+    for offset in offsets:
+        opcode, arguments, after = instructions[offset]
+        name = dis.opname[opcode]
+        if name in BLOCK_ENDS:
+            starts.add(after)
+        if opcode in dis.hasjrel or opcode in dis.hasjabs:
+            # Including the ends of loops, for BREAK_LOOP.
+            starts.add(arguments[0])
+
+    constants = []
+    const_names = {}
+
+    def const(value):
+        key = id(value)
+        if key not in const_names:
+            const_names[key] = 'k%d' % len(constants)
+            constants.append(value)
+        return const_names[key]
+
+    lines = []
+
+    def emit(indent, line):
+        lines.append(line and "    " * indent + line)
+
+    def goto(indent, offset, target):
+        emit(indent, "pc = %d" % target)
+        if target <= offset:
+            emit(indent, "continue")
+
+    # The parameters of make() are filled in at the end, once we know the
+    # constants.
+    emit(0, None)
+    emit(1, "def run(vm, frame):")
+    emit(2, "G = frame.f_globals")
+    emit(2, "B = frame.f_builtins")
+    if code.co_nlocals:
+        emit(2, "%s, = frame.fastlocals" % ", ".join(
+            "l%d" % slot for slot in range(code.co_nlocals)
+        ))
+    emit(2, "pc = 0")
+    emit(2, "while True:")
+    block_open = False
+    for offset in offsets:
+        depth, loops = states[offset]
+        opcode, arguments, after = instructions[offset]
+        name = dis.opname[opcode]
+        if offset in starts:
+            emit(3, "if pc == %d:" % offset)
+            block_open = True
+        elif not block_open:
+            continue
+        i = 4
+        top = "s%d" % (depth - 1)
+        second = "s%d" % (depth - 2)
+        push = "s%d" % depth
+        emit(i, "# %d: %s" % (offset, name))
+        if name in ('NOP', 'POP_TOP', 'SETUP_LOOP', 'POP_BLOCK'):
+            emit(i, "pass")
+        elif name == 'ROT_TWO':
+            emit(i, "%s, %s = %s, %s" % (second, top, top, second))
+        elif name == 'ROT_THREE':
+            third = "s%d" % (depth - 3)
+            emit(i, "%s, %s, %s = %s, %s, %s" % (
+                third, second, top, top, third, second,
+            ))
+        elif name == 'DUP_TOP':
+            emit(i, "%s = %s" % (push, top))
+        elif name == 'LOAD_FAST':
+            slot = arguments[0]
+            emit(i, "%s = l%d" % (push, slot))
+            if slot >= nargs:
+                emit(i, "if %s is UNBOUND:" % push)
+                emit(i + 1, "raise unbound_local_error(frame, %d)" % slot)
+        elif name == 'STORE_FAST':
+            emit(i, "l%d = %s" % (arguments[0], top))
+        elif name == 'LOAD_CONST':
+            emit(i, "%s = %s" % (push, const(arguments[0])))
+        elif name == 'LOAD_GLOBAL':
+            global_name = repr(str(arguments[0]))
+            emit(i, "if %s in G:" % global_name)
+            emit(i + 1, "%s = G[%s]" % (push, global_name))
+            emit(i, "elif %s in B:" % global_name)
+            emit(i + 1, "%s = B[%s]" % (push, global_name))
+            emit(i, "else:")
+            emit(i + 1, "raise NameError(%r)" % (
+                "global name '%s' is not defined" % arguments[0]
+            ))
+        elif name == 'LOAD_ATTR':
+            emit(i, "%s = %s.%s" % (top, top, arguments[0]))
+        elif name == 'STORE_ATTR':
+            emit(i, "%s.%s = %s" % (top, arguments[0], second))
+            emit(i, "if isinstance(%s, CACHED_TYPES):" % top)
+            emit(i + 1, "vm.attr_changed(%s)" % top)
+        elif name == 'STORE_SUBSCR':
+            emit(i, "%s[%s] = s%d" % (second, top, depth - 3))
+        elif name in UNARY_SOURCE:
+            emit(i, "%s = %s" % (top, UNARY_SOURCE[name] % top))
+        elif name in BINARY_SOURCE:
+            emit(i, "%s = %s" % (second, BINARY_SOURCE[name] % (second, top)))
+        elif name in INPLACE_SOURCE:
+            template = INPLACE_SOURCE[name]
+            if template.count('%s') == 3:
+                emit(i, template % (second, second, top))
+            else:
+                emit(i, template % (second, top))
+        elif name == 'COMPARE_OP':
+            emit(i, "%s = %s" % (
+                second, COMPARE_SOURCE[arguments[0]] % (second, top),
+            ))
+        elif name in ('BUILD_TUPLE', 'BUILD_LIST'):
+            count = arguments[0]
+            base = depth - count
+            items = ["s%d" % n for n in range(base, depth)]
+            if name == 'BUILD_TUPLE':
+                built = "(%s)" % "".join(item + ", " for item in items)
+            else:
+                built = "[%s]" % ", ".join(items)
+            emit(i, "s%d = %s" % (base, built))
+        elif name == 'BUILD_MAP':
+            emit(i, "%s = {}" % push)
+        elif name == 'STORE_MAP':
+            emit(i, "s%d[%s] = %s" % (depth - 3, top, second))
+        elif name == 'UNPACK_SEQUENCE':
+            count = arguments[0]
+            targets = [
+                "s%d" % n for n in reversed(range(depth - 1, depth - 1 + count))
+            ]
+            emit(i, "%s, = %s" % (", ".join(targets), top))
+        elif name == 'LIST_APPEND':
+            emit(i, "s%d.append(%s)" % (depth - 1 - arguments[0], top))
+        elif name == 'GET_ITER':
+            emit(i, "%s = ITER(%s)" % (top, top))
+        elif name == 'CALL_FUNCTION':
+            npos, nkw = arguments[0] & 0xFF, arguments[0] >> 8
+            base = depth - 1 - npos - 2 * nkw
+            func = "s%d" % base
+            args = ", ".join(
+                "s%d" % n for n in range(base + 1, base + 1 + npos)
+            )
+            kwargs = ", ".join(
+                "s%d: s%d" % (n, n + 1)
+                for n in range(base + 1 + npos, depth, 2)
+            )
+            emit(i, "frame.f_lasti = %d" % after)
+            emit(i, "if hasattr(%s, 'im_func') or %s is LOCALS:" % (
+                func, func,
+            ))
+            if code.co_nlocals:
+                emit(i + 1, "frame.fastlocals[:] = %s," % ", ".join(
+                    "l%d" % slot for slot in range(code.co_nlocals)
+                ))
+            emit(i + 1, "%s = call_function(frame, %s, [%s], {%s})" % (
+                func, func, args, kwargs,
+            ))
+            emit(i, "else:")
+            if kwargs:
+                args += (", " if args else "") + "**{%s}" % kwargs
+            emit(i + 1, "%s = %s(%s)" % (func, func, args))
+        elif name == 'RETURN_VALUE':
+            emit(i, "return %s" % top)
+        elif name in ('JUMP_ABSOLUTE', 'JUMP_FORWARD'):
+            goto(i, offset, arguments[0])
+        elif name == 'BREAK_LOOP':
+            goto(i, offset, loops[-1][0])
+        elif name in ('POP_JUMP_IF_FALSE', 'JUMP_IF_FALSE_OR_POP'):
+            emit(i, "if not %s:" % top)
+            goto(i + 1, offset, arguments[0])
+            emit(i, "else:")
+            goto(i + 1, offset, after)
+        elif name in ('POP_JUMP_IF_TRUE', 'JUMP_IF_TRUE_OR_POP'):
+            emit(i, "if %s:" % top)
+            goto(i + 1, offset, arguments[0])
+            emit(i, "else:")
+            goto(i + 1, offset, after)
+        elif name == 'FOR_ITER':
+            emit(i, "try:")
+            emit(i + 1, "%s = NEXT(%s)" % (push, top))
+            emit(i, "except StopIteration:")
+            goto(i + 1, offset, arguments[0])
+            emit(i, "else:")
+            goto(i + 1, offset, after)
+        else:       # pragma: no cover
+            raise AssertionError("Can't transpile %s" % name)
+
+        if name in BLOCK_ENDS:
+            block_open = False
+        elif after in starts:
+            # Fall into the next block.
+            goto(i, offset, after)
+            block_open = False
+    emit(1, "return run")
+
+    lines[0] = "def make(%s):" % ", ".join(
+        sorted(HELPERS) + ['k%d' % i for i in range(len(constants))]
+    )
+    return "\n".join(lines) + "\n", constants
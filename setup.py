@@ -9,6 +9,6 @@ setup(
     author='Ned Batchelder',
     author_email='ned@nedbatchelder.com',
     url='http://github.com/nedbat/byterun',
-    packages=['byterun'],
+    packages=['byterun', 'byterun.bench'],
     install_requires=['six'],
     )
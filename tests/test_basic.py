@@ -5,6 +5,8 @@ from . import vmtest
 
 import six
 
+from byterun.pyvm2 import VirtualMachine
+
 PY3, PY2 = six.PY3, not six.PY3
 
 
@@ -75,6 +77,9 @@ class TestIt(vmtest.VmTestCase):
                 x /= y
                 assert x == 2 and y == 3
                 assert isinstance(x, int)
+                x = 7.0
+                x /= 2
+                assert x == 3.5
                 """)
     elif PY3:
         def test_inplace_division(self):
@@ -88,6 +93,16 @@ class TestIt(vmtest.VmTestCase):
                 assert isinstance(x, float)
                 """)
 
+    def test_unpacking_mismatches(self):
+        self.assert_ok("""\
+            a, b, c = "xyz"
+            x, (y, z) = 1, [2, 3]
+            print(a, b, c, x, y, z)
+            """)
+        self.assert_ok("a, b = [1, 2, 3]", raises=ValueError)
+        self.assert_ok("a, b, c = [1, 2]", raises=ValueError)
+        self.assert_ok("a, b = [1]", raises=ValueError)
+
     def test_slice(self):
         self.assert_ok("""\
             print("hello, world"[3:8])
@@ -649,3 +664,209 @@ class TestComparisons(vmtest.VmTestCase):
             assert "z" > "a"
             assert "z" >= "a" and "z" >= "z"
             """)
+
+
+class TestDispatch(vmtest.VmTestCase):
+    def test_subclass_handlers_are_used(self):
+        class AddingVM(VirtualMachine):
+            def byte_BINARY_ADD(self):
+                x, y = self.popn(2)
+                self.push((x, "+", y))
+
+        code = compile("a = 1\nresult = a + 2", "<dispatch>", "exec")
+        for engine in VirtualMachine.ENGINES:
+            env = {'__builtins__': __builtins__}
+            AddingVM(engine=engine).run_code(code, f_globals=env)
+            self.assertEqual(env['result'], (1, "+", 2))
+
+            # The base class still has its own table.
+            env = {'__builtins__': __builtins__}
+            VirtualMachine(engine=engine).run_code(code, f_globals=env)
+            self.assertEqual(env['result'], 3)
+
+    def test_overriding_half_a_superinstruction(self):
+        loaded = []
+
+        class LoggingVM(VirtualMachine):
+            def byte_LOAD_FAST(self, slot):
+                loaded.append(slot)
+                return VirtualMachine.byte_LOAD_FAST(self, slot)
+
+        code = compile(
+            "def add(a, b):\n    return a + b\nresult = add(3, 4)",
+            "<superinstruction>", "exec",
+        )
+        for engine in VirtualMachine.ENGINES:
+            del loaded[:]
+            env = {'__builtins__': __builtins__}
+            LoggingVM(engine=engine).run_code(code, f_globals=env)
+            self.assertEqual(env['result'], 7)
+            self.assertEqual(loaded, [0, 1])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            VirtualMachine(engine='warp')
+
+
+class TestBuiltins(vmtest.VmTestCase):
+    def test_shadowing_builtins(self):
+        self.assert_ok("""\
+            def size(x):
+                return len(x)
+            print(size("abc"))
+            len = lambda x: 17
+            print(size("abc"))
+            del len
+            print(size("abc"))
+            """)
+
+    def test_changing_builtins(self):
+        self.assert_ok("""\
+            try:
+                import __builtin__ as builtins
+            except ImportError:
+                import builtins
+            def answer():
+                return the_answer
+            builtins.the_answer = 17
+            try:
+                print(answer())
+                builtins.the_answer = 42
+                print(answer())
+            finally:
+                del builtins.the_answer
+            try:
+                answer()
+            except NameError:
+                print("Gone")
+            """)
+
+    def test_changing_builtins_natively(self):
+        # Changes made by native code are seen too.
+        self.assert_ok("""\
+            try:
+                import __builtin__ as builtins
+            except ImportError:
+                import builtins
+            def answer():
+                return the_answer
+            setattr(builtins, 'the_answer', 1)
+            try:
+                print(answer())
+                setattr(builtins, 'the_answer', 2)
+                print(answer())
+                builtins.__dict__['the_answer'] = 3
+                print(answer())
+                builtins.__dict__.update(the_answer=None)
+                print(answer())
+            finally:
+                delattr(builtins, 'the_answer')
+            try:
+                answer()
+            except NameError:
+                print("Gone")
+            """)
+
+
+class TestAttrCaches(vmtest.VmTestCase):
+    def test_methods(self):
+        self.assert_ok("""\
+            class Thing(object):
+                def __init__(self, x):
+                    self.x = x
+                def meth(self):
+                    return self.x
+            class Other(Thing):
+                def meth(self):
+                    return -self.x
+            class Slotted(object):
+                __slots__ = ['x']
+                def meth(self):
+                    return self.x * 10
+            class Odd(object):
+                meth = 99
+            things = [Thing(1), Other(2), Thing(3)]
+            s = Slotted()
+            s.x = 4
+            things.append(s)
+            for thing in things:
+                print(thing.meth())
+            print(Odd().meth)
+            # The instance's dict hides the method.
+            things[0].meth = lambda: "shadow"
+            print([thing.meth() for thing in things])
+            del things[0].meth
+            print([thing.meth() for thing in things])
+            # Changing the class changes the method.
+            Thing.meth = lambda self: "changed"
+            print([thing.meth() for thing in things])
+            things[1].__class__ = Thing
+            print([thing.meth() for thing in things])
+            """)
+
+    def test_changing_classes_natively(self):
+        # Classes changed by code the VM doesn't run are seen too.
+        self.assert_ok("""\
+            class A(object):
+                def m(self):
+                    return 'a'
+            class B(A):
+                pass
+            def b(self):
+                return 'b'
+            def c(self):
+                return 'c'
+            def d(self):
+                return 'd'
+            def call(x):
+                return x.m()
+            a, sub = A(), B()
+            out = [call(a), call(sub)]
+            setattr(A, 'm', c)
+            out += [call(a), call(sub)]
+            type.__setattr__(B, 'm', b)
+            out += [call(a), call(sub)]
+            setattr(A, 'm', d)
+            out += [call(a), call(sub)]
+            delattr(B, 'm')
+            out += [call(a), call(sub)]
+            class C(object):
+                def m(self):
+                    return 'c2'
+            setattr(B, '__bases__', (C,))
+            out += [call(a), call(sub)]
+            print(",".join(out))
+            """)
+
+    def test_setting_attributes(self):
+        self.assert_ok("""\
+            import math
+            class Thing(object):
+                pass
+            def set_it(obj, value):
+                obj.it = value
+            t = Thing()
+            set_it(t, 1)
+            set_it(Thing, 2)
+            set_it(t, 3)
+            set_it(math, 4)
+            print(t.it, Thing.it, math.it)
+            del math.it
+            """)
+
+    def test_stats(self):
+        for engine in VirtualMachine.ENGINES:
+            code = compile(
+                "class Thing(object):\n"
+                "    def meth(self):\n"
+                "        return 1\n"
+                "t = Thing()\n"
+                "for i in range(10):\n"
+                "    t.meth()\n",
+                "<stats>", "exec",
+            )
+            vm = VirtualMachine(engine=engine)
+            env = {'__builtins__': __builtins__}
+            vm.run_code(code, f_globals=env)
+            stats = vm.attr_cache_stats()
+            self.assertEqual((stats['hits'], stats['misses']), (9, 1), engine)
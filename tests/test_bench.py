@@ -0,0 +1,40 @@
+"""Test the benchmarks, for Byterun."""
+
+from __future__ import print_function
+
+import unittest
+
+from byterun.bench import all_benchmarks, load, run_benchmark
+from byterun.bench.memory import measure_memory
+from byterun.pyvm2 import VirtualMachine
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_benchmarks_run_the_same(self):
+        # Every benchmark, made small, gets the same result in the VM.
+        for bench in all_benchmarks():
+            n = min(bench.n, 10)
+            expected = load(bench)(n)
+            for engine in VirtualMachine.ENGINES:
+                vm = VirtualMachine(engine=engine)
+                self.assertEqual(
+                    load(bench, vm)(n), expected,
+                    "%s with the %r engine" % (bench.name, engine),
+                )
+
+    def test_results(self):
+        bench = all_benchmarks()[0]
+        result = run_benchmark(bench, repeat=3, n=10)
+        self.assertEqual(result['kind'], 'micro')
+        self.assertEqual(len(result['times']), 3)
+        self.assertEqual(result['warmup_time'], result['times'][0])
+        self.assertGreater(result['instructions'], 10)
+        self.assertGreater(result['instructions_per_second'], 0)
+        self.assertGreater(result['slowdown'], 0)
+
+    def test_memory(self):
+        sizes = measure_memory(depth=5)
+        self.assertEqual(sorted(sizes), ['closure', 'frame', 'generator'])
+        for kind, (vm_size, native_size) in sizes.items():
+            self.assertGreater(vm_size, 0, kind)
+            self.assertGreater(native_size, 0, kind)
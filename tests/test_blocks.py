@@ -0,0 +1,167 @@
+"""Test the block tables made when decoding, for Byterun."""
+
+from __future__ import print_function
+from . import vmtest
+
+import dis
+import textwrap
+import unittest
+
+import six
+from six.moves import builtins
+
+from byterun.blocks import Block, block_table
+from byterun.decode import decode_instructions
+from byterun.pyvm2 import VirtualMachine
+
+
+def function_code(source, name='f'):
+    """Compile `source`, and get the code of the function `name` in it."""
+    code = compile(textwrap.dedent(source), "<test>", "exec")
+    for const in code.co_consts:
+        if getattr(const, 'co_name', None) == name:
+            return const
+    raise ValueError("No function %r" % (name,))
+
+
+@unittest.skipIf(six.PY3, "Python 3 frames push their blocks")
+class TestBlockTable(vmtest.VmTestCase):
+    def test_table(self):
+        code = function_code("""\
+            def f(seq):
+                for x in seq:
+                    try:
+                        x()
+                    except ValueError:
+                        break
+            """)
+        instructions = decode_instructions(code)
+        handlers = dict(
+            (dis.opname[instr.opcode], instr.arguments[0])
+            for instr in instructions
+            if instr is not None and 'SETUP' in dis.opname[instr.opcode]
+        )
+        loop = Block('loop', handlers['SETUP_LOOP'], 0)
+        # The iterator is on the stack below the try block's level.
+        try_block = Block('setup-except', handlers['SETUP_EXCEPT'], 1)
+        table = block_table(instructions)
+        self.assertEqual(table[0], ())
+        self.assertEqual(table[-1], ())
+        self.assertEqual(
+            set(table), set([(), (loop,), (loop, try_block)]),
+        )
+
+    def test_blocks_in_finally(self):
+        # How deep the stack is in a finally clause depends on how it was
+        # entered, so blocks in one can't be known beforehand.
+        code = function_code("""\
+            def f(seq):
+                try:
+                    pass
+                finally:
+                    for x in seq:
+                        pass
+            """)
+        self.assertIsNone(block_table(decode_instructions(code)))
+        self.assert_ok("""\
+            def f(seq):
+                try:
+                    raise ValueError()
+                finally:
+                    for x in seq:
+                        if x:
+                            break
+            try:
+                f([0, 1])
+            except ValueError:
+                print("caught")
+            """)
+
+    def test_no_blocks_pushed(self):
+        pushed = []
+
+        class CountingVM(VirtualMachine):
+            def push_block(self, type, handler=None, level=None):
+                pushed.append(type)
+                VirtualMachine.push_block(self, type, handler, level)
+
+        source = textwrap.dedent("""\
+            def f(n):
+                total = 0
+                while n:
+                    n -= 1
+                    try:
+                        total += 10 // (n % 3)
+                    except ZeroDivisionError:
+                        continue
+                return total
+            answer = f(10)
+            """)
+        for engine in VirtualMachine.ENGINES:
+            del pushed[:]
+            vm = CountingVM(engine=engine)
+            env = {'__builtins__': builtins, '__name__': '__main__'}
+            vm.run_code(compile(source, "<test>", "exec"), f_globals=env)
+            self.assertEqual(env['answer'], 45)
+            self.assertEqual(pushed, [], engine)
+
+    def test_overridden_handlers(self):
+        # A class that changes how blocks are pushed keeps pushing them.
+        pushed = []
+
+        class LoopVM(VirtualMachine):
+            def byte_SETUP_LOOP(self, dest):
+                pushed.append(dest)
+                self.push_block('loop', dest)
+
+        self.assertTrue(VirtualMachine.uses_block_tables())
+        self.assertFalse(LoopVM.uses_block_tables())
+        env = {'__builtins__': builtins, '__name__': '__main__'}
+        LoopVM().run_code(compile(textwrap.dedent("""\
+            total = 0
+            for x in range(5):
+                if x == 3:
+                    break
+                total += x
+            """), "<test>", "exec"), f_globals=env)
+        self.assertEqual(env['total'], 3)
+        self.assertEqual(len(pushed), 1)
+
+    def test_with_enter_fails(self):
+        # __enter__ failing leaves no with block to unwind.
+        self.assert_ok("""\
+            class Bad(object):
+                def __enter__(self):
+                    raise ValueError("no")
+                def __exit__(self, *args):
+                    print("exit")
+            def f():
+                for i in range(2):
+                    try:
+                        with Bad():
+                            print("inside")
+                    except ValueError:
+                        print("caught")
+                return i
+            print(f())
+            """)
+
+    def test_unwinding_through_finally(self):
+        self.assert_ok("""\
+            def f():
+                out = []
+                for i in range(4):
+                    try:
+                        try:
+                            if i == 1:
+                                continue
+                            if i == 3:
+                                return out
+                            out.append(1 // (i - 2))
+                        finally:
+                            out.append("f%d" % i)
+                    except ZeroDivisionError:
+                        out.append("z")
+                return out
+            print(f())
+            """)
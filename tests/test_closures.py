@@ -0,0 +1,88 @@
+"""Test the closure engine, for Byterun."""
+
+from __future__ import print_function
+from . import vmtest
+
+import textwrap
+
+from six.moves import builtins
+
+from byterun.blocks import WHY_EXCEPTION
+from byterun.pyvm2 import VirtualMachine
+
+
+def run(vm, source):
+    code = compile(textwrap.dedent(source), "<closures>", "exec")
+    env = {'__builtins__': builtins, '__name__': '__main__'}
+    vm.run_code(code, f_globals=env)
+    return code, env
+
+
+class TestClosureEngine(vmtest.VmTestCase):
+    def test_blocks_are_compiled_when_run(self):
+        vm = VirtualMachine(engine='closure')
+        code, env = run(vm, """\
+            def f(x):
+                if x:
+                    return "yes"
+                return "no"
+            answer = f(1)
+            """)
+        self.assertEqual(env['answer'], "yes")
+        decoded = vm.decode_cache.get(env['f'].func_code)
+        compiled = decoded.closures[(VirtualMachine, False)]
+        # The block for `return "no"` never ran, so was never compiled.
+        self.assertEqual(
+            len([block for block in compiled.blocks if block is not None]),
+            2,
+        )
+
+    def test_exception_offsets(self):
+        # Exceptions from the middle of a block leave f_lasti just after the
+        # instruction that raised, as the other engines do.
+        class LineVM(VirtualMachine):
+            def manage_block_stack(self, why):
+                if why == WHY_EXCEPTION:
+                    lines.append(self.frame.line_number())
+                return VirtualMachine.manage_block_stack(self, why)
+
+        source = """\
+            def f(d):
+                total = 0
+                for k in "abc":
+                    try:
+                        total += 1
+                        total += d[k]
+                        total += 1
+                    except KeyError:
+                        total += 10
+                return total
+            answer = f({'a': 1})
+            """
+        results = []
+        for engine in VirtualMachine.ENGINES:
+            lines = []
+            _, env = run(LineVM(engine=engine), source)
+            results.append((env['answer'], lines))
+        self.assertEqual(results[0], (25, [6, 6]))
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
+
+    def test_jumps_are_followed(self):
+        vm = VirtualMachine(engine='closure')
+        code, env = run(vm, """\
+            def f(n):
+                total = 0
+                while n:
+                    n -= 1
+                    total += n
+                return total
+            answer = f(5)
+            """)
+        self.assertEqual(env['answer'], 10)
+        decoded = vm.decode_cache.get(env['f'].func_code)
+        compiled = decoded.closures[(VirtualMachine, False)]
+        # The loop body goes on to test the loop condition again, instead of
+        # jumping back to it: there's no block starting at the test.
+        blocks = [block for block in compiled.blocks if block is not None]
+        self.assertEqual(len(blocks), 3)
@@ -0,0 +1,125 @@
+"""Test the on-disk code cache, for Byterun."""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from six.moves import builtins
+
+from byterun.codecache import CodeCache, code_objects
+from byterun.decode import DecodeCache, DecodedCode
+from byterun.pyvm2 import VirtualMachine
+
+
+SOURCE = """\
+def fact(n):
+    if n <= 1:
+        return 1
+    return n * fact(n - 1)
+class Thing(object):
+    def value(self):
+        return [fact(i) for i in range(6)]
+answer = Thing().value()
+"""
+
+
+class TestCodeCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, "cache")
+        self.filename = os.path.join(self.tempdir, "prog.py")
+        self.write_source(SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_source(self, source):
+        with open(self.filename, "w") as f:
+            f.write(source)
+
+    def compile(self, cache, source=SOURCE):
+        decode_cache = DecodeCache()
+        code = cache.compile(source, self.filename, decode_cache)
+        return code, decode_cache
+
+    def run_code(self, code, decode_cache):
+        vm = VirtualMachine(decode_cache=decode_cache)
+        globs = {'__builtins__': builtins, '__name__': '__main__'}
+        vm.run_code(code, f_globals=globs)
+        return globs['answer']
+
+    def test_hits(self):
+        cache = CodeCache(self.cachedir)
+        first, _ = self.compile(cache)
+        code, decode_cache = self.compile(cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(code, first)
+
+        # What was loaded is what decoding gets.
+        self.assertEqual(len(decode_cache), len(code_objects(code)))
+        for each in code_objects(code):
+            loaded = decode_cache.get(each)
+            decoded = DecodedCode(each)
+            self.assertEqual(loaded.fused, decoded.fused)
+            self.assertEqual(loaded.lines.offsets, decoded.lines.offsets)
+
+        # Every code object was decoded from the cache, none by the VM.
+        self.assertEqual(
+            self.run_code(code, decode_cache), [1, 1, 2, 6, 24, 120]
+        )
+        self.assertEqual(decode_cache.misses, 0)
+
+    def test_changed_source(self):
+        cache = CodeCache(self.cachedir)
+        self.compile(cache)
+        source = SOURCE.replace("range(6)", "range(3)")
+        self.write_source(source)
+        code, decode_cache = self.compile(cache, source)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(self.run_code(code, decode_cache), [1, 1, 2])
+        self.compile(cache, source)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_bad_entries(self):
+        cache = CodeCache(self.cachedir)
+        self.compile(cache)
+        path = cache.entry_path(self.filename)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+        code, decode_cache = self.compile(cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(
+            self.run_code(code, decode_cache), [1, 1, 2, 6, 24, 120]
+        )
+        # It was rewritten.
+        self.compile(cache)
+        self.assertEqual(cache.hits, 1)
+
+    def test_eviction(self):
+        cache = CodeCache(self.cachedir)
+        filenames = []
+        for i in range(3):
+            filename = os.path.join(self.tempdir, "prog%d.py" % i)
+            with open(filename, "w") as f:
+                f.write(SOURCE)
+            filenames.append(filename)
+        cache.compile(SOURCE, filenames[0], DecodeCache())
+        size = os.path.getsize(cache.entry_path(filenames[0]))
+        cache.maxsize = 2 * size
+
+        # Make the first entry more recently used than the second.
+        cache.compile(SOURCE, filenames[1], DecodeCache())
+        past = time.time() - 100
+        os.utime(cache.entry_path(filenames[0]), (past, past))
+        os.utime(cache.entry_path(filenames[1]), (past - 10, past - 10))
+        cache.compile(SOURCE, filenames[0], DecodeCache())
+        cache.compile(SOURCE, filenames[2], DecodeCache())
+
+        self.assertEqual(len(cache.entries()), 2)
+        self.assertTrue(os.path.exists(cache.entry_path(filenames[0])))
+        self.assertFalse(os.path.exists(cache.entry_path(filenames[1])))
+        self.assertTrue(os.path.exists(cache.entry_path(filenames[2])))
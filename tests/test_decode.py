@@ -0,0 +1,148 @@
+"""Tests of bytecode decoding for Byterun."""
+
+from __future__ import print_function
+
+import dis
+import gc
+import unittest
+
+import six
+
+from byterun.decode import (
+    DecodeCache, LineTable, decode_instructions, fuse_instructions, opmap,
+)
+
+
+def sample_code():
+    return compile("x = 1\nfor i in range(3):\n    x += i\n", "<sample>", "exec")
+
+
+class TestDecodeInstructions(unittest.TestCase):
+    def test_offsets_and_arguments(self):
+        code = sample_code()
+        instructions = decode_instructions(code)
+        self.assertEqual(len(instructions), len(code.co_code))
+
+        offset = 0
+        names = []
+        while offset < len(instructions):
+            instr = instructions[offset]
+            names.append(dis.opname[instr.opcode])
+            if instr.opcode == dis.opmap['LOAD_CONST']:
+                self.assertIn(instr.arguments[0], code.co_consts)
+            if instr.opcode < dis.HAVE_ARGUMENT:
+                self.assertEqual(instr.arguments, ())
+            # The bytes in between instructions are never instructions.
+            for other in instructions[offset+1:instr.next]:
+                self.assertIsNone(other)
+            offset = instr.next
+        self.assertIn('FOR_ITER', names)
+        self.assertEqual(names[-1], 'RETURN_VALUE')
+
+
+class TestLineTable(unittest.TestCase):
+    def linear_line_number(self, code, offset):
+        # The straightforward way: walk co_lnotab from the start.
+        lnotab = code.co_lnotab
+        byte_num = 0
+        line_num = code.co_firstlineno
+        for byte_incr, line_incr in zip(
+            six.iterbytes(lnotab[0::2]), six.iterbytes(lnotab[1::2])
+        ):
+            byte_num += byte_incr
+            if byte_num > offset:
+                break
+            line_num += line_incr
+        return line_num
+
+    def test_line_numbers(self):
+        # Blank lines and a long expression make multi-entry jumps in
+        # co_lnotab, in lines and in bytes.
+        source = (
+            "x = 1\n" +
+            "\n" * 300 +
+            "y = [\n" + "    x,\n" * 200 + "]\n"
+            "for i in y:\n"
+            "    x += i\n"
+        )
+        code = compile(source, "<lines>", "exec")
+        table = LineTable(code)
+        for offset in range(len(code.co_code)):
+            self.assertEqual(
+                table.line_number(offset),
+                self.linear_line_number(code, offset),
+            )
+        self.assertEqual(table.starts, set(table.offsets))
+        self.assertEqual(table.lines[:2], [1, 303])
+        self.assertEqual(max(table.lines), 505)
+
+
+class TestSuperinstructions(unittest.TestCase):
+    def test_pairs_are_fused(self):
+        def fn(a, b):
+            for x in a:
+                if x < b:
+                    return 17
+            return a.real
+        code = fn.__code__
+        instructions = decode_instructions(code)
+        fused = fuse_instructions(instructions)
+
+        names = set()
+        for offset, instr in enumerate(fused):
+            if instr is None:
+                continue
+            plain = instructions[offset]
+            if instr is not plain:
+                names.add(instr.opcode)
+                # The superinstruction moves to the second instruction, which
+                # is still there to be jumped to.
+                self.assertEqual(instr.next, plain.next)
+                second = fused[plain.next]
+                self.assertIsNotNone(second)
+                self.assertEqual(instr.arguments[-1], second.next)
+        self.assertEqual(names, set([
+            opmap['FOR_ITER__STORE_FAST'],
+            opmap['LOAD_FAST__LOAD_FAST'],
+            opmap['COMPARE_OP__POP_JUMP_IF_FALSE'],
+            opmap['LOAD_CONST__RETURN_VALUE'],
+            opmap['LOAD_FAST__LOAD_ATTR'],
+        ]))
+
+
+class TestDecodeCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = DecodeCache()
+        code = sample_code()
+        first = cache.get(code)
+        self.assertIs(cache.get(code), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # An equal, but distinct, code object gets its own entry.
+        other = sample_code()
+        self.assertEqual(other, code)
+        self.assertIsNot(cache.get(other), first)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_lru_eviction(self):
+        cache = DecodeCache(maxsize=2)
+        codes = [compile("a = %d" % i, "<lru>", "exec") for i in range(3)]
+        cache.get(codes[0])
+        cache.get(codes[1])
+        cache.get(codes[0])
+        cache.get(codes[2])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        # codes[1] was least recently used, so it was evicted.
+        cache.get(codes[0])
+        cache.get(codes[1])
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_collected_code_is_dropped(self):
+        cache = DecodeCache()
+        code = sample_code()
+        cache.get(code)
+        self.assertEqual(len(cache), 1)
+        del code
+        gc.collect()
+        self.assertEqual(len(cache), 0)
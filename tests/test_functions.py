@@ -2,7 +2,13 @@
 
 from __future__ import print_function
 from . import vmtest
+
+import textwrap
+
 import six
+from six.moves import builtins
+
+from byterun.pyvm2 import VirtualMachine
 
 PY3 = six.PY3
 
@@ -96,6 +102,82 @@ class TestFunctions(vmtest.VmTestCase):
             fn()
             """)
 
+    def test_locals(self):
+        self.assert_ok("""\
+            def fn(a, b=17):
+                c = a + b
+                print(sorted(locals().items()))
+                print(locals() is locals())
+                del c
+                print(sorted(locals().keys()))
+            fn(1)
+            """)
+
+    def test_unbound_local(self):
+        self.assert_ok("""\
+            def fn():
+                x = 1
+                del x
+                return x
+            fn()
+            """, raises=UnboundLocalError)
+
+    def test_bad_calls(self):
+        self.assert_ok("""\
+            def none(): pass
+            def one(a): pass
+            def two(a, b=2): pass
+            def three(a, b, c=3, *args): pass
+            def kw(a, **kwargs): pass
+            calls = [
+                lambda: none(1),
+                lambda: none(x=1),
+                lambda: one(),
+                lambda: one(1, 2),
+                lambda: one(b=1),
+                lambda: one(1, a=1),
+                lambda: two(),
+                lambda: two(1, 2, 3),
+                lambda: two(b=1),
+                lambda: three(1),
+                lambda: three(b=1, c=1),
+                lambda: kw(1, a=2),
+                lambda: kw(b=2),
+            ]
+            for call in calls:
+                try:
+                    call()
+                except TypeError as e:
+                    print(e)
+                else:
+                    print("No error!")
+            """)
+
+    def test_arguments_in_cells(self):
+        self.assert_ok("""\
+            def fn(a, b=2, *args, **kwargs):
+                def inner():
+                    return a, b, args, kwargs
+                return inner()
+            print(fn(1))
+            print(fn(1, b=3))
+            print(fn(1, 2, 3, c=4))
+            """)
+
+    def test_function_attributes(self):
+        self.assert_ok("""\
+            fns = []
+            for i in range(3):
+                def fn():
+                    "A docstring."
+                    return i
+                fns.append(fn)
+            fns[1].tag = "one"
+            print(fns[1].tag, fns[1].__dict__)
+            print(fns[0].__name__, fns[0].__doc__, fns[0].__dict__)
+            assert not hasattr(fns[2], "tag")
+            """)
+
     def test_partial(self):
         self.assert_ok("""\
             from _functools import partial
@@ -229,6 +311,52 @@ class TestFunctions(vmtest.VmTestCase):
             """)
 
 
+class TestFramePool(vmtest.VmTestCase):
+    def test_reused_frames_start_fresh(self):
+        self.assert_ok("""\
+            def f(x, first):
+                if first:
+                    y = x
+                return sorted(locals().items())
+            print(f(1, True))
+            print(f(2, False))
+            """)
+
+    def test_reused_frames_keep_nothing(self):
+        self.assert_ok("""\
+            import weakref
+            class Thing(object):
+                pass
+            def f(x):
+                return 1
+            thing = Thing()
+            ref = weakref.ref(thing)
+            f(thing)
+            del thing
+            print(ref() is None)
+            """)
+
+    def test_frames_in_use_arent_reused(self):
+        frames = []
+
+        def trace(frame, event, arg):
+            if event == 'call' and frame.f_code.co_name == 'f':
+                frames.append(frame)
+
+        vm = VirtualMachine()
+        vm.settrace(trace)
+        env = {'__builtins__': builtins, '__name__': '__main__'}
+        vm.run_code(compile(textwrap.dedent("""\
+            def f(x):
+                return x
+            f(1)
+            f(2)
+            """), "<test>", "exec"), f_globals=env)
+        self.assertIsNot(frames[0], frames[1])
+        self.assertEqual(frames[0].f_locals, {'x': 1})
+        self.assertEqual(vm.spare_frames, {})
+
+
 class TestClosures(vmtest.VmTestCase):
     def test_closures(self):
         self.assert_ok("""\
@@ -296,6 +424,75 @@ class TestClosures(vmtest.VmTestCase):
             assert answer == 54
             """)
 
+    def test_closures_called_elsewhere(self):
+        # A closure's cells are its own, not whatever its caller has with
+        # the same names.
+        self.assert_ok("""\
+            def make(x):
+                def get():
+                    return x
+                return get
+            def use(fn):
+                x = 'wrong'
+                def inner():
+                    return x
+                return fn(), inner()
+            print(use(make('right')))
+            """)
+
+    def test_closures_in_class_bodies(self):
+        self.assert_ok("""\
+            def make(n):
+                class Thing(object):
+                    size = n
+                    def get(self):
+                        return n * 2
+                return Thing
+            Thing = make(4)
+            print(Thing.size, Thing().get())
+            """)
+
+    def test_cells_in_locals(self):
+        self.assert_ok("""\
+            def f(a):
+                b = 2
+                def g():
+                    return a + b
+                return sorted(locals())
+            print(f(1))
+            """)
+
+    def test_cells_holding_none(self):
+        self.assert_ok("""\
+            def f():
+                x = None
+                g = lambda: x
+                return sorted(locals()), locals()['x']
+            def h():
+                g = lambda: y
+                before = sorted(locals())
+                y = None
+                return before, sorted(locals())
+            print(f())
+            print(h())
+            """)
+
+    def test_unassigned_cells(self):
+        self.assert_ok("""\
+            def f():
+                print(x)
+                x = 1
+                return lambda: x
+            f()
+            """, raises=UnboundLocalError)
+        self.assert_ok("""\
+            def f():
+                g = lambda: x
+                g()
+                x = 1
+            f()
+            """, raises=NameError)
+
 
 class TestGenerators(vmtest.VmTestCase):
     def test_first(self):
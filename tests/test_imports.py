@@ -0,0 +1,127 @@
+"""Test interpreting imported modules, for Byterun."""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from six.moves import builtins
+
+from byterun.execfile import CompiledSources, InterpretedImporter
+from byterun.pyobj import Function
+from byterun.pyvm2 import VirtualMachine
+
+
+FILES = {
+    'bytepkg/__init__.py': """\
+        from __future__ import absolute_import
+        NAME = 'bytepkg'
+        """,
+    'bytepkg/helper.py': """\
+        def double(x):
+            return x * 2
+        """,
+    'bytepkg/mod.py': """\
+        from __future__ import absolute_import
+        from . import helper
+        import plainmod
+        def quadruple(x):
+            return helper.double(helper.double(x))
+        VALUE = quadruple(plainmod.THREE)
+        """,
+    'plainmod.py': """\
+        THREE = 3
+        def native():
+            pass
+        """,
+}
+
+MODULES = ['bytepkg', 'bytepkg.helper', 'bytepkg.mod', 'plainmod']
+
+
+class TestInterpretedImporter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for name, source in FILES.items():
+            path = os.path.join(self.tempdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(textwrap.dedent(source))
+        sys.path.insert(0, self.tempdir)
+
+    def tearDown(self):
+        sys.path.remove(self.tempdir)
+        for name in MODULES:
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.tempdir)
+
+    def run_import(self, sources):
+        vm = VirtualMachine()
+        code = compile(
+            "import bytepkg.mod\nvalue = bytepkg.mod.VALUE\n",
+            "<imports>", "exec",
+        )
+        globs = {'__builtins__': builtins, '__name__': '__main__'}
+        with InterpretedImporter(vm, ['bytepkg'], sources) as importer:
+            self.assertIn(importer, sys.meta_path)
+            vm.run_code(code, f_globals=globs)
+        self.assertNotIn(importer, sys.meta_path)
+        self.assertEqual(globs['value'], 12)
+
+    def test_imports(self):
+        sources = CompiledSources()
+        self.run_import(sources)
+        # Matching modules were interpreted, others imported natively.
+        mod = sys.modules['bytepkg.mod']
+        self.assertIsInstance(mod.quadruple, Function)
+        self.assertIsInstance(sys.modules['bytepkg.helper'].double, Function)
+        self.assertNotIsInstance(sys.modules['plainmod'].native, Function)
+        self.assertEqual(sys.modules['bytepkg'].__path__, [
+            os.path.join(self.tempdir, 'bytepkg'),
+        ])
+        self.assertEqual(mod.__package__, 'bytepkg')
+        self.assertEqual((sources.hits, sources.misses), (0, 3))
+
+        # Importing again in another VM reuses the code objects.
+        code = mod.quadruple.func_code
+        for name in MODULES:
+            del sys.modules[name]
+        self.run_import(sources)
+        self.assertEqual((sources.hits, sources.misses), (3, 3))
+        self.assertIs(sys.modules['bytepkg.mod'].quadruple.func_code, code)
+
+    def test_failed_import(self):
+        with open(os.path.join(self.tempdir, 'bytepkg/helper.py'), "a") as f:
+            f.write("1/0\n")
+        with self.assertRaises(ZeroDivisionError):
+            self.run_import(CompiledSources())
+        self.assertNotIn('bytepkg.helper', sys.modules)
+        self.assertNotIn('bytepkg.mod', sys.modules)
+
+    def test_load_without_find(self):
+        # A module on sys.path with the same name as a submodule.
+        with open(os.path.join(self.tempdir, 'helper.py'), "w") as f:
+            f.write("WRONG = True\n")
+        importer = InterpretedImporter(VirtualMachine(), ['bytepkg'])
+        importer.load_module('bytepkg')
+        helper = importer.load_module('bytepkg.helper')
+        self.assertEqual(helper.__file__, os.path.join(
+            self.tempdir, 'bytepkg', 'helper.py',
+        ))
+        self.assertEqual(helper.double(4), 8)
+        with self.assertRaises(ImportError):
+            importer.load_module('bytepkg.missing')
+
+    def test_matches(self):
+        importer = InterpretedImporter(None, ['app', 'lib*.core'])
+        self.assertTrue(importer.matches('app'))
+        self.assertTrue(importer.matches('app.models'))
+        self.assertTrue(importer.matches('libfoo.core'))
+        self.assertTrue(importer.matches('libfoo.core.util'))
+        self.assertFalse(importer.matches('apple'))
+        self.assertFalse(importer.matches('libfoo'))
@@ -0,0 +1,122 @@
+"""Test the peephole optimizer, for Byterun."""
+
+from __future__ import print_function
+
+import dis
+import textwrap
+import unittest
+
+from byterun import peephole
+from byterun.decode import decode_instructions
+
+
+def function_code(source, name='f'):
+    """Compile `source`, and get the code of the function `name` in it."""
+    code = compile(textwrap.dedent(source), "<test>", "exec")
+    for const in code.co_consts:
+        if getattr(const, 'co_name', None) == name:
+            return const
+    raise ValueError("No function %r" % (name,))
+
+
+def straight_line(instructions):
+    """Get the opcode names run by straight-line code, following `next`."""
+    names = []
+    offset = 0
+    while True:
+        instr = instructions[offset]
+        names.append(dis.opname[instr.opcode])
+        if names[-1] == 'RETURN_VALUE':
+            return names
+        offset = instr.next
+
+
+class TestPeephole(unittest.TestCase):
+    def optimize(self, source):
+        code = function_code(source)
+        return peephole.optimize(decode_instructions(code))
+
+    def test_folding(self):
+        instructions = self.optimize("""\
+            def f():
+                x = not 1
+                y = 1 < 2
+                return x, y
+            """)
+        self.assertEqual(
+            straight_line(instructions),
+            ['LOAD_CONST', 'STORE_FAST', 'LOAD_CONST', 'STORE_FAST',
+             'LOAD_FAST', 'LOAD_FAST', 'BUILD_TUPLE', 'RETURN_VALUE'],
+        )
+        self.assertEqual(instructions[0].arguments, (False,))
+
+    def test_no_folding_errors_or_big_values(self):
+        instructions = self.optimize("""\
+            def f():
+                x = 1 < 'a' < 2
+                y = 'abcdef' * 10 < 'z'
+                return x, y
+            """)
+        self.assertIn('COMPARE_OP', straight_line(instructions))
+
+    def test_swap(self):
+        instructions = self.optimize("""\
+            def f(a, b):
+                a, b = b, a
+                return a
+            """)
+        self.assertEqual(
+            straight_line(instructions),
+            ['LOAD_FAST', 'LOAD_FAST', 'STORE_FAST', 'STORE_FAST',
+             'LOAD_FAST', 'RETURN_VALUE'],
+        )
+
+    def test_jump_threading(self):
+        instructions = self.optimize("""\
+            def f(seq):
+                total = 0
+                for x in seq:
+                    if x:
+                        total += 1
+                    else:
+                        total -= 1
+                while total:
+                    total -= 1
+                return total
+            """)
+        skipped = (peephole.NOP,) + tuple(peephole.UNCONDITIONAL_JUMPS)
+        for instr in instructions:
+            if instr is None:
+                continue
+            if instr.next < len(instructions):
+                self.assertNotIn(instructions[instr.next].opcode, skipped)
+            if instr.opcode in peephole.THREADABLE_JUMPS:
+                target = instructions[instr.arguments[0]]
+                self.assertNotIn(target.opcode, skipped)
+
+    def test_unreachable(self):
+        code = function_code("""\
+            def f():
+                return 1
+                x = 2
+                return x
+            """)
+        decoded = decode_instructions(code)
+        instructions = peephole.optimize(decoded)
+        # Only LOAD_CONST and RETURN_VALUE, at offsets 0 and 3, can run.
+        self.assertGreater(sum(instr is not None for instr in decoded), 2)
+        self.assertEqual(
+            [offset for offset, instr in enumerate(instructions) if instr],
+            [0, 3],
+        )
+
+    def test_original_unchanged(self):
+        code = function_code("""\
+            def f(a, b):
+                a, b = b, a
+                return not 1
+            """)
+        instructions = decode_instructions(code)
+        before = list(instructions)
+        peephole.optimize(instructions)
+        self.assertEqual(instructions, before)
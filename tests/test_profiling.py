@@ -0,0 +1,267 @@
+"""Test profiling interpreted code, for Byterun."""
+
+from __future__ import print_function
+
+import cProfile
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import textwrap
+import unittest
+
+from six.moves import builtins
+
+from byterun.profiling import (
+    FunctionProfiler, OpcodeProfiler, SamplingProfiler,
+)
+from byterun.pyvm2 import VirtualMachine
+
+
+def profile_code():
+    return compile(textwrap.dedent("""\
+        def fn(a):
+            return a + 1
+        x = 0
+        for i in range(10):
+            x = fn(x)
+        """), "<profile>", "exec")
+
+
+class TestOpcodeProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def profile(self):
+        vm = VirtualMachine()
+        vm.opcode_profiler = OpcodeProfiler()
+        globs = {'__builtins__': builtins, '__name__': '__main__'}
+        vm.run_code(profile_code(), f_globals=globs)
+        # Profiling doesn't change what the code does.
+        self.assertEqual(globs['x'], 10)
+        return vm.opcode_profiler
+
+    def test_counts(self):
+        profiler = self.profile()
+        self.assertEqual(profiler.opcodes['BINARY_ADD'][0], 10)
+        # Ten calls to fn, and one to range.
+        self.assertEqual(profiler.opcodes['CALL_FUNCTION'][0], 11)
+        self.assertEqual(profiler.handlers['byte_CALL_FUNCTION'][0], 11)
+        self.assertEqual(profiler.handlers['byte_BINARY_ADD'][0], 10)
+        # Each instruction in the loop is a site run ten times.
+        fn_sites = [
+            count for (code, _), (count, _, _) in profiler.sites.items()
+            if code.co_name == 'fn'
+        ]
+        self.assertEqual(fn_sites, [10] * 4)
+        total = sum(stats[0] for stats in profiler.opcodes.values())
+        self.assertEqual(
+            total, sum(stats[0] for stats in profiler.sites.values())
+        )
+        # Calls are charged for the instructions they run inclusively only.
+        for count, time, inclusive in profiler.sites.values():
+            self.assertLessEqual(time, inclusive)
+
+    def test_json(self):
+        filename = os.path.join(self.tempdir, "out.json")
+        self.profile().write_json(filename)
+        with open(filename) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['opcodes']['BINARY_ADD']['count'], 10)
+        add = [s for s in stats['sites'] if s['opcode'] == 'BINARY_ADD'][0]
+        self.assertEqual(
+            (add['function'], add['line'], add['count']), ('fn', 2, 10)
+        )
+
+    def test_pstats(self):
+        filename = os.path.join(self.tempdir, "out.prof")
+        self.profile().write_pstats(filename)
+        stats = pstats.Stats(filename)
+        add = [
+            (key, value) for key, value in stats.stats.items()
+            if key[2].startswith('fn:BINARY_ADD@')
+        ]
+        self.assertEqual(len(add), 1)
+        (filename, line, _), (cc, nc, _, _, _) = add[0]
+        self.assertEqual((filename, line, nc), ("<profile>", 2, 10))
+
+
+
+class TestFunctionProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def profile(self):
+        code = compile(textwrap.dedent("""\
+            def fact(n):
+                if n <= 1:
+                    return 1
+                return n * fact(n - 1)
+            def gen():
+                yield fact(3)
+                yield fact(4)
+            def main():
+                return [fact(5), list(gen())]
+            x = main()
+            """), "<functions>", "exec")
+        for engine in VirtualMachine.ENGINES:
+            vm = VirtualMachine(engine=engine)
+            vm.function_profiler = FunctionProfiler()
+            globs = {'__builtins__': builtins, '__name__': '__main__'}
+            vm.run_code(code, f_globals=globs)
+            self.assertEqual(globs['x'], [120, [6, 24]])
+            yield vm.function_profiler
+
+    def test_pstats(self):
+        for profiler in self.profile():
+            filename = os.path.join(self.tempdir, "out.prof")
+            profiler.write_pstats(filename)
+            stats = pstats.Stats(filename).stats
+            keys = dict((key[2], key) for key in stats)
+            self.assertEqual(
+                sorted(keys), ['<module>', 'fact', 'gen', 'main'],
+            )
+
+            # fact was called three times from outside, and recursed.
+            cc, nc, tt, ct, callers = stats[keys['fact']]
+            self.assertEqual((cc, nc), (3, 12))
+            self.assertEqual(
+                sorted(callers), [keys['fact'], keys['gen'], keys['main']]
+            )
+            self.assertEqual(callers[keys['main']][:2], (1, 1))
+            self.assertEqual(callers[keys['gen']][:2], (2, 2))
+            # Only the first call from each outermost fact is primitive.
+            self.assertEqual(callers[keys['fact']][:2], (9, 3))
+            self.assertLessEqual(tt, ct)
+
+            # The generator ran three times: two yields, then the end.
+            cc, nc, tt, ct, callers = stats[keys['gen']]
+            self.assertEqual((cc, nc), (3, 3))
+            self.assertEqual(list(callers), [keys['main']])
+
+            cc, nc, tt, ct, callers = stats[keys['<module>']]
+            self.assertEqual((cc, nc, callers), (1, 1, {}))
+            # The whole run includes everything else.
+            self.assertEqual(
+                ct, max(value[3] for value in stats.values())
+            )
+
+    def test_recursive_callers_like_cprofile(self):
+        code = compile(textwrap.dedent("""\
+            def fib(n):
+                if n < 2:
+                    return n
+                return fib(n - 1) + fib(n - 2)
+            def even(n):
+                return n == 0 or odd(n - 1)
+            def odd(n):
+                return n != 0 and even(n - 1)
+            def main():
+                return [fib(8), fib(5), even(6)]
+            x = main()
+            """), "<recursive>", "exec")
+
+        def counts(stats):
+            # The call counts, and those from each caller, by function name.
+            return dict(
+                (key[2], (cc, nc, dict(
+                    (caller[2], edge[:2])
+                    for caller, edge in callers.items()
+                    if caller[0] == "<recursive>"
+                )))
+                for key, (cc, nc, tt, ct, callers) in stats.items()
+                if key[0] == "<recursive>"
+            )
+
+        profile = cProfile.Profile()
+        globs = {'__builtins__': builtins, '__name__': '__main__'}
+        profile.runctx(code, globs, globs)
+        profile.create_stats()
+        expected = counts(profile.stats)
+        self.assertEqual(expected['fib'][2]['fib'], (80, 4))
+
+        for engine in VirtualMachine.ENGINES:
+            vm = VirtualMachine(engine=engine)
+            vm.function_profiler = FunctionProfiler()
+            globs = {'__builtins__': builtins, '__name__': '__main__'}
+            vm.run_code(code, f_globals=globs)
+            self.assertEqual(globs['x'], [21, 5, True])
+            self.assertEqual(
+                counts(vm.function_profiler.pstats()), expected, engine,
+            )
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def run_sampled(self, source, interval=None):
+        code = compile(textwrap.dedent(source), "<samples>", "exec")
+        vm = VirtualMachine()
+        profiler = SamplingProfiler(vm)
+        globs = {
+            '__builtins__': builtins, '__name__': '__main__',
+            'sample': profiler.sample,
+        }
+        if interval is None:
+            vm.run_code(code, f_globals=globs)
+        else:
+            profiler.interval = interval
+            with profiler:
+                vm.run_code(code, f_globals=globs)
+        return profiler
+
+    def test_samples(self):
+        # The program takes its own samples, to know what they'll be.
+        profiler = self.run_sampled("""\
+            def inner():
+                sample()
+            def outer():
+                inner()
+                inner()
+                sample()
+            outer()
+            """)
+        inner = (
+            ("<samples>", "<module>", 7),
+            ("<samples>", "outer", 4),
+            ("<samples>", "inner", 2),
+        )
+        # The second call to inner is on another line.
+        inner2 = inner[:1] + (("<samples>", "outer", 5),) + inner[2:]
+        outer = (
+            ("<samples>", "<module>", 7),
+            ("<samples>", "outer", 6),
+        )
+        self.assertEqual(profiler.samples, {inner: 1, inner2: 1, outer: 1})
+        self.assertEqual(profiler.collapsed().splitlines(), [
+            "<module> (<samples>:7);outer (<samples>:4);"
+                "inner (<samples>:2) 1",
+            "<module> (<samples>:7);outer (<samples>:5);"
+                "inner (<samples>:2) 1",
+            "<module> (<samples>:7);outer (<samples>:6) 1",
+        ])
+        self.assertEqual(profiler.top(2), [
+            (("<samples>", "inner", 2), 2, 2),
+            (("<samples>", "outer", 6), 1, 1),
+        ])
+        self.assertIn("inner (<samples>:2)", profiler.summary())
+
+    def test_thread(self):
+        profiler = self.run_sampled("""\
+            def spin():
+                t = 0
+                for i in range(5000):
+                    t += i
+                return t
+            for _ in range(3):
+                spin()
+            """, interval=0.001)
+        self.assertIsNone(profiler._thread)
+        # It's up to the thread scheduler how many samples there are.
+        for stack in profiler.samples:
+            self.assertEqual(stack[0][1], "<module>")
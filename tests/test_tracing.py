@@ -0,0 +1,112 @@
+"""Test tracing interpreted code, for Byterun."""
+
+from __future__ import print_function
+
+import sys
+import textwrap
+
+from byterun.pyvm2 import VirtualMachine
+from . import vmtest
+
+
+class TestTracing(vmtest.VmTestCase):
+
+    def assert_same_trace(self, code):
+        """Trace `code` in our VM and in real Python: the events are the same."""
+        code = textwrap.dedent(code)
+        filename = "<%s>" % self.id()
+        code = compile(code, filename, "exec", 0, 1)
+
+        def tracer(events):
+            def trace(frame, event, arg):
+                if frame.f_code.co_filename == filename:
+                    if event == 'exception':
+                        arg = arg[0]
+                    events.append(
+                        (frame.f_code.co_name, event, frame.f_lineno, arg)
+                    )
+                return trace
+            return trace
+
+        py_events = []
+        sys.settrace(tracer(py_events))
+        try:
+            globs = {}
+            exec(code, globs, globs)
+        finally:
+            sys.settrace(None)
+
+        for engine in VirtualMachine.ENGINES:
+            vm_events = []
+            vm = VirtualMachine(engine=engine)
+            vm.settrace(tracer(vm_events))
+            vm.run_code(code)
+            self.assertEqual(vm_events, py_events)
+        return py_events
+
+    def test_lines(self):
+        events = self.assert_same_trace("""\
+            def fn(a):
+                b = a + 1
+                return b
+            x = 0
+            for i in range(3):
+                x += fn(i)
+            """)
+        self.assertIn(('fn', 'call', 1, None), events)
+        self.assertIn(('fn', 'return', 3, 3), events)
+
+    def test_exceptions(self):
+        self.assert_same_trace("""\
+            def fn():
+                raise ValueError("oops")
+            def catcher():
+                try:
+                    fn()
+                except ValueError:
+                    pass
+            catcher()
+            """)
+
+    def test_generators(self):
+        self.assert_same_trace("""\
+            def gen():
+                yield 1
+                x = 2
+                yield x
+            for i in gen():
+                i += 1
+            """)
+
+    def test_local_tracing(self):
+        # Frames whose 'call' event returns None get no line events.
+        code = compile(textwrap.dedent("""\
+            def fn():
+                x = 1
+                return x
+            fn()
+            """), "<local>", "exec")
+        events = []
+        def trace(frame, event, arg):
+            events.append((frame.f_code.co_name, event))
+            if frame.f_code.co_name != 'fn':
+                return trace
+        vm = VirtualMachine()
+        vm.settrace(trace)
+        self.assertIs(vm.gettrace(), trace)
+        vm.run_code(code)
+        self.assertIn(('fn', 'call'), events)
+        self.assertNotIn(('fn', 'line'), events)
+        self.assertNotIn(('fn', 'return'), events)
+
+    def test_tracer_errors(self):
+        code = compile("x = 1\ny = 2\n", "<errors>", "exec")
+        def trace(frame, event, arg):
+            if event == 'line':
+                raise ZeroDivisionError("bad tracer")
+            return trace
+        vm = VirtualMachine()
+        vm.settrace(trace)
+        with self.assertRaises(ZeroDivisionError):
+            vm.run_code(code)
+        self.assertIsNone(vm.gettrace())
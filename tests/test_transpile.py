@@ -0,0 +1,167 @@
+"""Test transpiling code to Python source, for Byterun."""
+
+from __future__ import print_function
+from . import vmtest
+
+import textwrap
+
+from six.moves import builtins
+
+from byterun import transpile
+from byterun.pyvm2 import VirtualMachine
+
+
+def run(vm, source):
+    code = compile(textwrap.dedent(source), "<transpile>", "exec")
+    env = {'__builtins__': builtins, '__name__': '__main__'}
+    vm.run_code(code, f_globals=env)
+    return env
+
+
+class TestTranspile(vmtest.VmTestCase):
+    def transpiled(self, vm, fn):
+        decoded = vm.decode_cache.get(fn.func_code)
+        return (decoded.transpiled or {}).get(type(vm))
+
+    def test_transpiled_after_runs(self):
+        vm = VirtualMachine(transpile_after=3)
+        env = run(vm, """\
+            def f(x):
+                return x * 2
+            answers = [f(1), f(2)]
+            """)
+        self.assertIsNone(self.transpiled(vm, env['f']))
+        self.assertEqual(env['f'](3), 6)
+        fn = self.transpiled(vm, env['f'])
+        self.assertIn("return s0", fn.source)
+        self.assertEqual(env['f'](4), 8)
+        self.assertEqual(env['answers'], [2, 4])
+
+    def test_not_transpiled_by_default(self):
+        vm = VirtualMachine()
+        env = run(vm, """\
+            def f(x):
+                return x * 2
+            answers = [f(n) for n in range(5)]
+            """)
+        self.assertIsNone(self.transpiled(vm, env['f']))
+
+    def test_ineligible_code(self):
+        vm = VirtualMachine(transpile_after=1)
+        env = run(vm, """\
+            def handles(x):
+                try:
+                    return 1 / x
+                except ZeroDivisionError:
+                    return 0
+            def generates(n):
+                yield n
+            def closes(n):
+                return lambda: n
+            def looks(n):
+                return locals()
+            answers = [
+                handles(0), list(generates(1)), closes(2)(), looks(3),
+            ]
+            """)
+        self.assertEqual(env['answers'], [0, [1], 2, {'n': 3}])
+        for name in ['handles', 'generates', 'closes', 'looks']:
+            self.assertIs(self.transpiled(vm, env[name]), False, name)
+
+    def test_overridden_handlers(self):
+        # A subclass that changes an opcode's handler still runs it.
+        class AddingVM(VirtualMachine):
+            def byte_BINARY_MULTIPLY(self):
+                x, y = self.popn(2)
+                self.push(x + y)
+
+        vm = AddingVM(transpile_after=1)
+        env = run(vm, """\
+            def f(x):
+                return x * 3
+            def g(x):
+                return x - 3
+            answers = [f(2), g(2)]
+            """)
+        self.assertEqual(env['answers'], [5, -1])
+        self.assertIs(self.transpiled(vm, env['f']), False)
+        self.assertTrue(self.transpiled(vm, env['g']))
+
+    def test_unbound_locals(self):
+        self.assert_ok("""\
+            def f(x):
+                if x:
+                    y = 1
+                return y
+            print(f(1))
+            f(0)
+            """, raises=UnboundLocalError)
+
+    def test_calling_unbound_methods(self):
+        self.assert_ok("""\
+            class A(object):
+                def m(self):
+                    return 'A'
+            class B(object):
+                pass
+            def call(f, x):
+                return f(x)
+            print(call(A.m, A()))
+            call(A.m, B())
+            """, raises=TypeError)
+
+    def test_calling_locals_by_another_name(self):
+        self.assert_ok("""\
+            L = locals
+            def f(x):
+                y = x + 1
+                return L()
+            print(sorted(f(1).items()))
+            print(sorted(f(2).items()))
+            """)
+
+    def test_runs_counted_per_vm_class(self):
+        class OtherVM(VirtualMachine):
+            pass
+
+        code = compile(textwrap.dedent("""\
+            def f(x):
+                return x * 2
+            answer = f(1)
+            """), "<transpile>", "exec")
+        envs = []
+        for vm_class in [VirtualMachine, OtherVM]:
+            vm = vm_class(transpile_after=2)
+            env = {'__builtins__': builtins, '__name__': '__main__'}
+            vm.run_code(code, f_globals=env)
+            envs.append((vm, env))
+        # The first VM's run of f doesn't count towards the other's.
+        for vm, env in envs:
+            self.assertIsNone(self.transpiled(vm, env['f']))
+            self.assertEqual(env['f'](2), 4)
+            self.assertTrue(self.transpiled(vm, env['f']))
+
+    def test_generated_source(self):
+        vm = VirtualMachine(transpile_after=1)
+        env = run(vm, """\
+            def f(seq):
+                total = 0
+                for x in seq:
+                    total += x
+                return total
+            answer = f([1, 2, 3])
+            """)
+        self.assertEqual(env['answer'], 6)
+        source = self.transpiled(vm, env['f']).source
+        # Locals and stack slots are plain variables, and the loop jumps
+        # back with `continue`.
+        self.assertIn("s1 += s2", source)
+        self.assertIn("l1 = s1", source)
+        self.assertIn("continue", source)
+        self.assertNotIn("frame.stack", source)
+
+
+class TestTranspilableOpcodes(vmtest.VmTestCase):
+    def test_base_class(self):
+        opcodes = transpile.transpilable_opcodes(VirtualMachine, VirtualMachine)
+        self.assertTrue(transpile.SOURCE_OPCODES <= opcodes)
@@ -3,6 +3,7 @@
 from __future__ import print_function
 
 import dis
+import logging
 import sys
 import textwrap
 import types
@@ -16,6 +17,12 @@ from byterun.pyvm2 import VirtualMachine, VirtualMachineError
 CAPTURE_STDOUT = ('-s' not in sys.argv)
 # Make this false to see the traceback from a failure inside pyvm2.
 CAPTURE_EXCEPTION = 1
+# Make this true to log each instruction.  Frames are then run by the VM's
+# tracing loop instead of its engines.
+LOG_INSTRUCTIONS = False
+
+if not LOG_INSTRUCTIONS:
+    logging.getLogger('byterun.pyvm2').setLevel(logging.WARNING)
 
 
 def dis_code(code):
@@ -29,6 +36,16 @@ def dis_code(code):
     dis.dis(code)
 
 
+def describe_options(optimize, transpile_after):
+    """Describe how a VM runs code, after the name of its engine."""
+    text = ""
+    if optimize:
+        text += ", optimized"
+    if transpile_after is not None:
+        text += ", transpiled after %d runs" % transpile_after
+    return text
+
+
 class VmTestCase(unittest.TestCase):
 
     def assert_ok(self, code, raises=None):
@@ -40,14 +57,65 @@ class VmTestCase(unittest.TestCase):
         # Print the disassembly so we'll see it if the test fails.
         dis_code(code)
 
+        # Run the code through our VM, with each of its engines, with and
+        # without optimizing, and transpiling every function it can.
+        configurations = [
+            (engine, optimize, None)
+            for optimize in (False, True)
+            for engine in VirtualMachine.ENGINES
+        ]
+        configurations.append(('dispatch', False, 1))
+        vm_results = [
+            configuration + self.run_in_vm(code, *configuration)
+            for configuration in configurations
+        ]
+
         real_stdout = sys.stdout
 
-        # Run the code through our VM.
+        # Run the code through the real Python interpreter, for comparison.
+
+        py_stdout = six.StringIO()
+        sys.stdout = py_stdout
+
+        py_value = py_exc = None
+        globs = {}
+        try:
+            py_value = eval(code, globs, globs)
+        except AssertionError:              # pragma: no cover
+            raise
+        except Exception as e:
+            py_exc = e
+
+        sys.stdout = real_stdout
+
+        for result in vm_results:
+            engine, optimize, transpile_after = result[:3]
+            vm_value, vm_exc, vm_output = result[3:]
+            msg = "With the %r engine" % (engine,)
+            msg += describe_options(optimize, transpile_after)
+            self.assert_same_exception(vm_exc, py_exc, msg)
+            self.assertEqual(vm_output, py_stdout.getvalue(), msg)
+            self.assertEqual(vm_value, py_value, msg)
+            if raises:
+                self.assertIsInstance(vm_exc, raises, msg)
+            else:
+                self.assertIsNone(vm_exc, msg)
+
+    def run_in_vm(self, code, engine, optimize=False, transpile_after=None):
+        """Run `code` in our VM, using `engine`, optimizing if `optimize`.
+
+        Functions are transpiled after `transpile_after` runs, if it isn't
+        None.  Returns the value, the exception raised if any, and the output.
+
+        """
+        real_stdout = sys.stdout
 
         vm_stdout = six.StringIO()
         if CAPTURE_STDOUT:              # pragma: no branch
             sys.stdout = vm_stdout
-        vm = VirtualMachine()
+        vm = VirtualMachine(
+            engine=engine, optimize=optimize, transpile_after=transpile_after,
+        )
 
         vm_value = vm_exc = None
         try:
@@ -64,34 +132,15 @@ class VmTestCase(unittest.TestCase):
                 raise
             vm_exc = e
         finally:
-            real_stdout.write("-- stdout ----------\n")
+            sys.stdout = real_stdout
+            real_stdout.write("-- stdout (%s%s) ----------\n" % (
+                engine, describe_options(optimize, transpile_after),
+            ))
             real_stdout.write(vm_stdout.getvalue())
 
-        # Run the code through the real Python interpreter, for comparison.
-
-        py_stdout = six.StringIO()
-        sys.stdout = py_stdout
-
-        py_value = py_exc = None
-        globs = {}
-        try:
-            py_value = eval(code, globs, globs)
-        except AssertionError:              # pragma: no cover
-            raise
-        except Exception as e:
-            py_exc = e
-
-        sys.stdout = real_stdout
-
-        self.assert_same_exception(vm_exc, py_exc)
-        self.assertEqual(vm_stdout.getvalue(), py_stdout.getvalue())
-        self.assertEqual(vm_value, py_value)
-        if raises:
-            self.assertIsInstance(vm_exc, raises)
-        else:
-            self.assertIsNone(vm_exc)
+        return vm_value, vm_exc, vm_stdout.getvalue()
 
-    def assert_same_exception(self, e1, e2):
+    def assert_same_exception(self, e1, e2, msg=None):
         """Exceptions don't implement __eq__, check it ourselves."""
-        self.assertEqual(str(e1), str(e2))
-        self.assertIs(type(e1), type(e2))
+        self.assertEqual(str(e1), str(e2), msg)
+        self.assertIs(type(e1), type(e2), msg)